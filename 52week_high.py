@@ -24,6 +24,9 @@
 # JT is Jegadeesh and Titman (1993)
 #
 # Price is adjusted stock price: prc / cfacpr (CRSP items)
+#
+# week52_high_daily uses the exact high (and low) over the past 252
+# trading days instead of the 12 calendar-month highs
 # ------------------------------------------------------------------
 
 import wrds
@@ -32,6 +35,10 @@ import pandas as pd
 import numpy as np
 import os
 import time
+from panel import ap_panel, sort_panel
+from memo import memoize, query, source
+from wrds_fetch import fetch
+import polars_backend
 
 class ap_week52_high:
     def __init__(self):
@@ -42,12 +49,13 @@ class ap_week52_high:
         conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
         # Extract CRSP daily data
-        dsf = conn.raw_sql("""
+        dsf, dsf_key = query(conn, """
             select a.permno, a.date, a.prc, a.cfacpr
             from crsp.dsf a left join crsp.msenames b
                 on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
             where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
-        """, date_cols=['date'])
+        """, fetch,
+            date_cols=['date'])
 
         dsf = dsf.drop_duplicates(['permno', 'date'], keep='last')
         dsf['permno'] = dsf['permno'].astype(int)
@@ -57,22 +65,26 @@ class ap_week52_high:
         dsf.loc[dsf['cfacpr']<=0, 'cfacpr'] = np.nan
         dsf['prc'] = dsf['prc'] / dsf['cfacpr']
         del dsf['cfacpr']
+        dsf = sort_panel(dsf, ['permno', 'yyyymm', 'date'])
         obs_nonpos = len(dsf.query('prc<=0'))
-        self.dsf = dsf.copy()
+        self.dsf = dsf
+        source(self, dsf=dsf_key)
 
         end_time = time.time()
         print('\n--------- Extract data from WRDS ---------')
         print(f'Obs (non-positive price): {obs_nonpos}')
         print(f'Time used: {(end_time-start_time)/60: 3.1f} mins\n')
 
-    def week52_high(self):
+    @memoize('dsf')
+    def week52_high(self, backend='pandas'):
+        if backend == 'polars':
+            return polars_backend.week52_high(self.dsf)
+
         start_time = time.time()
 
         # Past 12-month high price for each month
         month_high = (self.dsf.groupby(['permno', 'yyyymm'])
             ['prc'].max().to_frame('month_high').reset_index())
-        month_high = month_high.sort_values(['permno', 'yyyymm'],
-            ignore_index=True)
         month_high['l1month_high'] = (month_high.groupby('permno')
             ['month_high'].shift(1))
         month_high['pre12high'] = (month_high.groupby('permno')['month_high']
@@ -81,14 +93,9 @@ class ap_week52_high:
             ['l1month_high'].rolling(window=12, min_periods=12)
             .max().reset_index(drop=True))
         # Price on last trading day in month t
-        month_price = self.dsf.copy()
-        month_price = month_price.sort_values(['permno', 'yyyymm', 'date'],
-            ignore_index=True)
-        month_price = (month_price.drop_duplicates(['permno', 'yyyymm'],
-            keep='last').copy())
-        del month_price['date']
-        month_price = month_price.sort_values(['permno', 'yyyymm'],
-            ignore_index=True)
+        p = ap_panel(self.dsf, ['permno', 'yyyymm', 'date'])
+        month_price = (self.dsf.loc[p.last(['permno', 'yyyymm']),
+            ['permno', 'yyyymm', 'prc']].reset_index(drop=True))
         month_price['l1prc'] = month_price.groupby('permno')['prc'].shift(1)
 
         df = month_price.merge(month_high, how='inner', on=['permno', 'yyyymm'])
@@ -99,7 +106,7 @@ class ap_week52_high:
         df = df.dropna(subset=['week52h', 'week52h_skip'], how='all')
         obs = len(df)
         start_month = df['yyyymm'].min()
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        df = sort_panel(df, ['permno', 'yyyymm'])
 
         end_time = time.time()
         print('--------- 52-week high estimation ---------')
@@ -109,10 +116,62 @@ class ap_week52_high:
         print(f'Time used: {(end_time-start_time)/60: 3.1f} mins\n')
         return df
 
+    # Sliding max (np.fmax) or min (np.fmin) over the past w rows
+    # van Herk/Gil-Werman: running extremes within blocks of w rows from
+    # the left and from the right, so each window is the extreme of one
+    # suffix and one prefix. This is O(n) whatever the window length.
+    def sliding_ext(self, x, w, func):
+        n = len(x)
+        nb = -(-n//w)
+        blk = np.full(nb*w, np.nan)
+        blk[:n] = x
+        blk = blk.reshape(nb, w)
+        pre = func.accumulate(blk, axis=1).ravel()[:n]
+        suf = func.accumulate(blk[:, ::-1], axis=1)[:, ::-1].ravel()[:n]
+        res = np.full(n, np.nan)
+        i = np.arange(w-1, n)
+        res[i] = func(suf[i-w+1], pre[i])
+        return res
+
+    # Daily-resolution version: the highest (lowest) price over the past
+    # window trading days including day t (require the full window)
+    # month_end=True keeps the last trading day in each month and adds
+    # the skip-one-month version; otherwise values are for every day
+    @memoize('dsf')
+    def week52_high_daily(self, window=252, month_end=True):
+        start_time = time.time()
+        p = ap_panel(self.dsf[['permno', 'date', 'yyyymm', 'prc']],
+            ['permno', 'yyyymm', 'date'])
+
+        prc = p['prc'].to_numpy(dtype=float)
+        full = p.lag_index(window-1, ['permno'])[1]
+        high = np.where(full, self.sliding_ext(prc, window, np.fmax), np.nan)
+        low = np.where(full, self.sliding_ext(prc, window, np.fmin), np.nan)
+        p['week52h'] = prc/high - 1
+        p['week52l'] = prc/low - 1
+        if month_end:
+            p = p.filter(p.last(['permno', 'yyyymm']))
+            for i in ['week52h', 'week52l']:
+                p[i+'_skip'] = p.lag(i, 1, ['permno'])
+
+            var_list = ['week52h', 'week52h_skip', 'week52l', 'week52l_skip']
+            df = p.df[['permno', 'yyyymm']+var_list]
+        else:
+            var_list = ['week52h', 'week52l']
+            df = p.df[['permno', 'date', 'yyyymm']+var_list]
+
+        df = df.dropna(subset=var_list, how='all').reset_index(drop=True)
+
+        end_time = time.time()
+        print(f'--------- {window}-day high estimation ---------')
+        print(f'Obs: {len(df)}')
+        print(f'Start month: {df["yyyymm"].min()}')
+        print(f'Time used: {(end_time-start_time)/60: 3.1f} mins\n')
+        return df
+
 if __name__ == '__main__':
     db = ap_week52_high()
     week52 = db.week52_high()
-    week52 = week52.sort_values(['permno', 'yyyymm'], ignore_index=True)
     data_dir = '/Volumes/Seagate/asset_pricing_data'
     week52.to_csv(os.path.join(data_dir, 'week52_high.txt'),
         sep='\t', index=False)
@@ -27,23 +27,30 @@ import wrds
 import configparser as cp
 import pandas as pd
 import numpy as np
-from dateutil import relativedelta
 import time
 import os
 import warnings
+from panel import sort_panel
+from memo import memoize, query, query_key, source, code_version
+from checkpoint import ap_checkpoint
+from revision import ap_revision
 
 warnings.filterwarnings('ignore', category=pd.errors.PerformanceWarning)
 
 class ap_accounting:
-    def __init__(self):
+    var_list = ['aci', 'ag', 'dpia', 'noa', 'dnoa', 'dlno', 'ig', 'ig2', 'ig3',
+        'nsi', 'cdi', 'ivg', 'ivc', 'oa', 'ta', 'cheq']
+
+    # save_data: also checkpoint the cleaned Compustat data. The extracted
+    # data is in the query cache (memo.py) anyway
+    def __init__(self, save_data=False):
         start_time = time.time()
         pass_dir = '~/.pass'
         cfg = cp.ConfigParser()
         cfg.read(os.path.join(os.path.expanduser(pass_dir), 'credentials.cfg'))
         conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
-        # Extract CRSP daily data
-        funda = conn.raw_sql("""
+        funda_sql = """
             select gvkey, datadate, fyear, cusip, at, ceq, pstk, capx, sale,
                 invt, ppegt, che, dlc, dltt, mib, ppent, intan, ao, lo, dp,
                 csho, ajex, act, lct, txp, ni, oancf, ivao, lt, ivst, ivncf,
@@ -51,10 +58,44 @@ class ap_accounting:
             from comp.funda
             where consol='C' and popsrc ='D' and datafmt = 'STD'
                 and curcd = 'USD' and indfmt = 'INDL'
-        """, date_cols=['datadate'], chunksize=None)
-
-        funda = funda.sort_values(['gvkey', 'fyear', 'datadate'],
-            ignore_index=True)
+        """
+        permno_gvkey_sql = """
+            select distinct a.permno, b.gvkey, c.namedt, c.nameendt
+            from crsp.msenames a
+            inner join comp.security b on a.ncusip=substring(b.cusip, 1, 8)
+            inner join crsp.msenames c on a.permno=c.permno
+            where a.shrcd between 10 and 11 and a.exchcd between -2 and 3
+                and b.excntry='USA' and a.ncusip is not null
+                and b.cusip is not null
+            order by permno, gvkey, namedt
+        """
+
+        # Checkpoints are keyed on the source tables and the code, so a
+        # run resumes only from stages of the same inputs. If the catalog
+        # cannot be read, nothing is resumed
+        funda_key = query_key(conn, funda_sql)
+        permno_gvkey_key = query_key(conn, permno_gvkey_sql)
+        key = (funda_key, permno_gvkey_key, code_version(__name__))
+        if funda_key is None or permno_gvkey_key is None:
+            key += (os.getpid(), time.time())
+
+        self.ckpt = ap_checkpoint('accounting', key=key)
+        # Resume from the cleaned data if a previous run stopped
+        if (save_data and self.ckpt.has('funda')
+            and self.ckpt.has('permno_gvkey')):
+            self.funda = self.ckpt.load('funda')
+            self.permno_gvkey = self.ckpt.load('permno_gvkey')
+            source(self, funda=funda_key, permno_gvkey=permno_gvkey_key)
+            end_time = time.time()
+            print('\n--------- Resume from checkpoint ---------')
+            print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+            return
+
+        # Extract Compustat annual data
+        funda, funda_key = query(conn, funda_sql, date_cols=['datadate'],
+            chunksize=None)
+
+        funda = sort_panel(funda, ['gvkey', 'fyear', 'datadate'])
         funda = funda.drop_duplicates(['gvkey', 'fyear'], keep='last')
         for i in ['at', 'ajex', 'csho']:
             funda.loc[funda[i]<=0, i] = np.nan
@@ -67,34 +108,31 @@ class ap_accounting:
 
         funda['date'] = funda['datadate'] + pd.offsets.MonthEnd(0)
         funda['date'] = funda['date'] + pd.offsets.MonthEnd(6)
-        self.funda = funda.copy()
+        self.funda = funda
 
-       # PERMNO-GVKEY link for common shares in NYSE/AMEX/NASDAQ
-        permno_gvkey = conn.raw_sql("""
-            select distinct a.permno, b.gvkey, c.namedt, c.nameendt
-            from crsp.msenames a
-            inner join comp.security b on a.ncusip=substring(b.cusip, 1, 8)
-            inner join crsp.msenames c on a.permno=c.permno
-            where a.shrcd between 10 and 11 and a.exchcd between -2 and 3
-                and b.excntry='USA' and a.ncusip is not null
-                and b.cusip is not null
-            order by permno, gvkey, namedt
-        """, date_cols=['namedt', 'nameendt'], chunksize=None)
+        # PERMNO-GVKEY link for common shares in NYSE/AMEX/NASDAQ
+        permno_gvkey, permno_gvkey_key = query(conn, permno_gvkey_sql,
+            date_cols=['namedt', 'nameendt'], chunksize=None)
 
         permno_gvkey['permno'] = permno_gvkey['permno'].astype(int)
-        self.permno_gvkey = permno_gvkey.copy()
+        self.permno_gvkey = permno_gvkey
+        source(self, funda=funda_key, permno_gvkey=permno_gvkey_key)
+        if save_data:
+            self.ckpt.save('funda', funda)
+            self.ckpt.save('permno_gvkey', permno_gvkey)
 
         end_time = time.time()
         print('\n--------- Extract data from WRDS ---------')
         print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
 
-    def accounting_est(self):
-        start_time = time.time()
-        df = self.funda.copy()
+    # Annual characteristics at fiscal year end
+    def annual_est(self):
+        df = self.funda.copy(deep=False)
 
         # Abnormal corporate investment (aci)
         df.loc[(df['sale']>0) & (df['capx']>0), 'ce'] = df['capx'] / df['sale']
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
+        # funda is sorted by gvkey and fyear and the order is kept below
+        df = sort_panel(df, ['gvkey', 'fyear'])
         for i in range(1, 4):
             df['l'+str(i)+'ce'] = df.groupby('gvkey')['ce'].shift(i)
 
@@ -105,19 +143,17 @@ class ap_accounting:
         df.loc[df['fyear_gap']!=3, 'aci'] = np.nan
         df.loc[df['sale']<10, 'aci'] = np.nan
         df = (df.drop(columns=['ce', 'l1ce', 'l2ce', 'l3ce', 'ce_avg3yr',
-            'l3fyear', 'fyear_gap']).copy())
+            'l3fyear', 'fyear_gap']))
 
         # Asset growth (ag)
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         df['l1at'] = df.groupby('gvkey')['at'].shift(1)
         df['l1fyear'] = df.groupby('gvkey')['fyear'].shift(1)
         df['fyear_gap'] = df['fyear'] - df['l1fyear']
         df['ag'] = df['at'] / df['l1at'] - 1
         df.loc[df['fyear_gap']!=1, 'ag'] = np.nan
-        df = df.drop(columns=['l1at', 'l1fyear', 'fyear_gap']).copy()
+        df = df.drop(columns=['l1at', 'l1fyear', 'fyear_gap'])
 
         # Changes in PPE and inventory to assets (dpia)
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         for i in ['ppegt', 'invt', 'at']:
             df['l1'+i] = df.groupby('gvkey')[i].shift(1)
             df['d'+i] = df[i] - df['l1'+i]
@@ -127,11 +163,10 @@ class ap_accounting:
         df['dpia'] = (df['dppegt']+df['dinvt']) / df['l1at']
         df.loc[df['fyear_gap']!=1, 'dpia'] = np.nan
         df = (df.drop(columns=['l1at', 'dat', 'l1ppegt', 'dppegt', 'l1invt',
-            'dinvt', 'l1fyear', 'fyear_gap']).copy())
+            'dinvt', 'l1fyear', 'fyear_gap']))
 
         # Net operating assets (noa)
         # Changes in net operating assets (dnoa)
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         df['l1at'] = df.groupby('gvkey')['at'].shift(1)
         df['l1fyear'] = df.groupby('gvkey')['fyear'].shift(1)
         df['fyear_gap'] = df['fyear'] - df['l1fyear']
@@ -142,15 +177,13 @@ class ap_accounting:
         df['noa'] = df['noasset'] / df['l1at']
         df.loc[df['fyear_gap']!=1, 'noa'] = np.nan
 
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         df['l1noasset'] = df.groupby('gvkey')['noasset'].shift(1)
         df['dnoa'] = (df['noasset']-df['l1noasset']) / df['l1at']
         df.loc[df['fyear_gap']!=1, 'dnoa'] = np.nan
         df = (df.drop(columns=['l1at', 'l1fyear', 'fyear_gap', 'oa', 'ol',
-            'noasset', 'l1noasset']).copy())
+            'noasset', 'l1noasset']))
 
         # Changes in long-term net operating assets (dlno)
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         for i in ['ppent', 'intan', 'ao', 'lo', 'at']:
             df['l1'+i] = df.groupby('gvkey')[i].shift(1)
             df['d'+i] = df[i] - df['l1'+i]
@@ -164,12 +197,11 @@ class ap_accounting:
         df.loc[df['fyear_gap']!=1, 'dlno'] = np.nan
         df = (df.drop(columns=['l1at', 'l1fyear', 'fyear_gap', 'l1ppent',
             'l1intan', 'l1ao', 'l1lo', 'dppent', 'dintan', 'dao', 'dlo',
-            'dat', 'dlnoasset', 'at_avg2yr']).copy())
+            'dat', 'dlnoasset', 'at_avg2yr']))
 
         # Investment growth (ig)
         # 2-year investment growth (ig2)
         # 3-year investment growth (ig3)
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         for i in range(1, 4):
             df['l'+str(i)+'capx'] = df.groupby('gvkey')['capx'].shift(i)
             df['l'+str(i)+'fyear'] = df.groupby('gvkey')['fyear'].shift(i)
@@ -184,7 +216,7 @@ class ap_accounting:
         df.loc[df['fyear_gap2']!=2, 'ig2'] = np.nan
         df.loc[df['fyear_gap3']!=3, 'ig3'] = np.nan
         df = (df.drop(columns=['l1capx', 'l1fyear', 'fyear_gap', 'l2capx',
-            'l2fyear', 'fyear_gap2', 'l3capx', 'l3fyear', 'fyear_gap3']).copy())
+            'l2fyear', 'fyear_gap2', 'l3capx', 'l3fyear', 'fyear_gap3']))
 
         # Net stock issues (nsi)
         # Hou, Xue and Zhang (2020)
@@ -192,30 +224,27 @@ class ap_accounting:
         # stocks with zero Nsi into 1 portfolio (3), and stocks with positive Nsi
         # into seven portfolios (4 to 10)"
         df['csho_adj'] = df['csho'] * df['ajex']
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         df['l1csho_adj'] = df.groupby('gvkey')['csho_adj'].shift(1)
         df['l1fyear'] = df.groupby('gvkey')['fyear'].shift(1)
         df['fyear_gap'] = df['fyear'] - df['l1fyear']
         df['nsi'] = np.log(df['csho_adj']/df['l1csho_adj'])
         df.loc[df['fyear_gap']!=1, 'nsi'] = np.nan
         df = (df.drop(columns=['csho_adj', 'l1csho_adj', 'l1fyear',
-            'fyear_gap']).copy())
+            'fyear_gap']))
 
         # Composite debt issuance (cdi)
         df['bvdebt'] = df['dlc'] + df['dltt']
         df.loc[df['bvdebt']<=0, 'bvdebt'] = np.nan
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         df['l5bvdebt'] = df.groupby('gvkey')['bvdebt'].shift(5)
         df['l5fyear'] = df.groupby('gvkey')['fyear'].shift(5)
         df['fyear_gap'] = df['fyear'] - df['l5fyear']
         df['cdi'] = np.log(df['bvdebt']/df['l5bvdebt'])
         df.loc[df['fyear_gap']!=5, 'cdi'] = np.nan
         df = (df.drop(columns=['bvdebt', 'l5bvdebt', 'l5fyear',
-            'fyear_gap']).copy())
+            'fyear_gap']))
 
         # Inventory growth (ivg)
         # Inventory changes (ivc)
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         df['l1invt'] = df.groupby('gvkey')['invt'].shift(1)
         df['l1at'] = df.groupby('gvkey')['at'].shift(1)
         df['l1fyear'] = df.groupby('gvkey')['fyear'].shift(1)
@@ -227,10 +256,9 @@ class ap_accounting:
         df.loc[df['fyear_gap']!=1, 'ivg'] = np.nan
         df.loc[df['fyear_gap']!=1, 'ivc'] = np.nan
         df = (df.drop(columns=['l1invt', 'l1fyear', 'fyear_gap', 'l1at',
-            'at_avg2yr']).copy())
+            'at_avg2yr']))
 
         # Operating accruals (oa)
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         for i in ['act', 'che', 'lct', 'dlc', 'txp']:
             df['l1'+i] = df.groupby('gvkey')[i].shift(1)
             df['d'+i] = df[i] - df['l1'+i]
@@ -246,7 +274,7 @@ class ap_accounting:
         df.loc[df['fyear_gap']!=1, 'oa'] = np.nan
         df = (df.drop(columns=['l1act', 'l1che', 'l1lct', 'l1dlc', 'l1txp',
             'dact', 'dche', 'dlct', 'ddlc', 'dtxp', 'l1fyear', 'l1at',
-            'fyear_gap']).copy())
+            'fyear_gap']))
 
         # Total accruals (ta)
         df['coa'] = df['act'] - df['che']
@@ -258,7 +286,6 @@ class ap_accounting:
         df['fna'] = df['ivst'] + df['ivao']
         df['fnl'] = df['dltt'] + df['dlc'] + df['pstk']
         df['fin'] = df['fna'] - df['fnl']
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         for i in ['wc', 'nco', 'fin']:
             df['l1'+i] = df.groupby('gvkey')[i].shift(1)
             df['d'+i] = df[i] - df['l1'+i]
@@ -273,7 +300,6 @@ class ap_accounting:
         df.loc[df['fyear_gap']!=1, 'ta'] = np.nan
 
         # Sustainable growth (cheq)
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
         df['l1ceq'] = df.groupby('gvkey')['ceq'].shift(1)
         df['l1fyear'] = df.groupby('gvkey')['fyear'].shift(1)
         df['fyear_gap'] = df['fyear'] - df['l1fyear']
@@ -281,32 +307,41 @@ class ap_accounting:
             & (df['fyear_gap']==1), 'cheq'] = df['ceq'] / df['l1ceq'] - 1
 
         # Clean
-        var_list = ['aci', 'ag', 'dpia', 'noa', 'dnoa', 'dlno', 'ig', 'ig2',
-            'ig3', 'nsi', 'cdi', 'ivg', 'ivc', 'oa', 'ta', 'cheq']
-        df = df[['gvkey', 'date', 'datadate', 'fyear']+var_list].copy()
-        df = df.sort_values(['gvkey', 'fyear'], ignore_index=True)
+        df = df[['gvkey', 'date', 'datadate', 'fyear']+self.var_list]
+        return df
 
-        # Expand data to distibute surprise to monthly frequence
+    # Expand data to distibute surprise to monthly frequence
+    def expand_month(self):
+        df = self.ckpt.stage('annual', self.annual_est)
         df = pd.concat([df]*12, ignore_index=True)
         df['month_gap'] = df.groupby(['gvkey', 'date'])['date'].cumcount()
-        df = df.sort_values(['gvkey', 'date', 'month_gap'], ignore_index=True)
-        df['month_gap'] = (df['month_gap']
-            .apply(lambda x: relativedelta.relativedelta(months=x)))
-        df['date'] = df['date'] + df['month_gap'] + pd.offsets.MonthEnd(0)
+        df = sort_panel(df, ['gvkey', 'date', 'month_gap'])
+        # Month end of date plus month_gap months
+        m = (df['date'].to_numpy().astype('datetime64[M]')
+            + df['month_gap'].to_numpy())
+        df['date'] = ((m+1).astype('datetime64[D]') - np.timedelta64(1, 'D'))
+        df['date'] = df['date'].astype('datetime64[ns]')
         del df['month_gap']
-        df = df.sort_values(['gvkey', 'date', 'datadate'], ignore_index=True)
-        df = df.drop_duplicates(['gvkey', 'date'], keep='last').copy()
+        df = sort_panel(df, ['gvkey', 'date', 'datadate'])
+        df = df.drop_duplicates(['gvkey', 'date'], keep='last')
         df['yyyymm'] = df['date'].dt.year*100 + df['date'].dt.month
+        return df
+
+    @memoize('funda', 'permno_gvkey')
+    def accounting_est(self):
+        start_time = time.time()
+        var_list = self.var_list
+        df = self.ckpt.stage('expanded', self.expand_month)
         # Get PERMNO to SUE data with date range condition
         # TODO: use CRSP-Compustat Merged data if available
         df = df.merge(self.permno_gvkey, how='left', on='gvkey')
-        df = df.query('namedt<=datadate<=nameendt').copy()
+        df = df.query('namedt<=datadate<=nameendt')
         df = df[['permno', 'yyyymm']+var_list+['gvkey', 'datadate']]
-        df = df.sort_values(['permno', 'yyyymm', 'datadate'], ignore_index=True)
-        df = df.drop_duplicates(['permno', 'yyyymm'], keep='last').copy()
+        df = sort_panel(df, ['permno', 'yyyymm', 'datadate'])
+        df = df.drop_duplicates(['permno', 'yyyymm'], keep='last')
         df = df.dropna(subset=var_list, how='all')
         df['permno'] = df['permno'].astype('int')
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        df = df.reset_index(drop=True)
 
         end_time = time.time()
         print(f'--------- Accounting estimation ---------')
@@ -316,8 +351,13 @@ class ap_accounting:
 
 if __name__ == '__main__':
     db = ap_accounting()
-    acct = db.accounting_est()
-    acct = acct.sort_values(['permno', 'yyyymm'], ignore_index=True)
+    # Recompute the permno whose Compustat data or link is revised
+    rev = ap_revision('accounting')
+    scope = rev.scope(db, {'funda': 'gvkey', 'permno_gvkey': 'gvkey'},
+        link='permno_gvkey')
+    acct = rev.estimate(db, 'accounting_est', scope)
     data_dir = '/Volumes/Seagate/asset_pricing_data'
     acct.to_csv(os.path.join(data_dir, 'accounting.txt'), sep='\t', index=False)
+    rev.commit()
+    db.ckpt.clear()
     print('Done: data is generated')
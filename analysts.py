@@ -25,7 +25,36 @@
 # See details: https://wrds-www.wharton.upenn.edu/documents/796/IBES_CRSP_Linking_Table_by_WRDS.pdf
 #
 # Need to pay attention to extreme values of dispersion: might
-# winsorize to kick out outliers.
+# winsorize to kick out outliers. analysts_est(winsor=(0.01, 0.99))
+# winsorizes disp at monthly 1st and 99th percentiles.
+#
+# Detail mode: ap_analysts(detail=True) builds the monthly consensus
+# from the individual analyst estimates (ibes.detu_epsus) instead of
+# the summary file. The detail file is streamed in ticker order and
+# ap_ibes_detail keeps the rows of the current ticker only (the last
+# ticker of a chunk is carried to the next chunk). fetch_chunks reads
+# through a server-side cursor, so memory is one chunk plus the rows of
+# the current ticker:
+#
+# The latest estimate of each analyst for each fiscal period is valid
+# at month end from its announcement date (anndats) until the analyst
+# revises it, and is dropped:
+# - on the fiscal period end date (fpedats)
+# - window days after anndats (consensus window, default no limit)
+# - stale days after the last confirmation date revdats (stale forecast
+#   filter, default no limit)
+# At each month end FY1 is the nearest fiscal period of the valid
+# estimates. As in the summary mode, keep if the month end is more than
+# horizon (30) days before the period end.
+#
+# numest, meanest, stdev: number, mean and standard deviation of the
+# valid estimates (the same columns as the summary file)
+# n_up, n_down: number of analysts whose estimate is higher (lower) than
+# their estimate for the same period at the previous month end
+# rev: (n_up-n_down) / numest (net revision ratio)
+# fchg: change in meanest from the previous month end for the same
+# period, scaled by the absolute value of the previous meanest
+# revision_est gives rev and fchg by permno-month
 # ------------------------------------------------------------------
 
 import wrds
@@ -35,9 +64,132 @@ import numpy as np
 import os
 import time
 from datetime import timedelta
+from panel import sort_panel
+from memo import memoize, query, source
+from cross_section import ap_cross_section
+from revision import ap_revision
+from wrds_fetch import fetch_chunks
+
+# Month end (datetime64[D]) of months (datetime64[M])
+def month_end(m):
+    return (m+1).astype('datetime64[D]') - np.timedelta64(1, 'D')
+
+class ap_ibes_detail:
+    def __init__(self, window=None, stale=None, horizon=30):
+        self.window = window
+        self.stale = stale
+        self.horizon = horizon
+        self.carry = None
+
+    # Monthly statistics of the tickers of df (all rows of each ticker)
+    def estimate(self, df):
+        df = df.dropna(subset=['ticker', 'analys', 'value', 'fpedats',
+            'anndats'])
+        if len(df) == 0:
+            return None
+
+        key = ['ticker', 'analys', 'fpedats']
+        df = sort_panel(df, key+['anndats'])
+        # Latest estimate of a day
+        df = df.drop_duplicates(key+['anndats'], keep='last')
+        ann = df['anndats'].to_numpy(dtype='datetime64[D]')
+        day = np.timedelta64(1, 'D')
+        # Last day of each estimate
+        end = df['fpedats'].to_numpy(dtype='datetime64[D]') - day
+        nxt = (df.groupby(key)['anndats'].shift(-1)
+            .to_numpy(dtype='datetime64[D]'))
+        end = np.where(np.isnat(nxt), end, np.minimum(end, nxt-day))
+        if self.window is not None:
+            end = np.minimum(end, ann+np.timedelta64(self.window, 'D'))
+
+        if self.stale is not None:
+            rev = df['revdats'].to_numpy(dtype='datetime64[D]')
+            rev = np.where(np.isnat(rev), ann, np.maximum(rev, ann))
+            end = np.minimum(end, rev+np.timedelta64(self.stale, 'D'))
+
+        # Month ends from the month of anndats to end
+        first = ann.astype('datetime64[M]')
+        last = end.astype('datetime64[M]')
+        last = np.where(end>=month_end(last), last, last-1)
+        n = np.maximum((last-first).astype(np.int64)+1, 0)
+        i = np.repeat(np.arange(len(df)), n)
+        m = first[i] + (np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n))
+        est = pd.DataFrame({'ticker': df['ticker'].to_numpy()[i],
+            'analys': df['analys'].to_numpy()[i],
+            'fpedats': df['fpedats'].to_numpy()[i],
+            'value': df['value'].to_numpy()[i], 'm': m.astype(np.int64)})
+
+        # FY1: the nearest fiscal period at each month end
+        period = est.groupby(['ticker', 'm'])['fpedats'].transform('min')
+        est = est[est['fpedats']==period]
+        gap = (est['fpedats'].to_numpy(dtype='datetime64[D]')
+            - month_end(est['m'].to_numpy().astype('datetime64[M]')))
+        est = est[gap>np.timedelta64(self.horizon, 'D')]
+
+        res = (est.groupby(['ticker', 'm', 'fpedats'])['value']
+            .agg(['count', 'mean', 'std']).reset_index())
+        res.columns = ['ticker', 'm', 'fpedats', 'numest', 'meanest', 'stdev']
+        # Revisions from the previous month end for the same period
+        prev = est[key+['m', 'value']]
+        prev['m'] = prev['m'] + 1
+        chg = est.merge(prev, how='inner', on=key+['m'],
+            suffixes=('', '_prev'))
+        chg['n_up'] = (chg['value']>chg['value_prev']).astype(int)
+        chg['n_down'] = (chg['value']<chg['value_prev']).astype(int)
+        chg = chg.groupby(['ticker', 'm'])[['n_up', 'n_down']].sum()
+        res = res.merge(chg.reset_index(), how='left', on=['ticker', 'm'])
+        res[['n_up', 'n_down']] = res[['n_up', 'n_down']].fillna(0).astype(int)
+        res['rev'] = (res['n_up']-res['n_down']) / res['numest']
+        prev = res[['ticker', 'm', 'fpedats', 'meanest']]
+        prev['m'] = prev['m'] + 1
+        res = res.merge(prev, how='left', on=['ticker', 'm', 'fpedats'],
+            suffixes=('', '_prev'))
+        res['fchg'] = np.where(res['meanest_prev']==0, np.nan,
+            (res['meanest']-res['meanest_prev']) / res['meanest_prev'].abs())
+
+        res['statpers'] = month_end(res['m'].to_numpy().astype('datetime64[M]'))
+        res['statpers'] = res['statpers'].astype('datetime64[ns]')
+        res['yyyymm'] = (res['m']//12+1970)*100 + res['m']%12 + 1
+        return res[['ticker', 'statpers', 'yyyymm', 'fpedats', 'numest',
+            'meanest', 'stdev', 'n_up', 'n_down', 'rev', 'fchg']]
+
+    # Rows of complete tickers are estimated and the rows of the last
+    # ticker are kept for the next block. Rows without ticker are dropped
+    def update(self, block):
+        block = block[block['ticker'].notna()]
+        if self.carry is not None:
+            block = pd.concat([self.carry, block], ignore_index=True)
+
+        if len(block) == 0:
+            return []
+
+        ticker = block['ticker'].to_numpy()
+        cut = np.argmax(ticker==ticker[-1])
+        self.carry = block.iloc[cut:]
+        df = self.estimate(block.iloc[:cut])
+        return [] if df is None else [df]
+
+    def flush(self):
+        df = None if self.carry is None else self.estimate(self.carry)
+        self.carry = None
+        return df
+
+    def run(self, blocks):
+        for block in blocks:
+            yield from self.update(block)
+
+        df = self.flush()
+        if df is not None:
+            yield df
+
+# Monthly statistics of the detail file, streamed in chunks
+def read_detail(conn, sql, st, date_cols=None):
+    return pd.concat(st.run(fetch_chunks(conn, sql, date_cols)),
+        ignore_index=True)
 
 class ap_analysts:
-    def __init__(self):
+    # detail: monthly consensus from the detail file (ap_ibes_detail)
+    def __init__(self, detail=False, window=None, stale=None, horizon=30):
         start_time = time.time()
         pass_dir = '~/.pass'
         cfg = cp.ConfigParser()
@@ -45,7 +197,7 @@ class ap_analysts:
         conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
         # Extract CRSP-IBES link table
-        crsp_ibes_link = conn.raw_sql("""
+        crsp_ibes_link, link_key = query(conn, """
             select ticker, permno, sdate, edate
             from wrdsapps.ibcrsphist
             where score<=2
@@ -53,40 +205,66 @@ class ap_analysts:
 
         crsp_ibes_link['permno'] = crsp_ibes_link['permno'].astype(int)
 
-        # Extract IBES unadjusted file
-        ibes = conn.raw_sql("""
-            select ticker, statpers, numest, meanest, stdev, fpedats
-            from ibes.statsumu_epsus
-            where fpi='1' and measure='EPS' and usfirm=1 and curcode='USD'
-            order by ticker, statpers
-        """, date_cols=['statpers', 'fpedats'])
-
-        print('\n--------- Extract data from WRDS ---------')
-        print(f'Obs (raw): {len(ibes)}')
-        ibes = ibes.drop_duplicates(['ticker', 'statpers'], keep='last')
-        print(f'Obs (after removing duplicates): {len(ibes)}')
-        ibes = ibes.merge(crsp_ibes_link, how='inner', on='ticker')
-        # Ensure valid link period
-        ibes = ibes.query('sdate<=statpers<=edate').copy()
-        ibes['yyyymm'] = ibes['statpers'].dt.year*100 + ibes['statpers'].dt.month
-        obs = len(ibes)
-        obs_0meanest = len(ibes.query('meanest==0'))
-        print(f'Obs (with valid link): {obs}')
-        print(f'Percent (zero meanest): {obs_0meanest/obs: 3.2%}')
-        # Keep if the forecasts are made 30 days before the forecast period end
-        ibes['date_gap'] = ibes['fpedats'] - ibes['statpers']
-        obs_less30days = len(ibes[ibes['date_gap']<=timedelta(days=30)])
-        print(f'Percent (forecast made less than 30 days): {obs_less30days/obs: 3.2%}')
-        ibes = ibes[ibes['date_gap']>timedelta(days=30)].copy()
-        ibes = ibes[['permno', 'yyyymm', 'numest', 'stdev', 'meanest']].copy()
-        print(f'Obs (with valid forecasts): {len(ibes)}')
-        self.ibes = ibes.copy()
+        if detail:
+            # Stream IBES unadjusted detail file in ticker order. The
+            # monthly statistics are cached, keyed on the parameters
+            ibes, ibes_key = query(conn, """
+                select ticker, analys, value, fpedats, anndats, revdats
+                from ibes.detu_epsus
+                where fpi='1' and measure='EPS' and usfirm=1
+                    and report_curr='USD' and ticker is not null
+                order by ticker, anndats
+            """, read_detail, tag=(window, stale, horizon),
+                date_cols=['fpedats', 'anndats', 'revdats'],
+                st=ap_ibes_detail(window, stale, horizon))
+            print('\n--------- Extract data from WRDS (detail) ---------')
+            print(f'Obs (ticker-month): {len(ibes)}')
+            ibes = ibes.merge(crsp_ibes_link, how='inner', on='ticker')
+            # Ensure valid link period
+            ibes = ibes.query('sdate<=statpers<=edate')
+            ibes = ibes[['ticker', 'permno', 'yyyymm', 'numest', 'stdev',
+                'meanest', 'n_up', 'n_down', 'rev', 'fchg']]
+            print(f'Obs (with valid link): {len(ibes)}')
+        else:
+            # Extract IBES unadjusted file
+            ibes, ibes_key = query(conn, """
+                select ticker, statpers, numest, meanest, stdev, fpedats
+                from ibes.statsumu_epsus
+                where fpi='1' and measure='EPS' and usfirm=1 and curcode='USD'
+                order by ticker, statpers
+            """, date_cols=['statpers', 'fpedats'])
+
+            print('\n--------- Extract data from WRDS ---------')
+            print(f'Obs (raw): {len(ibes)}')
+            ibes = ibes.drop_duplicates(['ticker', 'statpers'], keep='last')
+            print(f'Obs (after removing duplicates): {len(ibes)}')
+            ibes = ibes.merge(crsp_ibes_link, how='inner', on='ticker')
+            # Ensure valid link period
+            ibes = ibes.query('sdate<=statpers<=edate')
+            ibes['yyyymm'] = ibes['statpers'].dt.year*100 + ibes['statpers'].dt.month
+            obs = len(ibes)
+            obs_0meanest = len(ibes.query('meanest==0'))
+            print(f'Obs (with valid link): {obs}')
+            print(f'Percent (zero meanest): {obs_0meanest/obs: 3.2%}')
+            # Keep if the forecasts are made 30 days before the forecast period end
+            ibes['date_gap'] = ibes['fpedats'] - ibes['statpers']
+            obs_less30days = len(ibes[ibes['date_gap']<=timedelta(days=30)])
+            print(f'Percent (forecast made less than 30 days): {obs_less30days/obs: 3.2%}')
+            ibes = ibes[ibes['date_gap']>timedelta(days=30)]
+            # ticker is kept for revision.py (ticker-permno link)
+            ibes = ibes[['ticker', 'permno', 'yyyymm', 'numest', 'stdev',
+                'meanest']]
+            print(f'Obs (with valid forecasts): {len(ibes)}')
+
+        self.ibes = ibes
+        source(self, ibes=(link_key, ibes_key, detail))
 
         end_time = time.time()
         print(f'Time used: {end_time-start_time: 3.1f} seconds')
 
-    def analysts_est(self):
-        df = self.ibes.copy()
+    @memoize('ibes')
+    def analysts_est(self, winsor=None):
+        df = self.ibes.copy(deep=False)
         # Require meanest not equal to 0
         df['disp'] = np.where(df['meanest']==0, np.nan,
             df['stdev'] / df['meanest'].abs())
@@ -96,14 +274,31 @@ class ap_analysts:
         df = df.drop(columns=['stdev', 'meanest'])
         df['cov'] = df['cov'].astype(int)
         df = df[['permno', 'yyyymm', 'cov', 'disp']]
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        df = sort_panel(df, ['permno', 'yyyymm'])
+        if winsor is not None:
+            cs = ap_cross_section(df, ['disp'])
+            df['disp'] = cs.winsorize(['disp'], *winsor)['disp']
+
         return df
 
+    # Revisions from the detail file: rev, fchg (and n_up, n_down)
+    @memoize('ibes')
+    def revision_est(self):
+        if 'rev' not in self.ibes:
+            raise ValueError('revision_est requires ap_analysts(detail=True)')
+
+        df = self.ibes[['permno', 'yyyymm', 'n_up', 'n_down', 'rev', 'fchg']]
+        return sort_panel(df, ['permno', 'yyyymm'])
+
 if __name__ == '__main__':
     db = ap_analysts()
-    analysts = db.analysts_est()
-    analysts = analysts.sort_values(['permno', 'yyyymm'], ignore_index=True)
+    # Recompute the permno whose IBES data or link is revised. Without
+    # winsorization disp of a permno-month uses its own rows only
+    rev = ap_revision('analysts')
+    scope = rev.scope(db, {'ibes': 'ticker'}, link='ibes')
+    analysts = rev.estimate(db, 'analysts_est', scope)
     data_dir = '/Volumes/Seagate/asset_pricing_data'
     analysts.to_csv(os.path.join(data_dir, 'analysts.txt'),
         sep='\t', index=False)
+    rev.commit()
     print('Done: data is generated')
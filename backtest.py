@@ -0,0 +1,141 @@
+# ------------------------------------------------------------------
+#                       Portfolio sort backtest
+#
+# ap_backtest sorts stocks into q portfolios (deciles by default) on
+# each characteristic of a (permno, yyyymm) panel and computes equal-
+# and value-weighted portfolio returns and the high-minus-low spread.
+#
+# L/M/N design of Ang, Hodrick, Xing and Zhang (2006): characteristics
+# are estimated over L months (this is done by the scripts that generate
+# them), portfolios formed at the end of month t are held after waiting
+# M months for N months. With N>1 the return in a month is the average
+# of the N overlapping portfolios. AHXZ use 1/0/1: wait=0 and hold=1.
+#
+# Value weights are market equity at the end of the month before the
+# return month. Breakpoints are from all stocks or NYSE stocks (nyse is
+# a NYSE indicator column of the characteristic panel).
+#
+# Portfolio assignments (ap_cross_section.bucket) and the rows of the
+# return panel for each holding month are computed once and shared by
+# all characteristics.
+#
+# ret: permno, yyyymm, ret (return in month yyyymm), me (market equity
+# at the end of month yyyymm)
+#
+# Example
+# bt = ap_backtest(chars, ret, ['mdr1', 'ivol_ff3'], q=10, nyse='nyse')
+# port = bt.port_ret()
+# table = bt.summary(port)
+# ------------------------------------------------------------------
+
+import pandas as pd
+import numpy as np
+import time
+from cross_section import ap_cross_section
+
+def month_index(yyyymm):
+    yyyymm = np.asarray(yyyymm, dtype=np.int64)
+    return (yyyymm//100)*12 + yyyymm%100 - 1
+
+class ap_backtest:
+    def __init__(self, chars, ret, char_list=None, q=10, nyse=None, wait=0,
+        hold=1):
+        start_time = time.time()
+        if char_list is None:
+            char_list = [i for i in chars.columns
+                if i not in ['permno', 'yyyymm', nyse]]
+
+        self.char_list = list(char_list)
+        self.q = q
+        self.lags = list(range(wait+1, wait+hold+1))
+
+        # Portfolio of each stock-month for all characteristics
+        cs = ap_cross_section(chars, self.char_list, nyse=nyse)
+        self.port = cs.bucket(self.char_list, q, nyse=nyse is not None)
+        self.m = month_index(chars['yyyymm'])
+
+        # Rows of the return panel: return in month t+h and market
+        # equity in month t+h-1 for each holding month h
+        permno = chars['permno'].to_numpy(dtype=np.int64)
+        key = (ret['permno'].to_numpy(dtype=np.int64)*100000
+            + month_index(ret['yyyymm']))
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        self.ret = ret['ret'].to_numpy(dtype=float)[order]
+        self.me = ret['me'].to_numpy(dtype=float)[order]
+
+        def lookup(k):
+            i = np.minimum(np.searchsorted(key, k), max(len(key)-1, 0))
+            return np.where((len(key)>0) & (key[i]==k), i, -1)
+
+        self.row = {}
+        for h in self.lags:
+            self.row[h] = (lookup(permno*100000+self.m+h),
+                lookup(permno*100000+self.m+h-1))
+
+        end_time = time.time()
+        print('\n--------- Portfolio assignment ---------')
+        print(f'Characteristics: {len(self.char_list)}')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+
+    def cohort_mean(self, x):
+        n = (~np.isnan(x)).sum(axis=0)
+        return np.where(n>0, np.nansum(x, axis=0)/np.maximum(n, 1), np.nan)
+
+    # Monthly portfolio returns: ew1 to ewq, ew_hl, vw1 to vwq, vw_hl
+    def port_ret(self):
+        start_time = time.time()
+        q = self.q
+        m0 = self.m.min() + min(self.lags)
+        n_month = self.m.max() + max(self.lags) - m0 + 1
+        res = []
+        for c in self.char_list:
+            b = self.port[c].to_numpy()
+            ew = np.zeros((len(self.lags), n_month, q))
+            vw = np.zeros((len(self.lags), n_month, q))
+            for j, h in enumerate(self.lags):
+                ir, iw = self.row[h]
+                r = np.where(ir>=0, self.ret[ir], np.nan)
+                w = np.where(iw>=0, self.me[iw], np.nan)
+                ok = ~np.isnan(b) & ~np.isnan(r)
+                g = (self.m[ok]+h-m0)*q + b[ok].astype(int) - 1
+                n = np.bincount(g, minlength=n_month*q)
+                s = np.bincount(g, r[ok], n_month*q)
+                ew[j] = (s/np.where(n>0, n, np.nan)).reshape(n_month, q)
+                ok &= w > 0
+                g = (self.m[ok]+h-m0)*q + b[ok].astype(int) - 1
+                wsum = np.bincount(g, w[ok], n_month*q)
+                s = np.bincount(g, w[ok]*r[ok], n_month*q)
+                vw[j] = (s/np.where(wsum>0, wsum, np.nan)).reshape(n_month, q)
+
+            # Average of overlapping portfolios
+            ew, vw = self.cohort_mean(ew), self.cohort_mean(vw)
+            mi = m0 + np.arange(n_month)
+            df = pd.DataFrame({'char': c, 'yyyymm': (mi//12)*100 + mi%12 + 1})
+            for k, x in [('ew', ew), ('vw', vw)]:
+                for i in range(q):
+                    df[k+str(i+1)] = x[:, i]
+
+                df[k+'_hl'] = x[:, q-1] - x[:, 0]
+
+            res.append(df.dropna(subset=['ew_hl', 'vw_hl'], how='all'))
+
+        df = pd.concat(res, ignore_index=True)
+
+        end_time = time.time()
+        print('--------- Portfolio returns ---------')
+        print(f'Obs: {len(df)}')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+        return df
+
+    # Average monthly return and t-statistic of each portfolio
+    def summary(self, port=None):
+        port = self.port_ret() if port is None else port
+        cols = [i for i in port.columns if i not in ['char', 'yyyymm']]
+        g = port.groupby('char', sort=False)[cols]
+        mean = g.mean()
+        t = mean / (g.std()/np.sqrt(g.count()))
+        df = mean.stack().to_frame('mean').join(t.stack().to_frame('t'))
+        df['n'] = g.count().stack()
+        df.index.names = ['char', 'port']
+        return df.reset_index()
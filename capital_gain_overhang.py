@@ -5,6 +5,11 @@
 # Equation 9 (page 319)
 # Equation 11 (page 320)
 # Fig 2. note
+#
+# cgo_est(method='recursive') uses R_t = V_t*P_t + (1-V_t)*R_{t-1} over
+# the full history of each stock at daily, weekly or monthly frequency.
+# The default method='window' is the truncated version over 259/260
+# weeks.
 # ------------------------------------------------------------------
 
 import wrds
@@ -13,6 +18,9 @@ import pandas as pd
 import numpy as np
 import time
 import os
+from panel import ap_panel, sort_panel
+from memo import memoize, query, source
+from wrds_fetch import fetch
 
 class ap_cgo:
     def __init__(self):
@@ -23,12 +31,13 @@ class ap_cgo:
         conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
         # Extract CRSP daily data
-        dsf = conn.raw_sql("""
+        dsf, dsf_key = query(conn, """
             select a.permno, a.date, a.prc, a.vol, a.shrout
             from crsp.dsf a left join crsp.msenames b
                 on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
             where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
-        """, date_cols=['date'])
+        """, fetch,
+            date_cols=['date'])
 
         end_time = time.time()
         print('\n--------- Extract data from WRDS ---------')
@@ -43,25 +52,30 @@ class ap_cgo:
         dsf.loc[dsf['shrout']<=0, 'shrout'] = np.nan
         dsf['permno'] = dsf['permno'].astype(int)
         dsf['weekday'] = dsf['date'].dt.weekday
-        self.dsf = dsf.copy()
+        dsf['yyyymm'] = dsf['date'].dt.year*100 + dsf['date'].dt.month
+        dsf = sort_panel(dsf, ['permno', 'yyyymm', 'date'])
+        self.dsf = dsf
+        source(self, dsf=dsf_key)
 
         end_time = time.time()
         print(f'Time used (clean): {(end_time-start_time)/60: 3.1f} seconds\n')
 
-    def cgo_est(self):
-        start_time = time.time()
-        df = self.dsf.copy()
+    # method='recursive': reference price from the full-history recursion
+    # method='window': truncated version over past 259/260 weeks (weekly)
+    @memoize('dsf')
+    def cgo_est(self, method='window', freq='w', min_n=None):
+        if method == 'recursive':
+            return self.cgo_recursive_est(freq, min_n)
+        elif method != 'window':
+            raise ValueError('method should be recursive or window')
+        elif freq != 'w':
+            raise ValueError('window method is only available at weekly freq')
 
-        df = df.sort_values(['permno','date'], ignore_index=True)
-        df['vol_5day'] = df.groupby('permno')['vol'] \
-            .apply(lambda x: pd.Series.rolling(x,window=5).sum())
+        start_time = time.time()
+        df = self.turnover_series('w')
 
-        df = df.query('weekday==4').copy()
-        df['v'] = df['vol_5day'] / df['shrout']
-        df.loc[df['v']>=1, 'v'] = np.nan
         df['diff_1v'] = 1 - df['v']
         df['diff_1v'] = np.log(df['diff_1v'])
-        df = df.sort_values(['permno','date'], ignore_index=True)
         df['vprod'] = (df.groupby('permno')['diff_1v']
             .rolling(window=259, min_periods=129).sum().reset_index(drop=True))
         df['vprod'] = np.exp(df['vprod'])
@@ -69,19 +83,15 @@ class ap_cgo:
         df['k'] = (df.groupby('permno')['v_vprod']
             .rolling(window=259, min_periods=129).sum().reset_index(drop=True))
         df['v_vprod_p'] = df['v_vprod'] * df['prc']
-        df = df.sort_values(['permno','date'], ignore_index=True)
         df['r'] = (df.groupby('permno')['v_vprod_p'] \
             .rolling(window=260, min_periods=130).sum().reset_index(drop=True))
         df['r'] = df['r'] / df['k']
-        df = df.sort_values(['permno', 'date'], ignore_index=True)
         df['l1prc'] = df.groupby('permno')['prc'].shift(1)
 
-        df = df[['permno', 'date', 'r', 'l1prc']].copy()
+        df = df[['permno', 'yyyymm', 'r', 'l1prc']]
         df['cgo'] = (df['l1prc']-df['r']) / df['l1prc']
-        df['yyyymm'] = df['date'].dt.year * 100 + df['date'].dt.month
         df = df.groupby(['permno', 'yyyymm'])['cgo'].mean().reset_index()
-        df = df.query('cgo==cgo').copy()
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        df = df.query('cgo==cgo').reset_index(drop=True)
 
         end_time = time.time()
         print(f'--------- Capital gain overhang ---------')
@@ -89,6 +99,86 @@ class ap_cgo:
         print(f'Time used: {(end_time-start_time)/60: 3.1f} mins')
         return df
 
+    # Turnover (v) and price at daily (d), weekly (w) or monthly (m) freq
+    # Weekly: 5-day volume on Fridays, the same as the window version
+    # Monthly: volume in the month and price on the last trading day
+    def turnover_series(self, freq):
+        df = self.dsf[['permno', 'date', 'yyyymm', 'weekday', 'prc', 'vol',
+            'shrout']]
+        p = ap_panel(df, ['permno', 'yyyymm', 'date'])
+        permno = df['permno'].to_numpy()
+        if freq == 'w':
+            # Rolling 5-day volume from running sums within each stock
+            vol = df['vol'].to_numpy(dtype=float)
+            vol_cs = (pd.Series(np.nan_to_num(vol)).groupby(permno)
+                .cumsum().to_numpy())
+            n_cs = pd.Series(~np.isnan(vol)).groupby(permno).cumsum().to_numpy()
+            ok = p.lag_index(4, ['permno'])[1]
+            lo, prev = p.lag_index(5, ['permno'])
+            n = n_cs - np.where(prev, n_cs[lo], 0)
+            vol = vol_cs - np.where(prev, vol_cs[lo], 0)
+            df['vol'] = np.where(ok & (n==5), vol, np.nan)
+            df = df[df['weekday']==4]
+        elif freq == 'm':
+            vol_m = (df.groupby(['permno', 'yyyymm'])['vol']
+                .sum(min_count=1).to_numpy())
+            df = df[p.last(['permno', 'yyyymm'])]
+            df['vol'] = vol_m
+        elif freq != 'd':
+            raise ValueError('freq should be d, w or m')
+
+        df = df.reset_index(drop=True)
+        df['v'] = df['vol'] / df['shrout']
+        df.loc[df['v']>=1, 'v'] = np.nan
+        return df[['permno', 'date', 'yyyymm', 'prc', 'v']]
+
+    # Reference price: R_t = V_t*P_t + (1-V_t)*R_{t-1}
+    # The recursion is a linear filter along each stock's series. Rows are
+    # visited by their position within the stock, so step k updates the
+    # k-th observation of every stock at once and memory stays at a few
+    # arrays of the panel length. It starts from the first valid price and
+    # carries R_{t-1} forward if turnover or price is missing.
+    def reference_price(self, df):
+        v = df['v'].to_numpy(dtype=float)
+        p = df['prc'].to_numpy(dtype=float)
+        k = ap_panel(df, ['permno']).position(['permno'])
+        order = np.argsort(k, kind='stable')
+        bounds = np.r_[0, np.cumsum(np.bincount(k))]
+        trade = ~(np.isnan(v) | np.isnan(p))
+        r = p.copy()
+        for j in range(1, len(bounds)-1):
+            i = order[bounds[j]:bounds[j+1]]
+            prev = r[i-1]
+            upd = v[i]*p[i] + (1-v[i])*prev
+            r[i] = np.where(np.isnan(prev), p[i],
+                np.where(trade[i], upd, prev))
+
+        return r, k
+
+    # Capital gain overhang from the recursive reference price
+    # Require at least min_n observations (default is about 2.5 years,
+    # the same as min_periods in the window version)
+    def cgo_recursive_est(self, freq='w', min_n=None):
+        start_time = time.time()
+        if min_n is None:
+            min_n = {'d': 630, 'w': 130, 'm': 30}[freq]
+
+        df = self.turnover_series(freq)
+        prc = df['prc'].to_numpy(dtype=float)
+        r, k = self.reference_price(df)
+        r[k+1<min_n] = np.nan
+        l1prc = np.r_[np.nan, prc[:-1]]
+        l1prc[k==0] = np.nan
+        df['cgo'] = (l1prc-r) / l1prc
+        df = df.groupby(['permno', 'yyyymm'])['cgo'].mean().reset_index()
+        df = df.query('cgo==cgo').reset_index(drop=True)
+
+        end_time = time.time()
+        print(f'--------- Capital gain overhang (recursive, {freq}) ---------')
+        print(f'Obs: {len(df)}')
+        print(f'Time used: {(end_time-start_time)/60: 3.1f} mins')
+        return df
+
 if __name__ == '__main__':
     db = ap_cgo()
     cgo = db.cgo_est()
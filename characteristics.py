@@ -0,0 +1,63 @@
+# ------------------------------------------------------------------
+#                       Characteristic panel
+#
+# Combine the files generated by the other scripts into one wide
+# (permno, yyyymm) panel. Every file is sorted by permno and yyyymm,
+# so all of them are aligned by one k-way join instead of a chain of
+# pairwise merges.
+#
+# how='outer': keep a stock-month if any characteristic is available
+# how='inner': keep a stock-month if all files have it
+#
+# gvkey and datadate in sue, sur and accounting are link information
+# and are not kept in the panel
+# ------------------------------------------------------------------
+
+import pandas as pd
+import os
+import time
+from panel import kway_join, sort_panel
+
+class ap_characteristics:
+    def __init__(self, data_dir, file_list=None):
+        start_time = time.time()
+        if file_list is None:
+            file_list = ['preret.txt', 'volume.txt', 'week52_high.txt',
+                'mdr.txt', 'captial_gain_overhang.txt', 'tvol.txt', 'ivol.txt',
+                'skewness.txt', 'sue.txt', 'sur.txt', 'accounting.txt',
+                'analysts.txt']
+
+        self.char_list = []
+        for i in file_list:
+            f = os.path.join(data_dir, i)
+            if not os.path.exists(f):
+                print(f'Not found: {i}')
+                continue
+
+            df = pd.read_csv(f, sep='\t')
+            df = df.drop(columns=['gvkey', 'datadate'], errors='ignore')
+            self.char_list.append(sort_panel(df, ['permno', 'yyyymm']))
+
+        end_time = time.time()
+        print('\n--------- Read characteristics ---------')
+        print(f'Files: {len(self.char_list)}')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+
+    def panel_est(self, how='outer'):
+        start_time = time.time()
+        df = kway_join(self.char_list, how=how)
+
+        end_time = time.time()
+        print(f'--------- Characteristic panel ---------')
+        print(f'Obs: {len(df)}')
+        print(f'Characteristics: {len(df.columns)-2}')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+        return df
+
+if __name__ == '__main__':
+    data_dir = '/Volumes/Seagate/asset_pricing_data'
+    db = ap_characteristics(data_dir)
+    chars = db.panel_est()
+    chars.to_csv(os.path.join(data_dir, 'characteristics.txt'),
+        sep='\t', index=False)
+    print('Done: data is generated')
@@ -0,0 +1,88 @@
+# ------------------------------------------------------------------
+#                       Checkpoint and resume
+#
+# ap_checkpoint saves intermediate frames of a long run as parquet files
+# so that a run which stops half way resumes from the last completed
+# stage instead of extracting and cleaning the data again.
+#
+# Files are written to a temporary file and renamed, so a stage is
+# either complete or missing. Partitioned work (e.g. one file per block
+# of permno) is saved as stage/part, where part is a checksum of the
+# permno list.
+#
+# Checkpoint directory: AP_CHECKPOINT_DIR (default ~/.ap_checkpoint)
+# Checkpoints should be cleared after the output is generated.
+#
+# Example
+# ckpt = ap_checkpoint('ivol', key=(dsf_key, code_version(__name__)))
+# dsf = ckpt.stage('dsf', extract_dsf)  # load if saved, else run and save
+# ckpt.clear()
+# ------------------------------------------------------------------
+
+import pandas as pd
+import numpy as np
+import hashlib
+import os
+import shutil
+
+class ap_checkpoint:
+    def __init__(self, name, root=None, key=None):
+        if root is None:
+            root = os.environ.get('AP_CHECKPOINT_DIR', '~/.ap_checkpoint')
+
+        self.path = os.path.join(os.path.expanduser(root), name)
+        if key is not None:
+            self.open(hashlib.sha1(repr(key).encode()).hexdigest())
+
+    # Remove stages saved under another key and store the key
+    def open(self, key):
+        f = os.path.join(self.path, 'key')
+        old = None
+        if os.path.exists(f):
+            with open(f) as fh:
+                old = fh.read()
+
+        if old == key:
+            return
+
+        if os.path.isdir(self.path):
+            print(f'Checkpoint of other inputs or code is removed: {self.path}')
+            self.clear()
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(f, 'w') as fh:
+            fh.write(key)
+
+    def file(self, stage):
+        return os.path.join(self.path, stage+'.parquet')
+
+    def has(self, stage):
+        return os.path.exists(self.file(stage))
+
+    def load(self, stage):
+        return pd.read_parquet(self.file(stage))
+
+    def save(self, stage, df):
+        f = self.file(stage)
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+        tmp = f'{f}.{os.getpid()}.tmp'
+        df.to_parquet(tmp)
+        os.replace(tmp, f)
+
+    # Load a completed stage or run it and save the result
+    def stage(self, stage, func, *args, **kwargs):
+        if self.has(stage):
+            print(f'Resume from checkpoint: {stage}')
+            return self.load(stage)
+
+        df = func(*args, **kwargs)
+        self.save(stage, df)
+        return df
+
+    # Name of the partition of a list of keys
+    def part_key(self, keys):
+        x = np.sort(np.asarray(keys, dtype=np.int64))
+        return hashlib.sha1(x.tobytes()).hexdigest()[:16]
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,184 @@
+# ------------------------------------------------------------------
+#                   Monthly cross-sectional tools
+#
+# ap_cross_section works on a (permno, yyyymm) panel of characteristics.
+# Each characteristic is sorted once by (yyyymm, value) and all monthly
+# statistics are read from the sorted values in one vectorized pass:
+#
+# winsorize: clip at monthly percentiles
+# rank: monthly percentile rank, the same as rank(pct=True)
+# zscore: (x - monthly mean) / monthly standard deviation
+# breakpoints: monthly percentiles of all stocks or NYSE stocks
+# bucket: portfolio number from monthly breakpoints
+# segment_bucket: custom schemes, e.g. Hou, Xue and Zhang (2020) nsi:
+# negative nsi into 2 portfolios, zero nsi into 1 portfolio and
+# positive nsi into 7 portfolios
+#
+# Percentiles use linear interpolation as pandas quantile. Missing
+# values are kept missing. All methods work on several characteristics
+# at once and return frames in the row order of the input.
+#
+# Example
+# cs = ap_cross_section(chars, ['disp', 'nsi'], nyse='nyse')
+# disp_w = cs.winsorize(['disp'], 0.01, 0.99)
+# nsi_port = cs.segment_bucket('nsi', nsi_scheme, nyse=True)
+# ------------------------------------------------------------------
+
+import pandas as pd
+import numpy as np
+
+# (lower, upper, number of portfolios): lower < x < upper, or x == lower
+# if lower == upper
+nsi_scheme = [(-np.inf, 0, 2), (0, 0, 1), (0, np.inf, 7)]
+
+class ap_cross_section:
+    def __init__(self, df, chars=None, nyse=None):
+        self.df = df
+        if chars is None:
+            chars = [i for i in df.columns if i not in ['permno', 'yyyymm']]
+
+        self.chars = list(chars)
+        self.month, self.gid = np.unique(df['yyyymm'].to_numpy(),
+            return_inverse=True)
+        if isinstance(nyse, str):
+            nyse = df[nyse]
+
+        # Stocks with missing exchange are not NYSE stocks
+        if nyse is not None:
+            nyse = pd.Series(nyse).to_numpy(dtype=float, na_value=np.nan) == 1
+
+        self.nyse = nyse
+        self.order = {}
+
+    # Rows with valid values sorted by (yyyymm, value)
+    def sorted_rows(self, char):
+        if char not in self.order:
+            x = self.df[char].to_numpy(dtype=float)
+            idx = np.flatnonzero(~np.isnan(x))
+            idx = idx[np.lexsort((x[idx], self.gid[idx]))]
+            self.order[char] = idx
+
+        return self.order[char]
+
+    # Monthly percentiles of sorted values, one row per month
+    def quantile(self, x, g, q):
+        q = np.atleast_1d(np.asarray(q, dtype=float))
+        n = np.bincount(g, minlength=len(self.month))
+        start = np.cumsum(n) - n
+        res = np.full((len(self.month), len(q)), np.nan)
+        ok = n > 0
+        pos = q[None, :] * (n[ok, None]-1)
+        lo = np.floor(pos).astype(int)
+        hi = np.ceil(pos).astype(int)
+        s = start[ok, None]
+        res[ok] = x[s+lo] + (pos-lo)*(x[s+hi]-x[s+lo])
+        return res
+
+    def frame(self, res):
+        df = self.df[['permno', 'yyyymm']]
+        for i in res:
+            df[i] = res[i]
+
+        return df
+
+    def winsorize(self, chars=None, lower=0.01, upper=0.99):
+        res = {}
+        for c in chars or self.chars:
+            idx = self.sorted_rows(c)
+            x = self.df[c].to_numpy(dtype=float)
+            bp = self.quantile(x[idx], self.gid[idx], [lower, upper])
+            res[c] = np.clip(x, bp[self.gid, 0], bp[self.gid, 1])
+
+        return self.frame(res)
+
+    # Average rank of ties divided by the number of stocks in the month
+    def rank(self, chars=None):
+        res = {}
+        for c in chars or self.chars:
+            idx = self.sorted_rows(c)
+            x = self.df[c].to_numpy(dtype=float)[idx]
+            g = self.gid[idx]
+            n = np.bincount(g, minlength=len(self.month))
+            pos = np.arange(len(idx)) - (np.cumsum(n)-n)[g]
+            # Ties are (yyyymm, value) runs
+            new = np.r_[True, (g[1:]!=g[:-1]) | (x[1:]!=x[:-1])]
+            start = np.flatnonzero(new)
+            end = np.r_[start[1:]-1, len(idx)-1]
+            avg = (pos[start]+pos[end])/2 + 1
+            r = np.full(len(self.df), np.nan)
+            r[idx] = avg[np.cumsum(new)-1] / n[g]
+            res[c] = r
+
+        return self.frame(res)
+
+    def zscore(self, chars=None):
+        res = {}
+        for c in chars or self.chars:
+            x = self.df[c].to_numpy(dtype=float)
+            ok = ~np.isnan(x)
+            g = self.gid[ok]
+            m = len(self.month)
+            n = np.bincount(g, minlength=m)
+            s1 = np.bincount(g, x[ok], m)
+            mean = s1 / np.where(n>0, n, 1)
+            s2 = np.bincount(g, (x[ok]-mean[g])**2, m)
+            std = np.sqrt(s2 / np.where(n>1, n-1, np.nan))
+            res[c] = (x-mean[self.gid]) / std[self.gid]
+
+        return self.frame(res)
+
+    # Monthly breakpoints: q is the number of portfolios or a list of
+    # percentiles. nyse=True uses NYSE stocks only
+    def breakpoints(self, char, q=10, nyse=False, rows=None):
+        pct = np.arange(1, q)/q if np.isscalar(q) else np.asarray(q)
+        idx = self.sorted_rows(char) if rows is None else rows
+        if nyse:
+            if self.nyse is None:
+                raise ValueError('NYSE indicator is not available')
+
+            idx = idx[self.nyse[idx]]
+
+        x = self.df[char].to_numpy(dtype=float)
+        bp = self.quantile(x[idx], self.gid[idx], pct)
+        df = pd.DataFrame(bp, columns=['bp'+str(i+1) for i in range(len(pct))])
+        df.insert(0, 'yyyymm', self.month)
+        return df
+
+    # Portfolio 1 to q: a stock is in portfolio k+1 if its value is
+    # greater than the k-th breakpoint
+    def bucket_rows(self, char, q, nyse, rows):
+        bp = self.breakpoints(char, q, nyse, rows).to_numpy()[:, 1:]
+        x = self.df[char].to_numpy(dtype=float)[rows]
+        g = self.gid[rows]
+        port = 1 + (x[:, None] > bp[g]).sum(axis=1)
+        port = np.where(np.isnan(bp[g]).all(axis=1) & (bp.shape[1]>0), np.nan,
+            port)
+        return port
+
+    def bucket(self, chars=None, q=10, nyse=False):
+        res = {}
+        for c in chars or self.chars:
+            rows = self.sorted_rows(c)
+            r = np.full(len(self.df), np.nan)
+            r[rows] = self.bucket_rows(c, q, nyse, rows)
+            res[c] = r
+
+        return self.frame(res)
+
+    # Custom scheme: list of (lower, upper, number of portfolios) and
+    # portfolios are numbered across segments
+    def segment_bucket(self, char, scheme, nyse=False):
+        rows = self.sorted_rows(char)
+        x = self.df[char].to_numpy(dtype=float)[rows]
+        r = np.full(len(self.df), np.nan)
+        k = 0
+        for lo, hi, q in scheme:
+            sel = (x==lo) if lo == hi else (x>lo) & (x<hi)
+            if q == 1:
+                r[rows[sel]] = k + 1
+            else:
+                r[rows[sel]] = k + self.bucket_rows(char, q, nyse, rows[sel])
+
+            k += q
+
+        return self.frame({char: r})
@@ -0,0 +1,123 @@
+# ------------------------------------------------------------------
+#                   Monthly CRSP from daily CRSP
+#
+# msf_from_dsf builds a crsp.msf equivalent table from the daily panel
+# in one grouped pass over (permno, yyyymm):
+#
+# ret: compounded daily returns, missing if no daily return
+# prc: absolute price of the last trading day
+# shrout: shares outstanding of the last trading day
+# n_day: number of trading days with return
+#
+# so monthly and daily characteristics come from the same data.
+# msf_reconcile compares it with the official msf.
+#
+# Example
+# msf = msf_from_dsf(dsf)
+# db = ap_preret(dsf)
+# ------------------------------------------------------------------
+
+import wrds
+import configparser as cp
+import pandas as pd
+import numpy as np
+import os
+import time
+from panel import ap_panel, sort_panel
+from wrds_fetch import fetch
+
+def msf_from_dsf(dsf):
+    start_time = time.time()
+    df = dsf.copy(deep=False)
+    df['yyyymm'] = df['date'].dt.year*100 + df['date'].dt.month
+    p = ap_panel(df).sort(['permno', 'yyyymm', 'date'])
+    starts, gid = p.groups(['permno', 'yyyymm'])
+    last = p.last(['permno', 'yyyymm'])
+
+    ret = p['ret'].to_numpy(dtype=float)
+    valid = ret > -1
+    logret = np.log1p(np.where(valid, ret, 0))
+    msf = pd.DataFrame({'permno': p['permno'].to_numpy()[starts],
+        'date': p['date'].to_numpy()[last],
+        'yyyymm': p['yyyymm'].to_numpy()[starts]})
+    msf['ret'] = np.expm1(np.bincount(gid, logret, len(starts)))
+    msf['n_day'] = np.bincount(gid, valid, len(starts)).astype(int)
+    msf.loc[msf['n_day']==0, 'ret'] = np.nan
+    for i in ['prc', 'shrout']:
+        if i in df:
+            msf[i] = p[i].to_numpy(dtype=float)[last]
+
+    if 'prc' in msf:
+        msf['prc'] = msf['prc'].abs()
+
+    end_time = time.time()
+    print(f'--------- Monthly data from daily data ---------')
+    print(f'Obs: {len(msf)}')
+    print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+    return msf
+
+# Compare local and official monthly data on (permno, yyyymm)
+# Return stock-months that are only in one of them or have different values
+def msf_reconcile(msf, msf_crsp, cols=['ret', 'prc', 'shrout'], tol=1e-4):
+    cols = [i for i in cols if i in msf and i in msf_crsp]
+    df = msf[['permno', 'yyyymm']+cols].merge(msf_crsp[['permno', 'yyyymm']+cols],
+        how='outer', on=['permno', 'yyyymm'], suffixes=('', '_crsp'),
+        indicator=True)
+
+    print('--------- Reconcile monthly data ---------')
+    print(f'Matched: {(df["_merge"]=="both").sum()}')
+    print(f'Local only: {(df["_merge"]=="left_only").sum()}')
+    print(f'CRSP only: {(df["_merge"]=="right_only").sum()}')
+    diff = df['_merge'] != 'both'
+    for i in cols:
+        d = (df[i]-df[i+'_crsp']).abs()
+        bad = (d>tol*np.maximum(df[i+'_crsp'].abs(), 1)) | (df[i].isna()
+            != df[i+'_crsp'].isna())
+        bad &= df['_merge'] == 'both'
+        diff |= bad
+        print(f'{i}: {bad.sum()} different, max abs diff {d.max(): .6f}')
+
+    print('')
+    df = df[diff].rename(columns={'_merge': 'source'})
+    return sort_panel(df, ['permno', 'yyyymm'])
+
+if __name__ == '__main__':
+    start_time = time.time()
+    pass_dir = '~/.pass'
+    cfg = cp.ConfigParser()
+    cfg.read(os.path.join(os.path.expanduser(pass_dir), 'credentials.cfg'))
+    conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
+
+    dsf = fetch(conn, """
+        select a.permno, a.date, a.ret, a.prc, a.shrout
+        from crsp.dsf a left join crsp.msenames b
+            on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
+        where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
+    """, date_cols=['date'])
+
+    msf_crsp = conn.raw_sql("""
+        select a.permno, a.date, a.ret, a.prc, a.shrout
+        from crsp.msf a left join crsp.msenames b
+            on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
+        where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
+    """, date_cols=['date'])
+    end_time = time.time()
+    print('\n--------- Extract data from WRDS ---------')
+    print(f'Time used: {(end_time-start_time)/60: 3.1f} mins\n')
+
+    for i in [dsf, msf_crsp]:
+        i['permno'] = i['permno'].astype(int)
+        i.loc[i['ret']<=-1, 'ret'] = np.nan
+
+    dsf = dsf.drop_duplicates(['permno', 'date'], keep='last')
+    msf_crsp['yyyymm'] = msf_crsp['date'].dt.year*100 + msf_crsp['date'].dt.month
+    msf_crsp['prc'] = msf_crsp['prc'].abs()
+    msf_crsp = msf_crsp.drop_duplicates(['permno', 'yyyymm'])
+
+    msf = msf_from_dsf(dsf)
+    diff = msf_reconcile(msf, msf_crsp)
+    data_dir = '/Volumes/Seagate/asset_pricing_data'
+    msf.to_csv(os.path.join(data_dir, 'msf.txt'), sep='\t', index=False)
+    diff.to_csv(os.path.join(data_dir, 'msf_reconcile.txt'), sep='\t',
+        index=False)
+    print('Done: data is generated')
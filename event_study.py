@@ -0,0 +1,259 @@
+# ------------------------------------------------------------------
+#                   Earnings announcement returns
+#
+# Abnormal returns (ar) and cumulative abnormal returns (car) around
+# earnings announcements (rdq of ap_sue.fundq linked to permno). Event
+# day 0 is the first trading day on or after rdq. A window (lo, hi) has
+# the trading days lo to hi, e.g. (-1, 1) or (-2, 60).
+#
+# Returns are kept on a dense trading-day grid of each permno (day
+# index from trading_calendar.py). The terms of the factor regression
+# (1, y, x, xx', xy) are summed cumulatively along the grid, so the sums
+# over any window of an event are the difference of two rows: the
+# estimation window and every event window cost O(1) per event, with no
+# loop over events. Stocks are processed in blocks (rolling.py) to bound
+# memory. gather returns the daily returns of windows (events x days)
+# for abnormal return paths.
+#
+# A car requires abnormal returns on at least min_obs days of the window
+# (default: every trading day of the window), so windows cut by the
+# first or last trading day of a stock, or with missing returns, are
+# missing instead of sums over fewer days.
+#
+# Abnormal return models:
+# market: return minus market return (mktrf+rf)
+# capm, ff3: excess return minus the fitted value of the factor model
+# estimated over days est (default -250 to -31) of each event, at least
+# min_est days
+#
+# abr: car over (-2, 1) with the market model, assigned to the 6 months
+# after the month of day +1 until the next announcement (Hou, Xue and
+# Zhang, 2020; Chan, Jegadeesh and Lakonishok, 1996)
+#
+# Example
+# ev = ap_event(dsf, cal)
+# car = ev.car_est(db.events(), [(-1, 1), (-2, 60)], model='capm')
+# abr = ev.abr_est(db.events())
+# ------------------------------------------------------------------
+
+import wrds
+import configparser as cp
+import pandas as pd
+import numpy as np
+import os
+import time
+from panel import sort_panel
+from trading_calendar import ap_calendar
+from wrds_fetch import fetch
+from backtest import month_index
+from rolling import permno_blocks
+
+models = {'market': [], 'capm': ['mktrf'], 'ff3': ['mktrf', 'smb', 'hml']}
+
+def window_name(lo, hi):
+    sign = lambda x: ('m' if x < 0 else 'p') + str(abs(x))
+    return f'car_{sign(lo)}_{sign(hi)}'
+
+# Regression terms of each day: 1, y, x, xx' (p*p), xy. Days with a
+# missing value are zero
+def terms(y, x):
+    m = ~np.isnan(y) & ~np.isnan(x).any(axis=-1)
+    xx = (x[..., :, None]*x[..., None, :]).reshape(x.shape[:-1]+(-1,))
+    z = np.concatenate([np.ones(y.shape+(1,)), y[..., None], x, xx,
+        x*y[..., None]], axis=-1)
+    return np.where(m[..., None], z, 0)
+
+# OLS of y on x from summed terms: intercept and slopes, missing if fewer
+# than min_est days
+def fit(s, p, min_est):
+    n = s[:, 0]
+    nn = np.maximum(n, 1)[:, None]
+    sy, sx = s[:, 1], s[:, 2:2+p]
+    sxx = s[:, 2+p:2+p+p*p].reshape(-1, p, p)
+    sxy = s[:, 2+p+p*p:]
+    cxx = sxx - sx[:, :, None]*sx[:, None, :]/nn[:, :, None]
+    cxy = sxy - sx*sy[:, None]/nn
+    b = (np.linalg.pinv(cxx) @ cxy[:, :, None])[:, :, 0] if p else sx
+    a = (sy - (b*sx).sum(axis=1)) / nn[:, 0]
+    a[n<min_est] = np.nan
+    b[n<min_est] = np.nan
+    return a, b
+
+class ap_event:
+    # cal: trading calendar with factors (mktrf, rf; smb, hml for ff3)
+    def __init__(self, dsf, cal):
+        self.cal = cal
+        d = cal.day_index(dsf['date'])
+        ret = dsf['ret'].to_numpy(dtype=float)
+        ret = np.where(ret<=-1, np.nan, ret)
+        ok = (d>=0) & ~np.isnan(ret)
+        key = dsf['permno'].to_numpy(dtype=np.int64)[ok]*2**32 + d[ok]
+        order = np.argsort(key, kind='stable')
+        self.key = key[order]
+        self.permno = self.key >> 32
+        self.d = self.key & (2**32-1)
+        self.ret = ret[ok][order]
+
+    # Event day index: first trading day on or after the date, -1 if
+    # after the end of the calendar
+    def event_day(self, dates):
+        x = np.asarray(dates, dtype='datetime64[ns]')
+        d = np.searchsorted(self.cal.date, x)
+        return np.where((d<len(self.cal)) & ~np.isnat(x), d, -1)
+
+    # y and x of the model from returns r on days d (any shape)
+    # market: y is the return minus market return, no x
+    def model_terms(self, r, d, model):
+        rf = self.cal.take('rf', d)
+        if model == 'market':
+            return r - self.cal.take('mktrf', d) - rf, np.zeros(r.shape+(0,))
+
+        x = np.stack([self.cal.take(i, d) for i in models[model]], axis=-1)
+        return r - rf, x
+
+    # Returns and day index of days lo to hi of each event (events x days)
+    def gather(self, permno, d, lo, hi):
+        dd = d[:, None] + np.arange(lo, hi+1)
+        dd = np.where((d[:, None]>=0) & (dd>=0) & (dd<len(self.cal)), dd, -1)
+        key = np.asarray(permno, dtype=np.int64)[:, None]*2**32 + dd
+        i = np.minimum(np.searchsorted(self.key, key), max(len(self.key)-1, 0))
+        found = (dd>=0) & (len(self.key)>0) & (self.key[i]==key)
+        return np.where(found, self.ret[i], np.nan), dd
+
+    # Daily abnormal returns of days lo to hi of each event
+    def abnormal(self, permno, d, lo, hi, model='market', est=(-250, -31),
+        min_est=100):
+        p = len(models[model])
+        y, x = self.model_terms(*self.gather(permno, d, lo, hi), model)
+        if model == 'market':
+            return y
+
+        s = terms(*self.model_terms(*self.gather(permno, d, *est), model))
+        a, b = fit(s.sum(axis=1), p, min_est)
+        return y - (a[:, None] + np.einsum('eti,ei->et', x, b))
+
+    # Cumulative sums of the terms on the trading-day grid of rows b to e
+    # (whole stocks): permno, first day, offset and length of each stock
+    def grid(self, b, e, model):
+        permno, d = self.permno[b:e], self.d[b:e]
+        new = np.flatnonzero(np.r_[True, permno[1:]!=permno[:-1]])
+        g = np.cumsum(np.r_[True, permno[1:]!=permno[:-1]]) - 1
+        first = d[new]
+        length = np.r_[d[new[1:]-1], d[-1:]] - first + 1
+        offset = np.cumsum(length) - length
+        z = terms(*self.model_terms(self.ret[b:e], d, model))
+        dense = np.zeros((length.sum()+1, z.shape[1]))
+        dense[offset[g]+d-first[g]+1] = z
+        return permno[new], first, offset, length, np.cumsum(dense, axis=0)
+
+    # Sums of the terms over days lo to hi of each event
+    def window_terms(self, grid, permno, d, lo, hi):
+        uniq, first, offset, length, cs = grid
+        g = np.minimum(np.searchsorted(uniq, permno), len(uniq)-1)
+        a = np.clip(d+lo-first[g], 0, length[g])
+        b = np.clip(d+hi-first[g]+1, 0, length[g])
+        ok = (d>=0) & (uniq[g]==permno)
+        s = cs[offset[g]+b] - cs[offset[g]+a]
+        return np.where(ok[:, None], s, 0)
+
+    # car and number of days with abnormal returns (n_) of each window
+    # events: permno, rdq (and any other columns, which are kept)
+    # min_obs: days with abnormal returns required in each window, None
+    # for all days of the window
+    def car_est(self, events, windows=[(-1, 1)], model='market',
+        est=(-250, -31), min_est=100, min_obs=None):
+        start_time = time.time()
+        df = events.copy(deep=False)
+        permno = df['permno'].to_numpy(dtype=np.int64)
+        d = self.event_day(df['rdq'])
+        df['event_date'] = pd.NaT
+        df.loc[d>=0, 'event_date'] = self.cal.date[d[d>=0]]
+        p = len(models[model])
+        res = {}
+        for name in [window_name(*i) for i in windows]:
+            res[name] = np.full(len(df), np.nan)
+            res['n_'+name] = np.zeros(len(df), dtype=int)
+
+        # Events of the stocks of each block
+        order = np.argsort(permno, kind='stable')
+        sorted_permno = permno[order]
+        for b, e in permno_blocks(self.permno):
+            i = order[np.searchsorted(sorted_permno, self.permno[b]):
+                np.searchsorted(sorted_permno, self.permno[e-1], side='right')]
+            if len(i) == 0:
+                continue
+
+            grid = self.grid(b, e, model)
+            if model == 'market':
+                a, coef = np.zeros(len(i)), np.zeros((len(i), 0))
+            else:
+                a, coef = fit(self.window_terms(grid, permno[i], d[i], *est),
+                    p, min_est)
+
+            for lo, hi in windows:
+                s = self.window_terms(grid, permno[i], d[i], lo, hi)
+                n = np.where(np.isnan(a), 0, s[:, 0])
+                car = s[:, 1] - n*a - (coef*s[:, 2:2+p]).sum(axis=1)
+                name = window_name(lo, hi)
+                need = hi-lo+1 if min_obs is None else max(min_obs, 1)
+                res[name][i] = np.where(n>=need, car, np.nan)
+                res['n_'+name][i] = n
+
+        for i in res:
+            df[i] = res[i]
+
+        end_time = time.time()
+        print(f'--------- Event windows: {model} ---------')
+        print(f'Events: {len(df)}')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+        return df
+
+    # Monthly abr: the most recent announcement within the past months
+    def abr_est(self, events, months=6, min_obs=None):
+        df = self.car_est(events, [(-2, 1)], 'market', min_obs=min_obs)
+        df = df[df['car_m2_p1'].notna()]
+        # Information is complete at the end of day +1
+        d1 = self.event_day(df['rdq']) + 1
+        ok = d1 < len(self.cal)
+        df = df[ok]
+        m0 = month_index(self.cal.yyyymm[d1[ok]]) + 1
+        df = df.loc[df.index.repeat(months)]
+        m = np.repeat(m0, months) + np.tile(np.arange(months), len(m0))
+        df['yyyymm'] = (m//12)*100 + m%12 + 1
+        df = sort_panel(df, ['permno', 'yyyymm', 'rdq'])
+        df = df.drop_duplicates(['permno', 'yyyymm'], keep='last')
+        df = df.rename(columns={'car_m2_p1': 'abr'})
+        return df[['permno', 'yyyymm', 'abr']].reset_index(drop=True)
+
+if __name__ == '__main__':
+    from sue import ap_sue
+    db = ap_sue()
+    events = db.events()
+
+    pass_dir = '~/.pass'
+    cfg = cp.ConfigParser()
+    cfg.read(os.path.join(os.path.expanduser(pass_dir), 'credentials.cfg'))
+    conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
+    dsf = fetch(conn, """
+        select a.permno, a.date, a.ret
+        from crsp.dsf a left join crsp.msenames b
+            on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
+        where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
+    """, date_cols=['date'])
+    dsf = dsf.drop_duplicates(['permno', 'date'], keep='last')
+    ff3 = conn.raw_sql("""
+        select date, mktrf, smb, hml, rf
+        from ff.factors_daily
+        order by date
+    """, date_cols=['date'])
+    cal = ap_calendar(ff3['date'])
+    cal.add(ff3, ['mktrf', 'smb', 'hml', 'rf'])
+
+    ev = ap_event(dsf, cal)
+    car = ev.car_est(events, [(-1, 1), (-2, 60)], model='capm')
+    abr = ev.abr_est(events)
+    data_dir = '/Volumes/Seagate/asset_pricing_data'
+    car.to_csv(os.path.join(data_dir, 'earnings_car.txt'), sep='\t',
+        index=False)
+    abr.to_csv(os.path.join(data_dir, 'abr.txt'), sep='\t', index=False)
+    print('Done: data is generated')
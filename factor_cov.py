@@ -0,0 +1,116 @@
+# ------------------------------------------------------------------
+#                   Factor model covariance matrix
+#
+# Covariance of daily stock returns in month t from the monthly factor
+# regressions of ap_ivol (loading_est):
+#
+# V = B F B' + diag(d)
+#
+# B: factor loadings (b1, b2, ...) of the stocks in month t
+# F: covariance of daily factor returns over the past window months
+# (t-window+1 to t)
+# d: residual variance (sigma^2) of the stocks in month t
+#
+# V is kept in this low-rank form (N x k, k x k and N) and never as a
+# dense N x N matrix: portfolio variance and V @ w cost O(N k).
+#
+# shrink (0 to 1) shrinks loadings and residual variances towards their
+# cross-sectional means in each month (Vasicek, 1973)
+#
+# Example
+# db = ap_ivol()
+# db.ivol_est('ff3', 'ivol_ff3')
+# fc = ap_factor_cov(db.coef['ff3'], db.ff3, ['mktrf', 'smb', 'hml'])
+# v = fc.month(202012)
+# v.port_var(w)    # w: weights of v.permno or a Series indexed by permno
+# ------------------------------------------------------------------
+
+import pandas as pd
+import numpy as np
+
+class ap_cov_month:
+    def __init__(self, permno, B, F, d):
+        self.permno = permno
+        self.B = B
+        self.F = F
+        self.d = d
+
+    def __len__(self):
+        return len(self.permno)
+
+    # Weights in the order of self.permno. A Series indexed by permno is
+    # aligned and stocks that are not in the model get zero weight
+    def weight(self, w):
+        if isinstance(w, pd.Series):
+            w = w.groupby(level=0).sum().reindex(self.permno, fill_value=0)
+
+        return np.asarray(w, dtype=float)
+
+    def matvec(self, w):
+        w = self.weight(w)
+        return self.B @ (self.F @ (self.B.T @ w)) + self.d*w
+
+    # Variance of one portfolio (w is N) or several portfolios (N x p)
+    def port_var(self, w):
+        w = self.weight(w)
+        f = self.B.T @ w
+        if w.ndim == 1:
+            return f @ self.F @ f + (self.d*w) @ w
+
+        return (np.einsum('kp,kl,lp->p', f, self.F, f)
+            + np.einsum('n,np->p', self.d, w*w))
+
+    def dense(self):
+        return self.B @ self.F @ self.B.T + np.diag(self.d)
+
+class ap_factor_cov:
+    def __init__(self, loadings, factors, factor_list, window=1, shrink=0):
+        self.factor_list = list(factor_list)
+        self.b_list = ['b'+str(i+1) for i in range(len(self.factor_list))]
+        self.shrink = shrink
+        self.loadings = loadings[['permno', 'yyyymm']+self.b_list+['sigma']]
+        self.loadings = self.loadings.dropna().sort_values(['yyyymm', 'permno'],
+            ignore_index=True)
+        ym = self.loadings['yyyymm'].to_numpy()
+        self.months = np.unique(ym)
+        bounds = np.searchsorted(ym, self.months)
+        self.bounds = dict(zip(self.months, zip(bounds,
+            np.r_[bounds[1:], len(ym)])))
+
+        # Monthly sums of factor returns and their cross-products, then
+        # window sums by differencing running sums
+        f = factors.dropna(subset=self.factor_list)
+        x = f[self.factor_list].to_numpy(dtype=float)
+        fm = (f['date'].dt.year*100 + f['date'].dt.month).to_numpy()
+        fmonth, g = np.unique(fm, return_inverse=True)
+        k, M = x.shape[1], len(fmonth)
+        n = np.bincount(g, minlength=M)
+        s1 = np.column_stack([np.bincount(g, x[:, i], M) for i in range(k)])
+        s2 = np.empty((M, k, k))
+        for i in range(k):
+            for j in range(i, k):
+                s2[:, i, j] = s2[:, j, i] = np.bincount(g, x[:, i]*x[:, j], M)
+
+        c = [np.concatenate([np.zeros((1,)+i.shape[1:]), np.cumsum(i, axis=0)])
+            for i in [n, s1, s2]]
+        lo = np.maximum(np.arange(M)-window+1, 0)
+        hi = np.arange(M) + 1
+        n, s1, s2 = [i[hi]-i[lo] for i in c]
+        mean = s1 / n[:, None]
+        F = (s2 - n[:, None, None]*mean[:, :, None]*mean[:, None, :])
+        F = F / np.where(n>1, n-1, np.nan)[:, None, None]
+        self.F = dict(zip(fmonth, F))
+
+    def month(self, yyyymm):
+        if yyyymm not in self.bounds or yyyymm not in self.F:
+            raise ValueError(f'no loadings or factor returns in {yyyymm}')
+
+        lo, hi = self.bounds[yyyymm]
+        df = self.loadings.iloc[lo:hi]
+        B = df[self.b_list].to_numpy(dtype=float)
+        d = df['sigma'].to_numpy(dtype=float)**2
+        if self.shrink > 0:
+            B = (1-self.shrink)*B + self.shrink*B.mean(axis=0)
+            d = (1-self.shrink)*d + self.shrink*d.mean()
+
+        return ap_cov_month(df['permno'].to_numpy(), B, self.F[yyyymm], d)
@@ -0,0 +1,140 @@
+# ------------------------------------------------------------------
+#                       Fama-MacBeth regressions
+#
+# ap_fama_macbeth runs monthly cross-sectional regressions of next-month
+# returns on characteristics of month t for many specifications:
+#
+# 1. Cross-products X'X and X'y of every month are built by segmented
+#    sums (np.bincount by month) over the stock-months where the return
+#    and all regressors of the specification are available
+# 2. All monthly regressions are solved in one batched pinv. Months where
+#    the regressors are collinear (e.g. a characteristic that is constant
+#    in the month) have no unique coefficients and are dropped; the
+#    number of dropped months is printed
+# 3. Coefficients are averaged over months with Newey-West (1987)
+#    standard errors
+#
+# Newey-West lag: nw_lag, default is floor(4*(T/100)^(2/9))
+#
+# chars: permno, yyyymm, characteristics of month yyyymm
+# ret: permno, yyyymm, ret (return in month yyyymm)
+#
+# Example
+# fm = ap_fama_macbeth(chars, ret)
+# table = fm.fit({'m1': ['mdr1'], 'm2': ['mdr1', 'ivol_ff3', 'sue']})
+# ------------------------------------------------------------------
+
+import pandas as pd
+import numpy as np
+import time
+from backtest import month_index
+
+class ap_fama_macbeth:
+    def __init__(self, chars, ret, nw_lag=None):
+        self.chars = chars
+        self.nw_lag = nw_lag
+        self.month, self.gid = np.unique(chars['yyyymm'].to_numpy(),
+            return_inverse=True)
+
+        # Return in month t+1 of each stock-month
+        key = (ret['permno'].to_numpy(dtype=np.int64)*100000
+            + month_index(ret['yyyymm']))
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        k = (chars['permno'].to_numpy(dtype=np.int64)*100000
+            + month_index(chars['yyyymm']) + 1)
+        i = np.minimum(np.searchsorted(key, k), max(len(key)-1, 0))
+        found = (len(key)>0) & (key[i]==k)
+        self.y = np.where(found, ret['ret'].to_numpy(dtype=float)[order][i],
+            np.nan)
+        self.coef = {}
+
+    # Monthly coefficients of one specification
+    def monthly(self, x_var):
+        X = np.column_stack([np.ones(len(self.chars))]
+            + [self.chars[i].to_numpy(dtype=float) for i in x_var])
+        ok = ~np.isnan(self.y) & ~np.isnan(X).any(axis=1)
+        X, y, g = X[ok], self.y[ok], self.gid[ok]
+        T, k = len(self.month), X.shape[1]
+
+        n = np.bincount(g, minlength=T)
+        xx = np.empty((T, k, k))
+        for a in range(k):
+            for b in range(a, k):
+                xx[:, a, b] = xx[:, b, a] = np.bincount(g, X[:, a]*X[:, b], T)
+
+        xy = np.column_stack([np.bincount(g, X[:, a]*y, T) for a in range(k)])
+        yy = np.bincount(g, y*y, T)
+        ys = np.bincount(g, y, T)
+        # Regressors that are constant in a month (variance within the
+        # rounding error of the mean square) or collinear (singular
+        # correlation matrix) have no unique coefficients
+        full = np.ones(T, dtype=bool)
+        if k > 1:
+            eps = np.finfo(float).eps
+            sx = xx[:, 0, 1:]
+            c = (xx[:, 1:, 1:]
+                - sx[:, :, None]*sx[:, None, :]/np.maximum(n, 1)[:, None, None])
+            v = np.einsum('tii->ti', c)
+            const = v <= 8*n[:, None]*eps*np.einsum('tii->ti', xx[:, 1:, 1:])
+            sd = np.sqrt(np.where(const, 1, v))
+            r = c / sd[:, :, None] / sd[:, None, :]
+            full = ~const.any(axis=1) & (np.linalg.eigvalsh(r)[:, 0]
+                > k*np.sqrt(eps))
+
+        b = (np.linalg.pinv(xx) @ xy[:, :, None])[:, :, 0]
+        sse = yy - 2*(b*xy).sum(axis=1) + np.einsum('ti,tij,tj->t', b, xx, b)
+        sst = yy - ys**2/np.where(n>0, n, 1)
+        # Require more stocks than regressors and full rank
+        valid = n > k
+        if (valid & ~full).any():
+            print(f'Months dropped (collinear {list(x_var)}): '
+                f'{(valid & ~full).sum()}')
+
+        valid &= full
+        df = pd.DataFrame(b, columns=['const']+list(x_var))
+        df.insert(0, 'yyyymm', self.month)
+        df['r2'] = 1 - sse/np.where(sst>0, sst, np.nan)
+        df['n'] = n
+        return df[valid].reset_index(drop=True)
+
+    # Time-series mean and Newey-West standard error
+    def nw_mean(self, x):
+        x = x[~np.isnan(x)]
+        T = len(x)
+        if T < 2:
+            return np.nan, np.nan
+
+        lag = (int(np.floor(4*(T/100)**(2/9))) if self.nw_lag is None
+            else self.nw_lag)
+        e = x - x.mean()
+        v = e @ e / T
+        for l in range(1, min(lag, T-1)+1):
+            v += 2 * (1-l/(lag+1)) * (e[l:] @ e[:-l]) / T
+
+        return x.mean(), np.sqrt(v/T)
+
+    def fit(self, specs):
+        start_time = time.time()
+        if not isinstance(specs, dict):
+            specs = {'m'+str(i+1): j for i, j in enumerate(specs)}
+
+        res = []
+        for name, x_var in specs.items():
+            df = self.monthly(x_var)
+            self.coef[name] = df
+            for i in ['const']+list(x_var):
+                m, se = self.nw_mean(df[i].to_numpy())
+                res.append([name, i, m, se, m/se, len(df)])
+
+            res.append([name, 'r2', df['r2'].mean(), np.nan, np.nan, len(df)])
+            res.append([name, 'n', df['n'].mean(), np.nan, np.nan, len(df)])
+
+        df = pd.DataFrame(res, columns=['spec', 'var', 'coef', 'se', 't',
+            'n_month'])
+
+        end_time = time.time()
+        print('--------- Fama-MacBeth regressions ---------')
+        print(f'Specifications: {len(specs)}')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+        return df
@@ -18,6 +18,11 @@
 # regression (8) on daily data over an L-month period from month
 # t−L−M to month t−M."
 # "We use a 1/0/1 strategy in both cases."
+#
+# ivol_rolling_est: the regression over the past 21, 63 and 252 trading
+# days of each stock-day (ivol_ff3_21d, ...), at least 15, 45 and 180
+# days. Regressions are solved from window sums of cross-products
+# (see rolling.py)
 # ----------------------------------------------------------------
 
 import wrds
@@ -26,118 +31,174 @@ import pandas as pd
 import numpy as np
 from joblib import Parallel, delayed, parallel_backend
 import multiprocessing as mp
-import itertools
 import time
 import os
+from panel import sort_panel, kway_join
+from trading_calendar import ap_calendar
+from rolling import min_days, permno_blocks, window_start, window_moments
+from memo import memoize, query, query_key, source, code_version
+from checkpoint import ap_checkpoint
+from wrds_fetch import fetch
 
 class ap_ivol:
-    def __init__(self):
+    # save_data: also checkpoint the cleaned daily data (about 70 million
+    # rows). The extracted data is in the query cache (memo.py) anyway
+    def __init__(self, save_data=False):
         start_time = time.time()
+        # Factor loadings and residual std of each model (see loading_est)
+        self.coef = {}
         pass_dir = '~/.pass'
         cfg = cp.ConfigParser()
         cfg.read(os.path.join(os.path.expanduser(pass_dir), 'credentials.cfg'))
         conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
-        # Extract CRSP daily data
-        dsf = conn.raw_sql("""
+        dsf_sql = """
             select a.permno, a.date, a.ret
             from crsp.dsf a left join crsp.msenames b
                 on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
             where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
-        """, date_cols=['date'])
+        """
+        # Data is available from 1926-07-01
+        ff3_sql = """
+            select date, mktrf, smb, hml, rf
+            from ff.factors_daily
+            order by date
+        """
+
+        # Checkpoints are keyed on the source tables and the code, so a
+        # run resumes only from stages of the same inputs. If the catalog
+        # cannot be read, nothing is resumed
+        dsf_key, ff3_key = query_key(conn, dsf_sql), query_key(conn, ff3_sql)
+        key = (dsf_key, ff3_key, code_version(__name__))
+        if dsf_key is None or ff3_key is None:
+            key += (os.getpid(), time.time())
 
+        self.ckpt = ap_checkpoint('ivol', key=key)
+        # Resume from the cleaned data if a previous run stopped
+        if save_data and self.ckpt.has('dsf') and self.ckpt.has('ff3'):
+            self.ff3 = self.ckpt.load('ff3')
+            self.dsf = self.ckpt.load('dsf')
+            self.cal = ap_calendar(self.ff3['date'])
+            self.cal.add(self.ff3, ['mktrf', 'smb', 'hml', 'rf'])
+            source(self, dsf=(dsf_key, ff3_key), ff3=ff3_key)
+            end_time = time.time()
+            print('\n--------- Resume from checkpoint ---------')
+            print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+            return
+
+        # Extract CRSP daily data
+        dsf, dsf_key = query(conn, dsf_sql, fetch, date_cols=['date'])
         dsf = dsf.drop_duplicates(['permno', 'date'], keep='last')
         dsf.loc[dsf['ret']<=-1, 'ret'] = np.nan
         dsf['permno'] = dsf['permno'].astype(int)
 
         # Extract factor data
-        # Data is available from 1926-07-01
-        ff3 = conn.raw_sql("""
-            select date, mktrf, smb, hml, rf
-            from ff.factors_daily
-            order by date
-        """, date_cols=['date'])
+        ff3, ff3_key = query(conn, ff3_sql, date_cols=['date'])
 
-        self.dsf = dsf.copy()
-        self.ff3 = ff3.copy()
+        # Trading-day index of each daily row: factors are attached by
+        # take instead of merging on date. Days without factors are -1
+        # and are dropped in the estimation as in the left merge
+        self.cal = ap_calendar(ff3['date'])
+        self.cal.add(ff3, ['mktrf', 'smb', 'hml', 'rf'])
+        dsf['d'] = self.cal.day_index(dsf['date'])
+        self.dsf = dsf
+        self.ff3 = ff3
+        source(self, dsf=(dsf_key, ff3_key), ff3=ff3_key)
+        if save_data:
+            self.ckpt.save('ff3', ff3)
+            self.ckpt.save('dsf', dsf)
 
         end_time = time.time()
         print('\n--------- Extract data from WRDS ---------')
         print(f'Time used: {(end_time-start_time)/60: 3.1f} mins\n')
 
     def ols_b(self, data, x_var, y_var):
-        x = data[x_var].copy()
+        x = data[x_var]
         x.loc[:, 'a'] = 1
         x = x.to_numpy()
         y = data[y_var].to_numpy()
         b = np.linalg.inv(x.T@x) @ x.T @ y
         return b
 
-    def groupby_ols(self, data, x_var, i, l_res):
-        df = data.query('permno==list(@i)').copy()
+    # Coefficients of one block of permno: a, b1, b2, ...
+    # Each block is saved when it is done, so a restarted run only
+    # estimates the blocks that are missing
+    def groupby_ols(self, data, x_var, i, stage):
+        part = f'{stage}/{self.ckpt.part_key(i)}'
+        if self.ckpt.has(part):
+            return self.ckpt.load(part)
+
+        df = data[data['permno'].isin(i)]
         df = (df.groupby(['permno', 'yyyymm'])
-            .apply(self.ols_b, x_var=x_var, y_var='retx').reset_index())
-        df = tuple(df.itertuples(index=False, name=None))
-        l_res.append(df)
+            .apply(self.ols_b, x_var=x_var, y_var='retx'))
+        est = np.vstack(df.to_list()) if len(df) else np.empty((0, len(x_var)+1))
+        b = df.index.to_frame(index=False)
+        b['a'] = est[:, -1]
+        for j in range(len(x_var)):
+            b['b'+str(j+1)] = est[:, j]
 
-    def ivol_est(self, model, outvar):
+        self.ckpt.save(part, b)
+        return b
+
+    # Monthly regression of each stock-month: permno, yyyymm, a, b1, ...,
+    # sigma (residual std)
+    @memoize('dsf', 'ff3')
+    def loading_est(self, model):
         start_time = time.time()
-        df = self.dsf.copy()
+        df = self.dsf.query('d>=0')
 
         if model == 'capm':
             factors = ['mktrf']
-            df = df.merge(self.ff3, how='left', on='date')
         elif model == 'ff3':
             factors = ['mktrf', 'smb', 'hml']
-            df = df.merge(self.ff3, how='left', on='date')
+
+        d = df['d'].to_numpy()
+        for i in factors + ['rf']:
+            df[i] = self.cal.take(i, d)
 
         df['retx'] = df['ret'] - df['rf']
-        df['yyyymm'] = df['date'].dt.year*100 + df['date'].dt.month
+        df['yyyymm'] = self.cal.yyyymm[d]
         # Require at least 15 days in a month
         # Require standard deviation is greater than 0 to make sure the daily
         # returns in a month are not the same
         df = df.dropna()
         df['n'] = df.groupby(['permno', 'yyyymm'])['retx'].transform('count')
         df['std'] = df.groupby(['permno', 'yyyymm'])['retx'].transform('std')
-        df = df.query('n>=15 & std>0').copy()
-        df = df.drop(columns=['ret', 'rf', 'n', 'std'])
-        df = df.sort_values(['permno', 'date'], ignore_index=True)
+        df = df.query('n>=15 & std>0')
+        df = df.drop(columns=['ret', 'rf', 'n', 'std', 'd'])
+        df = sort_panel(df, ['permno', 'date'])
 
         # Python is slow when running large number of regressions by group
         # Parallel to speed up
         # TODO: pure numpy should be faster than pandas
         permno_list = df['permno'].unique()
         permno_split = np.array_split(permno_list, 7)
-        manager = mp.Manager()
-        l_res = manager.list()
-        with parallel_backend('loky', n_jobs=mp.cpu_count()-1):
-            Parallel()(delayed(self.groupby_ols)(df, factors, i, l_res)
-                for i in permno_split)
-
-        # Flatten list and generate dataframe to improve performance
-        # This is faster than appending dataframes
-        l_res = list(itertools.chain.from_iterable(list(l_res)))
-        b = pd.DataFrame(l_res)
-        b.columns = ['permno', 'yyyymm', 'est']
+        stage = 'coef_' + model
+        if self.ckpt.has(stage):
+            b = self.ckpt.load(stage)
+        else:
+            # Workers return coefficient frames of their blocks
+            with parallel_backend('loky', n_jobs=mp.cpu_count()-1):
+                l_res = Parallel()(delayed(self.groupby_ols)(df, factors, i, stage)
+                    for i in permno_split)
+
+            b = pd.concat(l_res, ignore_index=True)
+            self.ckpt.save(stage, b)
+
         res_df = df.merge(b, how='inner', on=['permno', 'yyyymm'])
-        res_df = res_df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        res_df = sort_panel(res_df, ['permno', 'yyyymm'])
 
         if model == 'capm':
-            for i, j in zip(['a', 'b1'], [1, 0]):
-                res_df[i] = res_df['est'].apply(lambda x: x[j])
-
             res_df['p'] = res_df['a'] + res_df['b1']*res_df['mktrf']
         elif model == 'ff3':
-            for i, j in zip(['a', 'b1', 'b2', 'b3'], [3, 0, 1, 2]):
-                res_df[i] = res_df['est'].apply(lambda x: x[j])
-
             res_df['p'] = (res_df['a'] + res_df['b1']*res_df['mktrf']
                 + res_df['b2']*res_df['smb'] + res_df['b3']*res_df['hml'])
 
         res_df['resid'] = res_df['retx'] - res_df['p']
         res_df = (res_df.groupby(['permno', 'yyyymm'])['resid']
-            .std().to_frame(outvar).reset_index())
-        res_df = res_df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+            .std().to_frame('sigma').reset_index())
+        res_df = sort_panel(b, ['permno', 'yyyymm']).merge(res_df, how='inner',
+            on=['permno', 'yyyymm'])
 
         end_time = time.time()
         print(f'--------- IVOL estimation: {model} ---------')
@@ -146,12 +207,60 @@ class ap_ivol:
         print(f'number of regressions: {len(res_df)}\n')
         return res_df
 
+    # Loadings are kept in self.coef for the factor covariance model
+    def ivol_est(self, model, outvar):
+        self.coef[model] = self.loading_est(model)
+        df = self.coef[model][['permno', 'yyyymm', 'sigma']]
+        return df.rename(columns={'sigma': outvar})
+
+    @memoize('dsf', 'ff3')
+    def ivol_rolling_est(self, model, windows=(21, 63, 252)):
+        start_time = time.time()
+        factors = {'capm': ['mktrf'], 'ff3': ['mktrf', 'smb', 'hml']}[model]
+        df = self.dsf.query('d>=0')
+        d = df['d'].to_numpy()
+        for i in factors:
+            df[i] = self.cal.take(i, d)
+
+        df['retx'] = df['ret'] - self.cal.take('rf', d)
+        df = df.dropna(subset=['retx']+factors)
+        df = sort_panel(df, ['permno', 'd'])
+        permno = df['permno'].to_numpy()
+        d = df['d'].to_numpy()
+        z = df[['retx']+factors].to_numpy(dtype=float)
+
+        res = {f'ivol_{model}_{w}d': np.full(len(df), np.nan) for w in windows}
+        for b, e in permno_blocks(permno):
+            for w in windows:
+                start = window_start(permno[b:e], d[b:e], w)
+                n, c2 = window_moments(z[b:e], permno[b:e], start)
+                # Require standard deviation of excess returns is greater
+                # than 0 as in the monthly regressions
+                ok = np.flatnonzero((n>=min_days(w)) & (c2[:, 0, 0]>0))
+                cxy = c2[ok, 1:, 0]
+                coef = np.linalg.pinv(c2[ok, 1:, 1:]) @ cxy[:, :, None]
+                coef = coef[:, :, 0]
+                sse = np.maximum(c2[ok, 0, 0] - (cxy*coef).sum(axis=1), 0)
+                res[f'ivol_{model}_{w}d'][b+ok] = np.sqrt(sse/(n[ok]-1))
+
+        df = df[['permno', 'date']]
+        for i in res:
+            df[i] = res[i]
+
+        df = df.dropna(subset=list(res), how='all').reset_index(drop=True)
+
+        end_time = time.time()
+        print(f'--------- Rolling IVOL estimation: {model} ---------')
+        print(f'Obs: {len(df)}')
+        print(f'Time used: {(end_time-start_time)/60: 3.1f} mins\n')
+        return df
+
 if __name__ == '__main__':
     db = ap_ivol()
     ivol_capm = db.ivol_est('capm', 'ivol_capm')
     ivol_ff3 = db.ivol_est('ff3', 'ivol_ff3')
-    ivol = ivol_capm.merge(ivol_ff3, how='left', on=['permno', 'yyyymm'])
-    ivol = ivol.sort_values(['permno', 'yyyymm'], ignore_index=True)
+    ivol = kway_join([ivol_capm, ivol_ff3], how='left')
     data_dir = '/Volumes/Seagate/asset_pricing_data'
     ivol.to_csv(os.path.join(data_dir, 'ivol.txt'), sep='\t', index=False)
+    db.ckpt.clear()
     print('Done: data is generated')
@@ -13,6 +13,11 @@
 #
 # For example, mdr1 is the maximum return in a month. And mdr2 is
 # the average of top 2 daily returns in a month.
+#
+# maxret_rolling_est: mdr1 to mdrk over the past 21, 63 and 252 trading
+# days of each stock-day (mdr1_21d, ...), at least 15, 45 and 180 daily
+# returns (see rolling.py). Trading days are the days of the CRSP daily
+# index file (crsp.dsi)
 # ------------------------------------------------------------------
 
 import wrds
@@ -21,6 +26,13 @@ import pandas as pd
 import numpy as np
 import os
 import time
+from panel import ap_panel, sort_panel
+from trading_calendar import ap_calendar
+from rolling import min_days, permno_blocks, window_start
+from rolling import window_topk, topk_mean
+from memo import memoize, query, source
+from wrds_fetch import fetch
+import polars_backend
 
 class ap_maxret:
     def __init__(self):
@@ -31,11 +43,20 @@ class ap_maxret:
         conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
         # Extract CRSP daily data
-        dsf = conn.raw_sql("""
+        dsf, dsf_key = query(conn, """
             select a.permno, a.date, a.ret
             from crsp.dsf a left join crsp.msenames b
                 on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
             where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
+        """, fetch,
+            date_cols=['date'])
+
+        # All CRSP trading days: rolling windows are counted on this
+        # calendar, not on the dates of the extracted stocks
+        dsi, dsi_key = query(conn, """
+            select date
+            from crsp.dsi
+            order by date
         """, date_cols=['date'])
 
         dsf = dsf.drop_duplicates(['permno', 'date'], keep='last')
@@ -46,43 +67,113 @@ class ap_maxret:
         print('\n--------- Extract data from WRDS ---------')
         print(f'Time used: {(end_time-start_time)/60: 3.1f} mins\n')
 
-        # Rank returns to find top 5 returns in a month
         start_time = time.time()
         dsf['yyyymm'] = dsf['date'].dt.year*100 + dsf['date'].dt.month
-        # Require at least 15 days in a month
         dsf = dsf.dropna()
-        dsf['n_day'] = (dsf.groupby(['permno', 'yyyymm'])
-            ['ret'].transform('count'))
-        dsf = dsf.query('n_day>=15').copy()
-        del dsf['n_day']
-        dsf['rank'] = (dsf.groupby(['permno', 'yyyymm'])['ret']
-            .rank(method='min', ascending=False))
-        self.dsf = dsf.copy()
+        # Daily returns of each stock-month are contiguous
+        dsf = sort_panel(dsf, ['permno', 'yyyymm', 'date'])
+        self.dsf = dsf
+        self.dsi = dsi
+        source(self, dsf=dsf_key, dsi=dsi_key)
 
         end_time = time.time()
-        print(f'--------- Rank returns ---------')
+        print(f'--------- Sort returns ---------')
         print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
 
+    # mdr1 to mdrk in one pass
+    # Returns of each stock-month are laid out as one row of a matrix and
+    # the top k are selected with np.partition instead of ranking every
+    # daily return. Ties follow rank(method='min'): mdrn is the average of
+    # all returns greater than or equal to the n-th largest return.
+    @memoize('dsf')
+    def maxret_all(self, k=5, backend='pandas'):
+        start_time = time.time()
+        # At least 15 days are required in a month
+        if k > 15:
+            raise ValueError('k should be no greater than 15')
+
+        if backend == 'polars':
+            return polars_backend.maxret(self.dsf, k)
+
+        p = ap_panel(self.dsf, ['permno', 'yyyymm', 'date'])
+        permno = self.dsf['permno'].to_numpy()
+        yyyymm = self.dsf['yyyymm'].to_numpy()
+        ret = self.dsf['ret'].to_numpy(dtype=float)
+        starts, gid = p.groups(['permno', 'yyyymm'])
+        n_day = np.diff(np.r_[starts, len(ret)])
+        within = np.arange(len(ret)) - starts[gid]
+        width = n_day.max()
+
+        res = np.full((len(starts), k), np.nan)
+        # Blocks of stock-months to bound the size of the matrix
+        block = 500000
+        for b in range(0, len(starts), block):
+            e = min(b+block, len(starts))
+            r0 = starts[b]
+            r1 = starts[e] if e < len(starts) else len(ret)
+            mat = np.full((e-b, width), -np.inf)
+            mat[gid[r0:r1]-b, within[r0:r1]] = ret[r0:r1]
+            top = -np.partition(-mat, k-1, axis=1)[:, :k]
+            top = -np.sort(-top, axis=1)
+            for i in range(k):
+                sel = mat >= top[:, [i]]
+                res[b:e, i] = np.where(sel, mat, 0).sum(axis=1) / sel.sum(axis=1)
+
+        df = pd.DataFrame({'permno': permno[starts], 'yyyymm': yyyymm[starts]})
+        for i in range(k):
+            df['mdr'+str(i+1)] = res[:, i]
+
+        # Require at least 15 days in a month
+        df = df[n_day>=15].reset_index(drop=True)
+
+        end_time = time.time()
+        print(f'--------- MDR1 to MDR{k} ---------')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+        return df
+
     def maxret(self, n):
+        return self.maxret_all(n)[['permno', 'yyyymm', 'mdr'+str(n)]]
+
+    @memoize('dsf', 'dsi')
+    def maxret_rolling_est(self, k=5, windows=(21, 63, 252)):
         start_time = time.time()
-        df = self.dsf.query('rank<=@n').copy()
-        df = (df.groupby(['permno', 'yyyymm'])['ret']
-            .mean().to_frame('mdr'+str(n)).reset_index())
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        if k > min_days(min(windows)):
+            raise ValueError('k should be no greater than the minimum days')
+
+        # dsf is sorted by permno and date
+        cal = ap_calendar(self.dsi['date'])
+        d = cal.day_index(self.dsf['date'])
+        ok = d >= 0
+        d = d[ok]
+        permno = self.dsf['permno'].to_numpy()[ok]
+        ret = self.dsf['ret'].to_numpy(dtype=float)[ok]
+
+        res = {f'mdr{i+1}_{w}d': np.full(len(ret), np.nan) for w in windows
+            for i in range(k)}
+        for b, e in permno_blocks(permno):
+            for w in windows:
+                top, tie = window_topk(ret[b:e], permno[b:e], d[b:e], w, k)
+                n = np.arange(e-b) - window_start(permno[b:e], d[b:e], w) + 1
+                mdr = topk_mean(top, tie)
+                for i in range(k):
+                    res[f'mdr{i+1}_{w}d'][b:e] = np.where(n>=min_days(w),
+                        mdr[:, i], np.nan)
+
+        df = self.dsf.loc[ok, ['permno', 'date']]
+        for i in res:
+            df[i] = res[i]
+
+        df = df.dropna(subset=list(res), how='all').reset_index(drop=True)
 
         end_time = time.time()
-        print(f'--------- MDR{n} ---------')
+        print(f'--------- Rolling MDR1 to MDR{k} ---------')
+        print(f'Obs: {len(df)}')
         print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
         return df
 
 if __name__ == '__main__':
     db = ap_maxret()
-    mdr = db.maxret(1)
-    for i in range(2, 6):
-        _tmp = db.maxret(i)
-        mdr = mdr.merge(_tmp, how='left', on=['permno', 'yyyymm'])
-
-    mdr = mdr.sort_values(['permno', 'yyyymm'], ignore_index=True)
+    mdr = db.maxret_all(5)
     data_dir = '/Volumes/Seagate/asset_pricing_data'
     mdr.to_csv(os.path.join(data_dir, 'mdr.txt'), sep='\t', index=False)
     print('Done: data is generated')
@@ -0,0 +1,273 @@
+# ------------------------------------------------------------------
+#                       Estimator result cache
+#
+# memoize stores the output of an estimator in a local parquet cache.
+# The cache key is built from
+#
+# the input frames of the instance, e.g. dsf: the keys of the queries
+# the frame is built from (source), or column names, dtypes and
+# checksums of blocks of rows (pd.util.hash_pandas_object)
+# the method parameters, e.g. model in ivol_est, specs in vol_multi_est
+# the code version: a checksum of the source of the estimator module
+# and of the repository modules it imports (panel.py, rolling.py, ...)
+#
+# so a result is reused only if inputs, parameters and code are the same.
+# The fingerprint of an input frame is computed once per instance and
+# reused as long as the attribute refers to the same frame.
+#
+# query caches the result of a WRDS query. Its key is the SQL text and a
+# snapshot of the source tables from the catalog (row and page counts,
+# insert/update/delete counters and the table comment of the tables and
+# of the tables under views), so a rerun reads the local copy instead of
+# pulling the data again until WRDS updates a source table.
+#
+# Cache directory: AP_CACHE_DIR (default ~/.ap_cache)
+# Cache size: AP_CACHE_SIZE in GB (default 20). The least recently used
+# files are removed when the cache is larger than this.
+# Set AP_CACHE_SIZE=0 to turn off the cache.
+#
+# Example
+# dsf, dsf_key = query(conn, sql, fetch, date_cols=['date'])
+# ... clean dsf
+# self.dsf = dsf
+# source(self, dsf=dsf_key)
+#
+# @memoize('dsf', 'ff3')
+# def ivol_est(self, model, outvar):
+# ------------------------------------------------------------------
+
+import pandas as pd
+import functools
+import hashlib
+import inspect
+import os
+import re
+import sys
+import time
+import weakref
+
+cache_dir = os.path.expanduser(os.environ.get('AP_CACHE_DIR', '~/.ap_cache'))
+cache_size = float(os.environ.get('AP_CACHE_SIZE', 20)) * 1024**3
+
+# Checksum of a frame by blocks of rows
+def frame_fingerprint(df, block=1000000):
+    h = hashlib.sha1()
+    h.update(repr(list(df.columns)).encode())
+    h.update(repr([str(i) for i in df.dtypes]).encode())
+    h.update(str(len(df)).encode())
+    for i in range(0, len(df), block):
+        x = pd.util.hash_pandas_object(df.iloc[i:i+block], index=False)
+        h.update(x.to_numpy().tobytes())
+
+    return h.hexdigest()
+
+def input_fingerprint(obj, attr):
+    x = getattr(obj, attr)
+    if not isinstance(x, pd.DataFrame):
+        return hashlib.sha1(repr(x).encode()).hexdigest()
+
+    fp = obj.__dict__.setdefault('_memo_fp', {})
+    if attr in fp and fp[attr][0]() is x:
+        return fp[attr][1]
+
+    res = frame_fingerprint(x)
+    fp[attr] = (weakref.ref(x), res)
+    return res
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Modules of the repository that a module uses: imported modules and the
+# modules of imported functions and classes, recursively
+def repo_modules(module, seen=None):
+    seen = set() if seen is None else seen
+    f = getattr(sys.modules.get(module), '__file__', None)
+    if (module in seen or f is None
+        or os.path.dirname(os.path.abspath(f)) != repo_dir):
+        return seen
+
+    seen.add(module)
+    for x in vars(sys.modules[module]).values():
+        dep = (x.__name__ if inspect.ismodule(x)
+            else getattr(x, '__module__', None))
+        if isinstance(dep, str):
+            repo_modules(dep, seen)
+
+    return seen
+
+# Checksum of the source of a module and of the repository modules it
+# uses (e.g. panel.py, rolling.py), so a change in a helper is a new
+# code version
+@functools.lru_cache(maxsize=None)
+def code_version(module):
+    h = hashlib.sha1()
+    for i in sorted(repo_modules(module)):
+        try:
+            src = inspect.getsource(sys.modules[i])
+        except (OSError, TypeError):
+            src = ''
+
+        h.update(f'{i}:{src}'.encode())
+
+    return h.hexdigest()
+
+# Source tables of a query: schema.table after from or join
+def query_tables(sql):
+    return sorted(set(re.findall(r'\b(?:from|join)\s+(\w+)\.(\w+)', sql,
+        flags=re.IGNORECASE)))
+
+# Catalog statistics of a table or view and of the tables under a view
+snapshot_sql = """
+    with recursive rel(oid) as (
+        select c.oid from pg_class c
+        join pg_namespace n on n.oid=c.relnamespace
+        where n.nspname=:schema and c.relname=:table
+        union
+        select d.refobjid from rel
+        join pg_rewrite r on r.ev_class=rel.oid
+        join pg_depend d on d.objid=r.oid
+            and d.classid='pg_rewrite'::regclass
+            and d.refclassid='pg_class'::regclass
+        where d.refobjid<>rel.oid
+    )
+    select n.nspname, c.relname, c.relkind, c.reltuples, c.relpages,
+        s.n_tup_ins, s.n_tup_upd, s.n_tup_del,
+        obj_description(c.oid, 'pg_class') as comment
+    from rel join pg_class c on c.oid=rel.oid
+    join pg_namespace n on n.oid=c.relnamespace
+    left join pg_stat_all_tables s on s.relid=c.oid
+    order by n.nspname, c.relname
+"""
+
+# Key of a query: SQL text and snapshot of its source tables. None if
+# the catalog cannot be read, then the result is not cached
+def query_key(conn, sql):
+    tables = query_tables(sql)
+    if not tables:
+        return None
+
+    h = hashlib.sha1(' '.join(sql.split()).encode())
+    for schema, table in tables:
+        try:
+            df = conn.raw_sql(snapshot_sql,
+                params={'schema': schema, 'table': table})
+        except Exception:
+            return None
+
+        if len(df) == 0:
+            return None
+
+        h.update(df.to_csv(index=False).encode())
+
+    return h.hexdigest()
+
+def save(f, df):
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+    tmp = f'{f}.{os.getpid()}.tmp'
+    df.to_parquet(tmp)
+    os.replace(tmp, f)
+
+# Result of a query and its key: from the local cache if the query and
+# its source tables did not change, else from WRDS with read (fetch, or
+# conn.raw_sql by default). tag: parameters of read that change the
+# result, which are part of the key
+def query(conn, sql, read=None, tag=None, **kwargs):
+    key = query_key(conn, sql) if cache_size > 0 else None
+    if key is not None and tag is not None:
+        key = hashlib.sha1(f'{key}:{tag!r}'.encode()).hexdigest()
+
+    f = (None if key is None
+        else os.path.join(cache_dir, f'query_{key}.parquet'))
+    if f is not None and os.path.exists(f):
+        start_time = time.time()
+        df = pd.read_parquet(f)
+        os.utime(f)
+        end_time = time.time()
+        print(f'--------- Cache: query {query_tables(sql)} ---------')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+        return df, key
+
+    if read is None:
+        df = conn.raw_sql(sql, **kwargs)
+    else:
+        df = read(conn, sql, **kwargs)
+
+    if f is not None:
+        save(f, df)
+        evict()
+
+    return df, key
+
+# Key input frames on the keys of the queries (and parameters) they are
+# built from, so memoize does not hash them. A frame with a missing key
+# is hashed
+def source(obj, **keys):
+    fp = obj.__dict__.setdefault('_memo_fp', {})
+    for attr, key in keys.items():
+        key = list(key) if isinstance(key, (list, tuple)) else [key]
+        if all(i is not None for i in key):
+            fp[attr] = (weakref.ref(getattr(obj, attr)),
+                hashlib.sha1(repr(key).encode()).hexdigest())
+
+# Remove the least recently used files until the cache fits the limit
+def evict(limit=None):
+    limit = cache_size if limit is None else limit
+    if not os.path.isdir(cache_dir):
+        return
+
+    files = []
+    for i in os.listdir(cache_dir):
+        if i.endswith('.parquet'):
+            s = os.stat(os.path.join(cache_dir, i))
+            files.append((s.st_mtime, s.st_size, i))
+
+    files.sort()
+    total = sum(i[1] for i in files)
+    for _, size, i in files:
+        if total <= limit:
+            break
+
+        os.remove(os.path.join(cache_dir, i))
+        total -= size
+
+def clear_cache():
+    evict(0)
+
+def memoize(*attrs):
+    def decorator(func):
+        sig = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if cache_size <= 0:
+                return func(self, *args, **kwargs)
+
+            bound = sig.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            params = [(k, v) for k, v in bound.arguments.items() if k != 'self']
+            h = hashlib.sha1()
+            h.update(f'{type(self).__name__}.{func.__name__}'.encode())
+            h.update(repr(params).encode())
+            h.update(code_version(func.__module__).encode())
+            for i in attrs:
+                h.update(f'{i}:{input_fingerprint(self, i)}'.encode())
+
+            name = f'{type(self).__name__}.{func.__name__}'
+            f = os.path.join(cache_dir, f'{func.__name__}_{h.hexdigest()}.parquet')
+            if os.path.exists(f):
+                start_time = time.time()
+                df = pd.read_parquet(f)
+                # Mark as recently used
+                os.utime(f)
+                end_time = time.time()
+                print(f'--------- Cache: {name} ---------')
+                print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+                return df
+
+            df = func(self, *args, **kwargs)
+            save(f, df)
+            evict()
+            return df
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,200 @@
+# ------------------------------------------------------------------
+#                          Sorted panel
+#
+# ap_panel keeps a data frame together with the keys it is sorted by
+# and the first row of each group. Sorting by keys the frame is known
+# to be sorted by is a no-op, and a frame with unknown order is checked
+# in one linear pass before it is sorted. Column assignment, grouped
+# lags and row filtering keep the order, so they keep the metadata.
+#
+# Example
+# p = ap_panel(dsf).sort(['permno', 'date'])
+# idx, ok = p.lag_index(5, ['permno'])  # row 5 days before, same stock
+# p.sort(['permno'])                    # no-op
+#
+# kway_join aligns any number of (permno, yyyymm) sorted outputs in one
+# pass instead of a chain of pairwise merges
+# ------------------------------------------------------------------
+
+import pandas as pd
+import numpy as np
+
+# Estimators keep shallow copies of their inputs, which needs
+# copy-on-write. It is always on from pandas 3, where the option is
+# deprecated
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.options.mode.copy_on_write = True
+
+class ap_panel:
+    def __init__(self, df, keys=None):
+        self.df = df
+        self.keys = list(keys) if keys is not None else []
+        self.grp = {}
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getitem__(self, col):
+        return self.df[col]
+
+    # Adding or replacing a column does not change the row order
+    def __setitem__(self, col, value):
+        self.df[col] = value
+
+    # Lexicographic order check in one pass over the key columns
+    def is_sorted(self, keys):
+        keys = list(keys)
+        if self.keys[:len(keys)] == keys:
+            return True
+
+        eq = np.ones(max(len(self.df)-1, 0), dtype=bool)
+        for i in keys:
+            x = self.df[i].to_numpy()
+            if (eq & (x[:-1]>x[1:])).any():
+                return False
+
+            eq &= x[:-1] == x[1:]
+
+        return True
+
+    def sort(self, keys):
+        keys = list(keys)
+        if self.keys[:len(keys)] == keys:
+            return self
+
+        if not self.is_sorted(keys):
+            self.df = self.df.sort_values(keys, ignore_index=True)
+
+        self.keys = keys
+        self.grp = {}
+        return self
+
+    # Positions of the first row of each group and group id of each row
+    def groups(self, by):
+        by = list(by)
+        if self.keys[:len(by)] != by:
+            raise ValueError(f'panel is not sorted by {by}')
+
+        if tuple(by) not in self.grp:
+            first = np.zeros(len(self.df), dtype=bool)
+            first[:1] = True
+            for i in by:
+                x = self.df[i].to_numpy()
+                first[1:] |= x[1:] != x[:-1]
+
+            starts = np.flatnonzero(first)
+            gid = np.cumsum(first) - 1
+            self.grp[tuple(by)] = (starts, gid)
+
+        return self.grp[tuple(by)]
+
+    # First row of the group of each row
+    def group_start(self, by):
+        starts, gid = self.groups(by)
+        return starts[gid]
+
+    # Position of each row within its group
+    def position(self, by):
+        return np.arange(len(self.df)) - self.group_start(by)
+
+    # Last row of each group
+    def last(self, by):
+        starts, gid = self.groups(by)
+        return np.r_[gid[1:]!=gid[:-1], len(gid)>0]
+
+    # Row n rows before (n<0: after) each row and whether it is in the
+    # same group. Rows outside the group point to row 0.
+    def lag_index(self, n, by):
+        starts, gid = self.groups(by)
+        idx = np.arange(len(self.df)) - n
+        ok = (idx>=0) & (idx<len(self.df))
+        idx = np.where(ok, idx, 0)
+        ok &= gid[idx] == gid
+        return idx, ok
+
+    # Grouped shift, the same as groupby(by)[col].shift(n)
+    def lag(self, col, n, by):
+        idx, ok = self.lag_index(n, by)
+        x = self.df[col].take(idx).reset_index(drop=True)
+        return x.where(ok).set_axis(self.df.index)
+
+    # Filtering keeps the order, group positions are rebuilt on request
+    def filter(self, mask):
+        return ap_panel(self.df[mask].reset_index(drop=True), self.keys)
+
+# Same as df.sort_values(keys, ignore_index=True)
+def sort_panel(df, keys):
+    return ap_panel(df).sort(keys).df.reset_index(drop=True)
+
+# Integer codes that keep the lexicographic order of integer keys
+# Codes of all frames share the same scale so they can be compared
+def key_codes(frames, keys):
+    n = [len(i) for i in frames]
+    code = np.zeros(sum(n), dtype=np.int64)
+    for k in keys:
+        x = np.concatenate([i[k].to_numpy() for i in frames])
+        if not np.issubdtype(x.dtype, np.integer):
+            raise ValueError(f'key {k} should be integer')
+
+        x = x.astype(np.int64)
+        lo = x.min() if len(x) else 0
+        span = x.max()-lo+1 if len(x) else 1
+        if code.max(initial=0) > (np.iinfo(np.int64).max-span) // span:
+            raise ValueError('keys are too wide to be combined')
+
+        code = code*span + (x-lo)
+
+    return np.split(code, np.cumsum(n)[:-1])
+
+# K-way join of frames sorted by the same integer keys without duplicates
+# It gives the same result as chaining merge(how=how, on=keys), where how
+# is outer (union), inner (intersection) or left (keys of the first
+# frame), but all frames are aligned in one pass: the sorted runs are
+# merged by a stable sort and each frame's columns are placed with take
+def kway_join(frames, keys=['permno', 'yyyymm'], how='outer'):
+    keys = list(keys)
+    if how not in ['outer', 'inner', 'left']:
+        raise ValueError('how should be outer, inner or left')
+
+    cols = [[c for c in i.columns if c not in keys] for i in frames]
+    all_cols = [c for i in cols for c in i]
+    if len(set(all_cols)) < len(all_cols):
+        raise ValueError('frames should not share non-key columns')
+
+    codes = key_codes(frames, keys)
+    for i in codes:
+        if (np.diff(i)<=0).any():
+            raise ValueError('frames should be sorted by keys without duplicates')
+
+    code = np.concatenate(codes)
+    src = np.repeat(np.arange(len(frames)), [len(i) for i in codes])
+    order = np.argsort(code, kind='stable')
+    new = np.r_[True, code[order][1:]!=code[order][:-1]]
+    # Union id of each row in each frame
+    uid = np.empty(len(code), dtype=np.int64)
+    uid[order] = np.cumsum(new) - 1
+    n = new.sum()
+    present = np.zeros((len(frames), n), dtype=bool)
+    present[src, uid] = True
+    if how == 'outer':
+        keep = np.ones(n, dtype=bool)
+    elif how == 'inner':
+        keep = present.all(axis=0)
+    else:
+        keep = present[0]
+
+    remap = np.where(keep, np.cumsum(keep)-1, -1)
+    base = order[new][keep]
+    df = pd.DataFrame({k: np.concatenate([i[k].to_numpy() for i in frames])[base]
+        for k in keys})
+    start = 0
+    for i, c in zip(frames, cols):
+        pos = remap[uid[start:start+len(i)]]
+        start += len(i)
+        hit = pos >= 0
+        ix = np.full(len(df), -1)
+        ix[pos[hit]] = np.flatnonzero(hit)
+        for j in c:
+            df[j] = pd.api.extensions.take(np.asarray(i[j]), ix, allow_fill=True)
+
+    return df
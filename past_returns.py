@@ -9,6 +9,16 @@
 #
 # All calculations skip current month
 # Require at least n-1 months in past n months
+#
+# All horizons come from one pass over msf: cumulative log returns
+# are built once for each stock and the return over months t-e to
+# t-s is the difference of two cumulative sums. pre12_7ret requires
+# at least 11 months in past 12 months, the same as pre12ret.
+#
+# ap_preret(dsf) compounds monthly returns from a daily panel that is
+# already available instead of extracting crsp.msf (see crsp_monthly.py).
+# dsf_key is the query key of the daily panel (memo.py), so the monthly
+# data is not hashed. ap_preret() extracts crsp.msf
 # -------------------------------------------------------------------------
 
 import wrds
@@ -17,22 +27,32 @@ import pandas as pd
 import numpy as np
 import os
 import time
+from panel import ap_panel, sort_panel
+from memo import memoize, query, source
+from crsp_monthly import msf_from_dsf
+from wrds_fetch import fetch
 
 class ap_preret:
-    def __init__(self):
+    def __init__(self, dsf=None, dsf_key=None):
         start_time = time.time()
-        pass_dir = '~/.pass'
-        cfg = cp.ConfigParser()
-        cfg.read(os.path.join(os.path.expanduser(pass_dir), 'credentials.cfg'))
-        conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
+        if dsf is None:
+            pass_dir = '~/.pass'
+            cfg = cp.ConfigParser()
+            cfg.read(os.path.join(os.path.expanduser(pass_dir), 'credentials.cfg'))
+            conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
-        # Extract CRSP daily data
-        msf = conn.raw_sql("""
-            select a.permno, a.date, a.ret
-            from crsp.msf a left join crsp.msenames b
-                on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
-            where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
-        """, date_cols=['date'])
+            # Extract CRSP monthly data
+            msf, msf_key = query(conn, """
+                select a.permno, a.date, a.ret
+                from crsp.msf a left join crsp.msenames b
+                    on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
+                where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
+            """, date_cols=['date'])
+        else:
+            # Compound monthly returns from CRSP daily data
+            msf = msf_from_dsf(dsf[['permno', 'date', 'ret']])
+            msf = msf[['permno', 'date', 'ret']]
+            msf_key = dsf_key
 
         msf['permno'] = msf['permno'].astype(int)
         msf['date'] = msf['date'] + pd.offsets.MonthEnd(0)
@@ -41,77 +61,81 @@ class ap_preret:
         msf['midx'] = ((msf['date'].dt.year-1925) * 12
             + msf['date'].dt.month - 11)
         msf.loc[msf['ret']<=-1, 'ret'] = np.nan
-        msf = msf.sort_values(['permno', 'yyyymm'], ignore_index=True)
-        self.msf = msf.copy()
+        msf = sort_panel(msf, ['permno', 'yyyymm'])
+        self.msf = msf
+        source(self, msf=msf_key)
 
         end_time = time.time()
-        print('\n--------- Extract data from WRDS ---------')
+        src = 'WRDS' if dsf is None else 'daily data'
+        print(f'\n--------- Extract data from {src} ---------')
         print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
 
-    def preret_est(self, j):
+    # Past returns over months t-e to t-s for each (s, e) pair in windows
+    # e.g. pre12ret is (1, 12) and pre12_7ret is (7, 12)
+    @memoize('msf')
+    def preret_multi_est(self, windows=None):
         start_time = time.time()
-        df = self.msf.copy()
-
-        df['logret'] = np.log(1+df['ret'])
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
-        df['l1logret'] = df.groupby('permno')['logret'].shift(1)
-        # Past n-month returns with at least n-1 months
-        df['pre'+str(j)+'ret'] = (df.groupby('permno')['l1logret']
-            .rolling(window=j, min_periods=j-1)
-            .sum().reset_index(drop=True))
-        df['lmidx'] = df.groupby('permno')['midx'].shift(j)
-        df['month_gap'] = df['midx'] - df['lmidx']
-        df['pre'+str(j)+'ret'] = np.exp(df['pre'+str(j)+'ret']) - 1
-        # 137 obs with month gaps
-        # Set to missing if there is month gap
-        df.loc[df['month_gap']!=j, 'pre'+str(j)+'ret'] = np.nan
-        df = df[df['pre'+str(j)+'ret'].notna()].copy()
-        df = df[['permno', 'yyyymm', 'pre'+str(j)+'ret']]
-        obs = len(df)
-        start_month = df['yyyymm'].min()
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
-
-        end_time = time.time()
-        print(f'--------- Past {j}-month return ---------')
-        print(f'Obs: {obs}')
-        print(f'Start month: {start_month}')
-        print(f'Time used: {end_time-start_time: 3.1f} seconds')
-        return df
+        if windows is None:
+            windows = {'pre3ret': (1, 3), 'pre6ret': (1, 6), 'pre9ret': (1, 9),
+                'pre12ret': (1, 12), 'pre12_7ret': (7, 12)}
 
-    def pre12_7ret_est(self):
-        start_time = time.time()
-        print('\n--------- Past 12-to-7 return ---------')
-        pre6ret = self.preret_est(6)
-        pre12ret = self.preret_est(12)
+        df = self.msf[['permno', 'yyyymm']]
+        p = ap_panel(self.msf, ['permno', 'yyyymm'])
+        midx = self.msf['midx'].to_numpy()
+        logret = np.log(1+self.msf['ret'].to_numpy(dtype=float))
+        valid = ~np.isnan(logret)
+        # cum[i] and cnt[i] are the sum of log returns and number of valid
+        # returns before row i (msf is sorted by permno and yyyymm)
+        cum = np.concatenate([[0], np.cumsum(np.where(valid, logret, 0))])
+        cnt = np.concatenate([[0], np.cumsum(valid)])
+        pos = np.arange(len(df))
+        for name, (s, e) in windows.items():
+            # Month t-e should belong to the same stock
+            lo, ok = p.lag_index(e, ['permno'])
+            # Set to missing if there is month gap
+            ok &= (midx-midx[lo]) == e
+            # Require at least e-1 months in past e months
+            ok &= (cnt[pos]-cnt[lo]) >= e-1
+            logsum = cum[pos-s+1] - cum[lo]
+            df[name] = np.where(ok, np.exp(logsum)-1, np.nan)
 
-        df = pre6ret.merge(pre12ret, how='inner', on=['permno', 'yyyymm'])
-        df['pre12_7ret'] = np.log(1+df['pre12ret']) - np.log(1+df['pre6ret'])
-        df['pre12_7ret'] = np.exp(df['pre12_7ret']) - 1
-        df = (df.query('pre12_7ret==pre12_7ret')
-            [['permno', 'yyyymm', 'pre12_7ret']].copy())
+        df = df.dropna(subset=list(windows), how='all')
+        df = df.reset_index(drop=True)
         obs = len(df)
         start_month = df['yyyymm'].min()
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
 
         end_time = time.time()
+        print(f'--------- Past returns: {", ".join(windows)} ---------')
         print(f'Obs: {obs}')
         print(f'Start month: {start_month}')
         print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
         return df
 
+    def preret_est(self, j):
+        return self.preret_multi_est({'pre'+str(j)+'ret': (1, j)})
+
+    def pre12_7ret_est(self):
+        return self.preret_multi_est({'pre12_7ret': (7, 12)})
+
 if __name__ == '__main__':
-    db = ap_preret()
-    preret = db.preret_est(3)
-    for i in [6, 9, 12]:
-        tmp = db.preret_est(i)
-        preret = preret.merge(tmp, how='outer', on=['permno', 'yyyymm'])
+    pass_dir = '~/.pass'
+    cfg = cp.ConfigParser()
+    cfg.read(os.path.join(os.path.expanduser(pass_dir), 'credentials.cfg'))
+    conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
+    dsf, dsf_key = query(conn, """
+        select a.permno, a.date, a.ret
+        from crsp.dsf a left join crsp.msenames b
+            on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
+        where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
+    """, fetch,
+        date_cols=['date'])
+    dsf = dsf.drop_duplicates(['permno', 'date'], keep='last')
+    dsf['permno'] = dsf['permno'].astype(int)
 
-    tmp = db.pre12_7ret_est()
-    preret = preret.merge(tmp, how='outer', on=['permno', 'yyyymm'])
-    preret = preret.sort_values(['permno', 'yyyymm'], ignore_index=True)
+    db = ap_preret(dsf, dsf_key)
+    preret = db.preret_multi_est()
     obs = len(preret)
     data_dir = '/Volumes/Seagate/asset_pricing_data'
     preret.to_csv(os.path.join(data_dir, 'preret.txt'), sep='\t', index=False)
     print('Done: data is generated')
     print(f'Obs: {obs}')
-
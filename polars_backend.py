@@ -0,0 +1,151 @@
+# ------------------------------------------------------------------
+#                          Polars backend
+#
+# The same estimators as the pandas code, written as polars lazy
+# queries. Only the columns that are used are read and filters are
+# applied before group-bys (projection and predicate pushdown). The
+# group-bys run on all cores in one process, and the query is run by
+# the streaming engine if it is available.
+#
+# tvol: tvol_est in total_volatility.py
+# maxret: maxret_all in max_daily_return.py
+# vol: vol_multi_est in volume.py
+# week52_high: week52_high in 52week_high.py
+#
+# Select it with backend='polars', e.g. db.tvol_est(backend='polars')
+# polars is optional and only required by this backend
+# ------------------------------------------------------------------
+
+import pandas as pd
+import time
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+def check_polars():
+    if pl is None:
+        raise ImportError("polars is required for backend='polars'")
+
+def lazy_frame(df, cols):
+    check_polars()
+    return pl.from_pandas(df[cols], nan_to_null=True).lazy()
+
+def collect(lf):
+    try:
+        df = lf.collect(engine='streaming')
+    except (TypeError, ValueError):
+        df = lf.collect()
+
+    # Column by column: to_pandas requires pyarrow
+    return pd.DataFrame({i: df[i].to_numpy() for i in df.columns})
+
+def yyyymm(col='date'):
+    return (pl.col(col).dt.year().cast(pl.Int64)*100
+        + pl.col(col).dt.month().cast(pl.Int64))
+
+def tvol(dsf):
+    start_time = time.time()
+    lf = (lazy_frame(dsf, ['permno', 'date', 'ret'])
+        .drop_nulls()
+        .with_columns(yyyymm=yyyymm())
+        .group_by(['permno', 'yyyymm'])
+        .agg(tvol=pl.col('ret').std(), n=pl.col('ret').count())
+        # Require at least 15 days in a month
+        .filter(pl.col('n')>=15)
+        .select(['permno', 'yyyymm', 'tvol'])
+        .sort(['permno', 'yyyymm']))
+    df = collect(lf)
+
+    end_time = time.time()
+    print(f'--------- Total volatility (polars) ---------')
+    print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+    return df
+
+# mdrn is the average of all returns greater than or equal to the n-th
+# largest return, the same as rank(method='min') in the pandas code
+def maxret(dsf, k=5):
+    start_time = time.time()
+    r = pl.col('ret')
+    lf = (lazy_frame(dsf, ['permno', 'yyyymm', 'ret'])
+        .drop_nulls()
+        .group_by(['permno', 'yyyymm'])
+        .agg([pl.len().alias('n_day')]
+            + [r.filter(r>=r.top_k(i).min()).mean().alias('mdr'+str(i))
+            for i in range(1, k+1)])
+        # Require at least 15 days in a month
+        .filter(pl.col('n_day')>=15)
+        .drop('n_day')
+        .sort(['permno', 'yyyymm']))
+    df = collect(lf)
+
+    end_time = time.time()
+    print(f'--------- MDR1 to MDR{k} (polars) ---------')
+    print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+    return df
+
+# Each spec is (j, min_n, var, var_name) as in vol_multi_est
+def vol(dsf, specs):
+    start_time = time.time()
+    var_list = sorted(set(i[2] for i in specs))
+    lf = (lazy_frame(dsf, ['permno', 'date']+var_list)
+        .with_columns(yyyymm=yyyymm())
+        .group_by(['permno', 'yyyymm'])
+        .agg([pl.col(i).sum() for i in var_list]
+            + [pl.col(i).count().alias(i+'_n') for i in var_list])
+        .sort(['permno', 'yyyymm'])
+        .with_columns(midx=(pl.col('yyyymm')//100-1925)*12
+            + pl.col('yyyymm')%100 - 11))
+
+    cols, ok_list = [], []
+    for j, min_n, var, var_name in specs:
+        var_sum = pl.col(var).rolling_sum(j, min_samples=j).over('permno')
+        day_sum = pl.col(var+'_n').rolling_sum(j, min_samples=j).over('permno')
+        # Control month gap
+        gap = pl.col('midx') - pl.col('midx').shift(j-1).over('permno')
+        ok = (gap==j-1) & (day_sum>0) & (day_sum>=min_n)
+        v = var_sum / day_sum
+        if var == 'dvol_d':
+            v = pl.when(v>0).then(v.log())
+
+        cols.append(pl.when(ok).then(v).alias(var_name))
+        ok_list.append(ok.fill_null(False))
+
+    lf = (lf.with_columns(cols + [pl.any_horizontal(ok_list).alias('keep')])
+        .filter(pl.col('keep'))
+        .select(['permno', 'yyyymm']+[i[3] for i in specs]))
+    df = collect(lf)
+
+    end_time = time.time()
+    print(f'\n--------- {", ".join(i[3] for i in specs)} (polars) ---------')
+    print(f'Obs: {len(df)}')
+    print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+    return df
+
+def week52_high(dsf):
+    start_time = time.time()
+    high = pl.col('month_high')
+    lf = (lazy_frame(dsf, ['permno', 'yyyymm', 'date', 'prc'])
+        .sort(['permno', 'yyyymm', 'date'])
+        # Highest price and price on last trading day in each month
+        .group_by(['permno', 'yyyymm'], maintain_order=True)
+        .agg(month_high=pl.col('prc').max(), prc=pl.col('prc').last())
+        .with_columns(l1month_high=high.shift(1).over('permno'),
+            l1prc=pl.col('prc').shift(1).over('permno'))
+        .with_columns(
+            pre12high=high.rolling_max(12, min_samples=12).over('permno'),
+            pre12high_skip=(pl.col('l1month_high')
+                .rolling_max(12, min_samples=12).over('permno')))
+        .with_columns(week52h=pl.col('prc')/pl.col('pre12high')-1,
+            week52h_skip=pl.col('l1prc')/pl.col('pre12high_skip')-1)
+        .filter(pl.col('week52h').is_not_null()
+            | pl.col('week52h_skip').is_not_null())
+        .select(['permno', 'yyyymm', 'week52h', 'week52h_skip']))
+    df = collect(lf)
+
+    end_time = time.time()
+    print('--------- 52-week high estimation (polars) ---------')
+    print(f'Obs: {len(df)}')
+    print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+    return df
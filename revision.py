@@ -0,0 +1,212 @@
+# ------------------------------------------------------------------
+#                   Revision-aware recomputation
+#
+# CRSP and Compustat revise the history of some securities in every
+# release. Instead of rebuilding every output, ap_revision compares the
+# input frames of an estimator with a snapshot of the previous release
+# and recomputes the stocks whose inputs changed:
+#
+# 1. Each keyed input frame (dsf by permno, fundq and funda by gvkey,
+#    ibes by ticker) is hashed by key: the sum of the row checksums of
+#    the key (pd.util.hash_pandas_object), so the order of rows does not
+#    matter. Keys that are new, removed or have a different checksum are
+#    changed. Other inputs (e.g. factors) are compared as whole frames
+#    and a change requires a full rebuild.
+# 2. Changed gvkeys and tickers are mapped to permno through the link
+#    (permno_gvkey or the ticker-permno pairs of ibes) of both releases.
+#    All gvkeys or tickers of these permno are recomputed together, as
+#    the output of a permno can use any of them.
+# 3. The estimator runs on the rows of these keys only (partial_est) and
+#    the rows of the changed permno are replaced in the previous output
+#    (splice).
+#
+# Estimators with cross-sectional steps (e.g. winsorized disp in
+# analysts_est) need a full rebuild.
+#
+# Snapshot directory: AP_REVISION_DIR (default ~/.ap_revision). The
+# output of estimate is saved with the snapshot by commit, so the next
+# release splices into the output of the same inputs.
+#
+# Example
+# db = ap_sue()
+# rev = ap_revision('sue')
+# scope = rev.scope(db, {'fundq': 'gvkey', 'permno_gvkey': 'gvkey'},
+#     link='permno_gvkey')
+# # Full run if scope is None (first run or a full rebuild is required)
+# sue = rev.estimate(db, 'sue_est', scope, 'eps', 'sue')
+# ... save sue
+# rev.commit()
+# ------------------------------------------------------------------
+
+import pandas as pd
+import numpy as np
+import hashlib
+import os
+import time
+from panel import sort_panel
+from memo import frame_fingerprint
+from checkpoint import ap_checkpoint
+
+# Checksum of the rows of each key: key, hash, n (number of rows)
+# Column names and dtypes are mixed into every row checksum
+def key_hash(df, key):
+    schema = repr([(i, str(j)) for i, j in df.dtypes.items()])
+    salt = np.frombuffer(hashlib.sha1(schema.encode()).digest()[:8],
+        dtype=np.uint64)[0]
+    h = pd.util.hash_pandas_object(df, index=False).to_numpy() ^ salt
+    code, uniq = pd.factorize(df[key], sort=True)
+    # Rows without key are not hashed
+    h, code = h[code>=0], code[code>=0]
+    s = np.zeros(len(uniq), dtype=np.uint64)
+    # uint64 sum wraps around
+    np.add.at(s, code, h)
+    return pd.DataFrame({key: uniq, 'hash': s,
+        'n': np.bincount(code, minlength=len(uniq))})
+
+class ap_revision:
+    def __init__(self, name, root=None):
+        if root is None:
+            root = os.environ.get('AP_REVISION_DIR', '~/.ap_revision')
+
+        self.snap = ap_checkpoint(name, root)
+        self.pending = {}
+        self.old = {}
+
+    # Changed keys of a frame, None if there is no snapshot. With to, the
+    # key-to pairs of the frame (e.g. ticker-permno) are kept for mapped
+    def changed_keys(self, attr, df, key, to=None):
+        if attr not in self.pending:
+            new = key_hash(df, key)
+            if to is not None:
+                pairs = df[[key, to]].drop_duplicates()
+                new = new.merge(pairs, how='left', on=key)
+
+            self.pending[attr] = new
+            self.old[attr] = self.snap.load(attr) if self.snap.has(attr) else None
+
+        old, new = self.old[attr], self.pending[attr]
+        if old is None:
+            return None
+
+        old = old.drop_duplicates(key)[[key, 'hash', 'n']]
+        new = new.drop_duplicates(key)[[key, 'hash', 'n']]
+        df = old.merge(new, how='outer', on=key, indicator=True)
+        changed = ((df['_merge']!='both') | (df['hash_x']!=df['hash_y'])
+            | (df['n_x']!=df['n_y']))
+        return df.loc[changed, key].to_numpy()
+
+    # True if a frame without key changed or there is no snapshot
+    def frame_changed(self, attr, df):
+        if attr not in self.pending:
+            self.pending[attr] = pd.DataFrame({'fp': [frame_fingerprint(df)]})
+            self.old[attr] = self.snap.load(attr) if self.snap.has(attr) else None
+
+        old = self.old[attr]
+        return old is None or old['fp'].iloc[0] != self.pending[attr]['fp'].iloc[0]
+
+    # Values of to linked to keys in the snapshot and in the new frame
+    def mapped(self, attr, keys, key, to):
+        res = [i.loc[i[key].isin(keys), to] for i in
+            [self.old[attr], self.pending[attr]] if i is not None]
+        return pd.unique(pd.concat(res).dropna())
+
+    # Permno to recompute and the rows of each input to use:
+    # (permno, {attr: (column, values)}), or None for a full rebuild
+    # keyed: {attr: key}, frames: inputs compared as whole frames, link:
+    # keyed attr with key-permno pairs (all keyed inputs share the key)
+    def scope(self, obj, keyed, frames=(), link=None):
+        start_time = time.time()
+        full = any([self.frame_changed(i, getattr(obj, i)) for i in frames])
+        keys = []
+        for attr, key in keyed.items():
+            to = 'permno' if attr == link else None
+            keys.append(self.changed_keys(attr, getattr(obj, attr), key, to))
+
+        if full or any(i is None for i in keys):
+            print('\n--------- Revision: full rebuild ---------\n')
+            return None
+
+        key = list(keyed.values())[0]
+        keys = np.unique(np.concatenate(keys))
+        if link is None:
+            permno, rows = keys, keys
+        else:
+            permno = self.mapped(link, keys, key, 'permno')
+            df = getattr(obj, link)
+            rows = pd.unique(df.loc[df['permno'].isin(permno), key])
+            rows = np.union1d(rows, keys)
+
+        end_time = time.time()
+        print('\n--------- Revision: changed keys ---------')
+        print(f'Changed {key}: {len(keys)}')
+        print(f'Permno to recompute: {len(permno)}')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+        return permno, {attr: (key, rows) for attr, key in keyed.items()}
+
+    # Previous output of method with the rows of the changed permno
+    # recomputed, or a full run if there is no previous output or scope
+    # is None. Outputs are kept by the arguments of method
+    def estimate(self, obj, method, scope, *args, **kwargs):
+        h = hashlib.sha1(repr((args, sorted(kwargs.items()))).encode())
+        stage = f'output_{method}_{h.hexdigest()[:12]}'
+        old = self.snap.load(stage) if self.snap.has(stage) else None
+        if scope is None or old is None:
+            df = getattr(obj, method)(*args, **kwargs)
+        else:
+            new = partial_est(obj, method, scope, *args, **kwargs)
+            df = splice(old, new, scope[0])
+
+        self.pending[stage] = df
+        return df
+
+    # Save the snapshot of the inputs and outputs of this run. Outputs of
+    # other runs do not match the new snapshot and are removed
+    def commit(self):
+        if os.path.isdir(self.snap.path):
+            for i in os.listdir(self.snap.path):
+                stage = i[:-len('.parquet')]
+                if i.startswith('output_') and stage not in self.pending:
+                    os.remove(os.path.join(self.snap.path, i))
+
+        for attr, df in self.pending.items():
+            self.snap.save(attr, df)
+
+        self.pending = {}
+        self.old = {}
+
+# Run an estimator on the rows in scope only. Checkpoints of the
+# instance are moved to a scratch directory, so stages of a full run
+# are not reused. None if no permno changed
+def partial_est(obj, method, scope, *args, **kwargs):
+    permno, rows = scope
+    if len(permno) == 0:
+        return None
+
+    saved = {i: getattr(obj, i) for i in rows}
+    ckpt = getattr(obj, 'ckpt', None)
+    try:
+        for attr, (col, keys) in rows.items():
+            df = saved[attr]
+            setattr(obj, attr, df[df[col].isin(keys)])
+
+        if ckpt is not None:
+            obj.ckpt = ap_checkpoint('revision', ckpt.path)
+
+        df = getattr(obj, method)(*args, **kwargs)
+    finally:
+        for attr, df0 in saved.items():
+            setattr(obj, attr, df0)
+
+        if ckpt is not None:
+            obj.ckpt.clear()
+            obj.ckpt = ckpt
+
+    return df[df['permno'].isin(permno)]
+
+# Replace the rows of permno in the previous output
+def splice(old, new, permno):
+    if new is None:
+        return old
+
+    df = pd.concat([old[~old['permno'].isin(permno)], new], ignore_index=True)
+    return sort_panel(df, ['permno', 'yyyymm'])
@@ -0,0 +1,177 @@
+# ------------------------------------------------------------------
+#                   Rolling trading-day windows
+#
+# Daily characteristics over the trailing w trading days of each
+# stock-day (e.g. 21, 63 and 252 days). A window is updated from the
+# previous one in constant time instead of being recomputed:
+#
+# window_moments: running sums of values and cross-products by stock.
+# The sums over a window are the difference of two running sums (the
+# new day is added and the day that leaves is removed). Values are
+# shifted by the first value of the stock so the sums stay small, and
+# running sums restart every w rows so the rounding error is of the
+# size of the window, not of the history. Variances below the rounding
+# error (constant values) are 0.
+# window_topk: the days of a stock are cut into blocks of w days and the
+# top k of the prefix and of the suffix of each block are built by
+# merging one day at a time. A window is the suffix of one block and
+# the prefix of the next, so its top k is one merge of two lists (van
+# Herk/Gil-Werman running maximum). The number of returns equal to the
+# k-th largest return is kept for ties.
+#
+# Rows are sorted by permno and trading-day index d (trading_calendar.py)
+# and the window of a row has the rows of days d-w+1 to d. The minimum
+# number of days is scaled from 15 in 21 days: min_days(w)
+# ------------------------------------------------------------------
+
+import numpy as np
+
+def min_days(w, n=15, m=21):
+    return int(np.ceil(w*n/m))
+
+# Row ranges of whole stocks with about rows rows each
+def permno_blocks(permno, rows=2000000):
+    starts = np.r_[np.flatnonzero(np.r_[True, permno[1:]!=permno[:-1]]),
+        len(permno)]
+    b = 0
+    while b < len(permno):
+        e = starts[min(np.searchsorted(starts, b+rows), len(starts)-1)]
+        e = max(e, starts[np.searchsorted(starts, b, side='right')])
+        yield b, e
+        b = e
+
+# First row of each stock and of the window of each row
+def first_row(permno):
+    new = np.r_[True, permno[1:]!=permno[:-1]]
+    return np.maximum.accumulate(np.where(new, np.arange(len(permno)), 0))
+
+def window_start(permno, d, w):
+    key = np.asarray(permno, dtype=np.int64)*2**32 + d
+    return np.searchsorted(key, key-w+1)
+
+# Sums of x over rows start to i and the sums of |x| over the rows that
+# enter the computation (scale of the rounding error). Prefix sums
+# restart every size rows (the longest window), so a window is the
+# suffix of one segment plus the prefix of the next and no sum runs over
+# the whole history of a stock
+def segment_sum(x, start):
+    i = np.arange(len(x))
+    size = int((i-start).max()) + 1 if len(x) else 1
+    m = -(-len(x)//size) * size
+    seg = (m//size, size) + x.shape[1:]
+    cross = (i//size != start//size).reshape((-1,)+(1,)*(x.ndim-1))
+    res = []
+    for y in [x, np.abs(x)]:
+        pad = np.zeros((m,)+x.shape[1:])
+        pad[:len(x)] = y
+        inc = np.cumsum(pad.reshape(seg), axis=1).reshape(pad.shape)
+        # Sum of the rows of the segment before a row
+        ex = np.zeros_like(inc)
+        ex[1:] = inc[:-1]
+        ex[::size] = 0
+        total = np.where(cross, inc[size-1::size][start//size], 0)
+        res.append((total, ex[start], inc[:len(x)]))
+
+    (total, ex, inc), (total_abs, ex_abs, inc_abs) = res
+    return total - ex + inc, total_abs + ex_abs + inc_abs
+
+def window_sum(x, start):
+    return segment_sum(x, start)[0]
+
+# Number of rows and central sums of products of z (rows x p) in windows.
+# Sums of squares within the rounding error of their scale are set to 0
+# (constant values in a window), with the products of that column
+def window_moments(z, permno, start, tol=None):
+    dz = z - z[first_row(permno)]
+    n = np.arange(len(z)) - start + 1
+    s1 = window_sum(dz, start)
+    s2, scale = segment_sum(dz[:, :, None]*dz[:, None, :], start)
+    a = s1 / n[:, None]
+    c2 = s2 - n[:, None, None]*a[:, :, None]*a[:, None, :]
+    if tol is None:
+        tol = 8 * (int(n.max()) if len(n) else 1) * np.finfo(float).eps
+
+    j = np.arange(z.shape[1])
+    zero = c2[:, j, j] <= tol*scale[:, j, j]
+    c2[zero[:, :, None] | zero[:, None, :]] = 0
+    c2[:, j, j] = np.maximum(c2[:, j, j], 0)
+    return n, c2
+
+# Merge two top k lists. tie is the number of values equal to the k-th
+# largest value. The k-th largest value of the merged list is not below
+# the k-th of either list, so its other copies are in the lists or are
+# counted by their tie
+def topk_merge(a, a_tie, b, b_tie):
+    top = -np.sort(-np.hstack([a, b]), axis=1)[:, :a.shape[1]]
+    v = top[:, [-1]]
+    n = (np.where(v[:, 0]==a[:, -1], a_tie, (a==v).sum(axis=1))
+        + np.where(v[:, 0]==b[:, -1], b_tie, (b==v).sum(axis=1)))
+    return top, np.where(np.isfinite(v[:, 0]), n, 0)
+
+def topk_single(x, k):
+    top = np.full((len(x), k), -np.inf)
+    top[:, 0] = x
+    return top, np.where(np.isfinite(x) & (k==1), 1, 0)
+
+# Average of all values greater than or equal to the n-th largest
+# value, n = 1 to k (rank(method='min') ties)
+def topk_mean(top, tie):
+    k = top.shape[1]
+    res = np.full((len(top), k), np.nan)
+    for i in range(k):
+        # Missing if fewer than i+1 values
+        t = np.where(np.isfinite(top[:, [i]]), top[:, [i]], np.nan)
+        gt = top > t
+        n_eq = np.where(t[:, 0]==top[:, -1], tie, (top==t).sum(axis=1))
+        s = np.where(gt, top, 0).sum(axis=1) + n_eq*t[:, 0]
+        res[:, i] = s / (gt.sum(axis=1)+n_eq)
+
+    return res
+
+# Top k of x in the window of each row
+def window_topk(x, permno, d, w, k):
+    # Days of each stock from its first to its last day, -inf if missing
+    first = first_row(permno)
+    pos = d - d[first]
+    new = np.flatnonzero(first==np.arange(len(x)))
+    length = np.r_[pos[new[1:]-1], pos[-1:]] + 1
+    offset = np.cumsum(length) - length
+    g = np.cumsum(first==np.arange(len(x))) - 1
+    j = offset[g] + pos
+    dense = np.full(length.sum(), -np.inf)
+    dense[j] = x
+    dg = np.repeat(np.arange(len(length)), length)
+    dpos = np.arange(len(dense)) - offset[dg]
+    last = dpos == length[dg]-1
+    bpos = dpos % w
+
+    by_pos = np.argsort(bpos, kind='stable')
+    cuts = np.searchsorted(bpos[by_pos], np.arange(w+1))
+    pre = np.full((len(dense), k), -np.inf)
+    pre_tie = np.zeros(len(dense), dtype=np.int64)
+    suf = np.full((len(dense), k), -np.inf)
+    suf_tie = np.zeros(len(dense), dtype=np.int64)
+    for o in range(w):
+        i = by_pos[cuts[o]:cuts[o+1]]
+        top, tie = topk_single(dense[i], k)
+        if o > 0:
+            top, tie = topk_merge(pre[i-1], pre_tie[i-1], top, tie)
+
+        pre[i], pre_tie[i] = top, tie
+
+    for o in range(w-1, -1, -1):
+        i = by_pos[cuts[o]:cuts[o+1]]
+        top, tie = topk_single(dense[i], k)
+        m = ~last[i] & (o<w-1)
+        top[m], tie[m] = topk_merge(suf[i[m]+1], suf_tie[i[m]+1], top[m],
+            tie[m])
+        suf[i], suf_tie[i] = top, tie
+
+    # Window of a row: suffix of the previous block from day pos-w+1 and
+    # prefix of the current block
+    top, tie = pre[j], pre_tie[j]
+    a = pos - w + 1
+    m = (a>0) & (pos%w!=w-1)
+    top[m], tie[m] = topk_merge(suf[offset[g[m]]+a[m]],
+        suf_tie[offset[g[m]]+a[m]], top[m], tie[m])
+    return top, tie
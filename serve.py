@@ -0,0 +1,235 @@
+# ------------------------------------------------------------------
+#                       Characteristic server
+#
+# Notebooks and jobs read the characteristic panel from one local
+# server instead of parsing the tab-delimited files each time:
+#
+# build_store writes the panel (characteristics.py) sorted by yyyymm and
+# permno as an Arrow IPC file with one record batch per month
+# ap_store memory-maps the file: columns are read in place, without
+# parsing or copying, and all processes that open the file share the
+# same pages in the OS cache. The permno index of the most recently
+# used months is kept in a LRU hot cache.
+# serve answers HTTP queries on localhost and streams the result as
+# Arrow IPC batches, one month at a time. The batches are selected
+# before the response starts, so a failed query is an error status
+#
+# GET /columns
+# GET /query?chars=tvol,ivol_ff3&start=200001&end=201012&permno=10001,10107
+# All parameters are optional: all characteristics, months and stocks
+#
+# Store file: AP_STORE_DIR (default ~/.ap_store)/characteristics.arrow
+# Hot cache: AP_STORE_MONTHS months (default 36)
+# pyarrow is required
+#
+# Example
+# store = ap_store()
+# df = store.query(['tvol', 'mdr1'], 200001, 200012).to_pandas()
+# server = start_server(store, port=0)    # in a background thread
+# df = read_query(f'http://127.0.0.1:{server.server_port}', ['tvol'])
+# ------------------------------------------------------------------
+
+import numpy as np
+import collections
+import json
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from panel import sort_panel
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+store_dir = os.path.expanduser(os.environ.get('AP_STORE_DIR', '~/.ap_store'))
+hot_months = int(os.environ.get('AP_STORE_MONTHS', 36))
+arrow_mime = 'application/vnd.apache.arrow.stream'
+
+def check_pyarrow():
+    if pa is None:
+        raise ImportError('pyarrow is required for the characteristic server')
+
+def store_file(path=None):
+    return os.path.join(store_dir if path is None else path,
+        'characteristics.arrow')
+
+def build_store(panel, path=None):
+    check_pyarrow()
+    start_time = time.time()
+    f = store_file(path)
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+    panel = sort_panel(panel, ['yyyymm', 'permno'])
+    table = pa.Table.from_pandas(panel, preserve_index=False)
+    ym = panel['yyyymm'].to_numpy()
+    bounds = np.r_[np.flatnonzero(np.diff(ym)!=0)+1, len(ym)]
+    bounds = bounds[bounds>0]
+
+    tmp = f'{f}.{os.getpid()}.tmp'
+    with pa.OSFile(tmp, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            lo = 0
+            for hi in bounds:
+                writer.write_table(table.slice(lo, hi-lo),
+                    max_chunksize=hi-lo)
+                lo = hi
+
+    os.replace(tmp, f)
+
+    end_time = time.time()
+    print('\n--------- Build characteristic store ---------')
+    print(f'Obs: {len(panel)}')
+    print(f'Months: {len(bounds)}')
+    print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+    return f
+
+class ap_store:
+    def __init__(self, path=None, hot=None):
+        check_pyarrow()
+        self.reader = pa.ipc.open_file(pa.memory_map(store_file(path)))
+        self.schema = self.reader.schema
+        self.columns = self.schema.names
+        self.chars = [i for i in self.columns if i not in ['permno', 'yyyymm']]
+        self.months = np.array([self.reader.get_batch(i).column('yyyymm')[0]
+            .as_py() for i in range(self.reader.num_record_batches)])
+        self.hot = collections.OrderedDict()
+        self.hot_size = hot_months if hot is None else hot
+        self.lock = threading.Lock()
+
+    # Record batch and permno of the i-th month
+    def month(self, i):
+        with self.lock:
+            if i in self.hot:
+                self.hot.move_to_end(i)
+                return self.hot[i]
+
+            batch = self.reader.get_batch(i)
+            res = (batch, batch.column('permno').to_numpy())
+            self.hot[i] = res
+            while len(self.hot) > self.hot_size:
+                self.hot.popitem(last=False)
+
+            return res
+
+    def select(self, chars=None):
+        chars = self.chars if chars is None else list(chars)
+        missing = [i for i in chars if i not in self.chars]
+        if missing:
+            raise ValueError(f'characteristics not found: {missing}')
+
+        return ['permno', 'yyyymm'] + chars
+
+    # Record batches of the query, one per month
+    def batches(self, chars=None, start=None, end=None, permno=None):
+        cols = self.select(chars)
+        i0 = 0 if start is None else np.searchsorted(self.months, start)
+        i1 = (len(self.months) if end is None
+            else np.searchsorted(self.months, end, side='right'))
+        if permno is not None:
+            permno = np.unique(np.asarray(permno, dtype=np.int64))
+
+        for i in range(i0, i1):
+            batch, p = self.month(i)
+            if permno is not None:
+                # permno is sorted within a month
+                idx = np.minimum(np.searchsorted(p, permno), max(len(p)-1, 0))
+                idx = idx[(len(p)>0) & (p[idx]==permno)]
+                batch = batch.take(pa.array(idx))
+
+            yield batch.select(cols)
+
+    def query(self, chars=None, start=None, end=None, permno=None):
+        cols = self.select(chars)
+        schema = pa.schema([self.schema.field(i) for i in cols])
+        return pa.Table.from_batches(list(self.batches(chars, start, end,
+            permno)), schema=schema)
+
+class ap_handler(BaseHTTPRequestHandler):
+    store = None
+
+    def send_text(self, code, text, mime='text/plain'):
+        body = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', mime)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        q = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        if url.path == '/columns':
+            m = [int(i) for i in self.store.months]
+            info = {'chars': self.store.chars, 'months': len(m),
+                'start': min(m, default=None), 'end': max(m, default=None)}
+            self.send_text(200, json.dumps(info), 'application/json')
+            return
+
+        if url.path != '/query':
+            self.send_text(404, 'not found')
+            return
+
+        try:
+            chars = q['chars'].split(',') if 'chars' in q else None
+            start = int(q['start']) if 'start' in q else None
+            end = int(q['end']) if 'end' in q else None
+            permno = ([int(i) for i in q['permno'].split(',')]
+                if 'permno' in q else None)
+            cols = self.store.select(chars)
+        except ValueError as e:
+            self.send_text(400, str(e))
+            return
+
+        # Batches are built before the status is sent, so an error is a
+        # 500 instead of a 200 with a truncated stream. Batches of whole
+        # months are views of the memory-mapped file
+        try:
+            batches = list(self.store.batches(chars, start, end, permno))
+        except Exception as e:
+            self.send_text(500, f'{type(e).__name__}: {e}')
+            return
+
+        schema = pa.schema([self.store.schema.field(i) for i in cols])
+        self.send_response(200)
+        self.send_header('Content-Type', arrow_mime)
+        self.end_headers()
+        with pa.ipc.new_stream(self.wfile, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(store, host='127.0.0.1', port=8765):
+    handler = type('handler', (ap_handler,), {'store': store})
+    return ThreadingHTTPServer((host, port), handler)
+
+# Serve in a daemon thread, e.g. in a notebook or a test
+def start_server(store, host='127.0.0.1', port=8765):
+    server = make_server(store, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def read_query(url, chars=None, start=None, end=None, permno=None):
+    check_pyarrow()
+    q = {'chars': None if chars is None else ','.join(chars),
+        'start': start, 'end': end,
+        'permno': None if permno is None else ','.join(str(i) for i in permno)}
+    q = {k: v for k, v in q.items() if v is not None}
+    with urllib.request.urlopen(f'{url}/query?{urllib.parse.urlencode(q)}') as r:
+        return pa.ipc.open_stream(r).read_pandas()
+
+if __name__ == '__main__':
+    from characteristics import ap_characteristics
+    if not os.path.exists(store_file()):
+        data_dir = '/Volumes/Seagate/asset_pricing_data'
+        db = ap_characteristics(data_dir)
+        build_store(db.panel_est())
+
+    store = ap_store()
+    server = make_server(store)
+    print(f'Serving on http://{server.server_address[0]}:{server.server_port}')
+    server.serve_forever()
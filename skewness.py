@@ -20,6 +20,10 @@ import pandas as pd
 import numpy as np
 import time
 import os
+from panel import kway_join
+from trading_calendar import ap_calendar
+from memo import memoize, query, source
+from wrds_fetch import fetch
 
 class ap_skew:
     def __init__(self):
@@ -30,16 +34,17 @@ class ap_skew:
         conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
         # Extract CRSP daily data
-        dsf = conn.raw_sql("""
+        dsf, dsf_key = query(conn, """
             select a.permno, a.date, a.ret
             from crsp.dsf a left join crsp.msenames b
                 on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
             where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
-        """, date_cols=['date'])
+        """, fetch,
+            date_cols=['date'])
 
         # Extract factor data
         # Data is available from 1926-07-01
-        mktrf = conn.raw_sql("""
+        mktrf, mktrf_key = query(conn, """
             select date, mktrf, rf
             from ff.factors_daily
             order by date
@@ -52,8 +57,14 @@ class ap_skew:
         dsf = dsf.drop_duplicates(['permno', 'date'], keep='last')
         dsf.loc[dsf['ret']<=-1, 'ret'] = np.nan
         dsf['permno'] = dsf['permno'].astype(int)
-        self.dsf = dsf.copy()
-        self.mktrf = mktrf.copy()
+        # Trading-day index of each daily row: factors are attached by
+        # take instead of merging on date
+        self.cal = ap_calendar(mktrf['date'])
+        self.cal.add(mktrf, ['mktrf', 'rf'])
+        dsf['d'] = self.cal.day_index(dsf['date'])
+        self.dsf = dsf
+        self.mktrf = mktrf
+        source(self, dsf=(dsf_key, mktrf_key), mktrf=mktrf_key)
 
         end_time = time.time()
         print(f'Time used (clean): {(end_time-start_time)/60: 3.1f} seconds\n')
@@ -68,19 +79,22 @@ class ap_skew:
         res = ((x-np.mean(x)) @ (y-np.mean(y))) / (len(x) - 1)
         return res
 
+    @memoize('dsf', 'mktrf')
     def skew_est(self):
         start_time = time.time()
-        df = self.dsf.merge(self.mktrf, how='inner', on='date')
-
-        df['retx'] = df['ret'] - df['rf']
-        del df['ret']
-        df['yyyymm'] = df['date'].dt.year * 100 + df['date'].dt.month
+        # Days in the factor data only, the same as an inner merge on date
+        df = self.dsf.query('d>=0')
+        d = df['d'].to_numpy()
+        df['mktrf'] = self.cal.take('mktrf', d)
+        df['retx'] = df['ret'] - self.cal.take('rf', d)
+        df['yyyymm'] = self.cal.yyyymm[d]
+        df = df.drop(columns=['ret', 'd'])
         df = df.dropna()
         df['n_day'] = (df.groupby(['permno', 'yyyymm'])
             ['retx'].transform('count'))
         df['std'] = df.groupby(['permno', 'yyyymm'])['retx'].transform('std')
         # Require at least 15 days
-        df = df.query('n_day>=15 & std>0').copy()
+        df = df.query('n_day>=15 & std>0')
         covar = (df.groupby(['permno', 'yyyymm'])
             .apply(self.cov_m).to_frame('covar'))
         var = df.groupby(['permno', 'yyyymm'])['mktrf'].var().to_frame('var')
@@ -92,7 +106,7 @@ class ap_skew:
             .join(x_bar, how='inner').reset_index())
         b['b'] = b['covar'] / b['var']
         b['a'] = b['y_bar'] - (b['b']*b['x_bar'])
-        b = b[['permno','yyyymm', 'a', 'b']].copy()
+        b = b[['permno','yyyymm', 'a', 'b']]
 
         # Residual
         df = df.merge(b, how='inner', on=['permno', 'yyyymm'])
@@ -100,7 +114,7 @@ class ap_skew:
         # Idiosyncratic skewness
         iskew = (df.groupby(['permno', 'yyyymm'])['e']
             .skew().to_frame('iskew').reset_index())
-        iskew = iskew.query('iskew==iskew').copy()
+        iskew = iskew.query('iskew==iskew')
         # Coskewness
         df['mktrf_dm'] = (df.groupby(['permno', 'yyyymm'])['mktrf']
             .transform(lambda x: x-x.mean()))
@@ -115,9 +129,8 @@ class ap_skew:
         df = e_mktrf_dm2.join(e2, how='inner').join(mktrf_dm2, how='inner')
         df = df.reset_index()
         df['coskew'] = df['e_mktrf_dm2'] / (np.sqrt(df['e2'])*df['mktrf_dm2'])
-        df = df.query('coskew==coskew')[['permno', 'yyyymm', 'coskew']].copy()
-        df = df.merge(iskew, how='outer', on=['permno', 'yyyymm'])
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        df = df.query('coskew==coskew')[['permno', 'yyyymm', 'coskew']]
+        df = kway_join([df, iskew])
 
         end_time = time.time()
         print(f'--------- Skewness ---------')
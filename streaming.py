@@ -0,0 +1,346 @@
+# ------------------------------------------------------------------
+#                   Streaming monthly estimation
+#
+# ap_stream consumes the daily panel in date order, one day or one block
+# of rows at a time (e.g. the chunks of fetch_chunks), and keeps online
+# state for the stocks that trade in the current month only:
+#
+# ap_moments: power sums of shifted daily values (the shift is the first
+# observation of the stock in the month, so constant returns have
+# exactly zero variance). Central moments and co-moments up to order 3
+# are derived from them at month end. Blocks are merged by addition.
+# ap_topk: k largest daily returns and the number of returns equal to
+# the k-th largest one (ties of rank(method='min'))
+#
+# When the first row of a later month arrives, the current month is
+# closed: its characteristics are returned and the state is freed.
+# Memory depends on the number of stocks in a month, not on the length
+# of the history. flush adds the rows held back and closes the last
+# month.
+#
+# Characteristics, the same as the batch estimators (at least 15 days):
+# tvol: tvol_est in total_volatility.py
+# mdr1 to mdrk: maxret_all in max_daily_return.py
+# iskew, coskew: skew_est in skewness.py
+# ivol_capm, ivol_ff3: ivol_est in idiosyncratic_volatility.py
+#
+# Factors (mktrf, smb, hml, rf) are taken from the trading calendar.
+# Rows of days that are not in the calendar are used by tvol and mdr
+# only. Rows of the last date of a block are held back until the next
+# block (or flush), so duplicated (permno, date) rows are removed (last
+# row kept) even if they straddle two blocks. Blocks should be in date
+# order across rows, not only across months.
+#
+# Example
+# cal = ap_calendar(ff3['date'])
+# cal.add(ff3, ['mktrf', 'smb', 'hml', 'rf'])
+# st = ap_stream(cal)
+# for df in st.run(blocks):    # blocks: permno, date, ret in date order
+#     ...
+# ------------------------------------------------------------------
+
+import wrds
+import configparser as cp
+import pandas as pd
+import numpy as np
+import itertools
+import os
+import time
+from panel import sort_panel
+from trading_calendar import ap_calendar
+from rolling import topk_mean
+from wrds_fetch import fetch_chunks
+
+models = {'capm': ['mktrf'], 'ff3': ['mktrf', 'smb', 'hml']}
+
+# Grow per-stock state to at least n rows
+def grow(x, n, fill=0):
+    if n <= len(x):
+        return x
+
+    y = np.full((max(n, 2*len(x)),)+x.shape[1:], fill, dtype=x.dtype)
+    y[:len(x)] = x
+    return y
+
+class ap_moments:
+    def __init__(self, p, order=2, size=1024):
+        self.p = p
+        self.order = order
+        self.n = np.zeros(size)
+        self.shift = np.zeros((size, p))
+        self.s1 = np.zeros((size, p))
+        self.s2 = np.zeros((size, p, p))
+        self.s3 = np.zeros((size, p, p, p)) if order == 3 else None
+
+    def reserve(self, size):
+        for i in ['n', 'shift', 's1', 's2', 's3']:
+            if getattr(self, i) is not None:
+                setattr(self, i, grow(getattr(self, i), size))
+
+    # z: rows x p values of the stocks in slot
+    def update(self, slot, z):
+        if len(slot) == 0:
+            return
+
+        u, first, inv = np.unique(slot, return_index=True, return_inverse=True)
+        new = self.n[u] == 0
+        self.shift[u[new]] = z[first[new]]
+        dz = z - self.shift[slot]
+        m = len(u)
+        self.n[u] += np.bincount(inv, minlength=m)
+        for i in range(self.p):
+            self.s1[u, i] += np.bincount(inv, dz[:, i], m)
+            for j in range(i, self.p):
+                x = np.bincount(inv, dz[:, i]*dz[:, j], m)
+                for a, b in set(itertools.permutations((i, j))):
+                    self.s2[u, a, b] += x
+
+                if self.order < 3:
+                    continue
+
+                for l in range(j, self.p):
+                    x = np.bincount(inv, dz[:, i]*dz[:, j]*dz[:, l], m)
+                    for a, b, c in set(itertools.permutations((i, j, l))):
+                        self.s3[u, a, b, c] += x
+
+    # Number of rows and central sums of products of the first m stocks
+    def central(self, m):
+        n = self.n[:m]
+        s2 = self.s2[:m]
+        a = self.s1[:m] / np.where(n>0, n, np.nan)[:, None]
+        c2 = s2 - n[:, None, None]*a[:, :, None]*a[:, None, :]
+        if self.order < 3:
+            return n, c2, None
+
+        c3 = (self.s3[:m] - np.einsum('si,sjl->sijl', a, s2)
+            - np.einsum('sj,sil->sijl', a, s2) - np.einsum('sl,sij->sijl', a, s2)
+            + 2*n[:, None, None, None]*np.einsum('si,sj,sl->sijl', a, a, a))
+        return n, c2, c3
+
+class ap_topk:
+    def __init__(self, k, size=1024):
+        self.k = k
+        self.top = np.full((size, k), -np.inf)
+        self.tie = np.zeros(size, dtype=np.int64)
+
+    def reserve(self, size):
+        self.top = grow(self.top, size, -np.inf)
+        self.tie = grow(self.tie, size)
+
+    def update(self, slot, x):
+        if len(slot) == 0:
+            return
+
+        # New returns of each stock as one row of a matrix
+        u, inv = np.unique(slot, return_inverse=True)
+        order = np.argsort(inv, kind='stable')
+        cnt = np.bincount(inv)
+        within = np.arange(len(inv)) - (np.cumsum(cnt)-cnt)[inv[order]]
+        new = np.full((len(u), cnt.max()), -np.inf)
+        new[inv[order], within] = x[order]
+
+        old = self.top[u]
+        top = -np.sort(-np.hstack([old, new]), axis=1)[:, :self.k]
+        v = top[:, [-1]]
+        # All old returns equal to the new k-th largest are in the old
+        # top k unless it is the old k-th largest
+        n_old = np.where(v[:, 0]==old[:, -1], self.tie[u], (old==v).sum(axis=1))
+        tie = n_old + (new==v).sum(axis=1)
+        self.top[u] = top
+        self.tie[u] = np.where(np.isfinite(v[:, 0]), tie, 0)
+
+    # mdr1 to mdrk of the first m stocks
+    def mean(self, m):
+        return topk_mean(self.top[:m], self.tie[:m])
+
+class ap_stream:
+    def __init__(self, cal, k=5, min_n=15):
+        self.cal = cal
+        self.k = k
+        self.min_n = min_n
+        self.yyyymm = None
+        self.pending = None
+        self.reset()
+
+    # State of the stocks in the current month
+    def reset(self):
+        self.live = pd.Index([], dtype=np.int64)
+        self.ret = ap_moments(1)
+        self.top = ap_topk(self.k)
+        # (retx, factors) of each model, up to order 3 for skewness
+        self.reg = {i: ap_moments(len(j)+1, 3 if i=='capm' else 2)
+            for i, j in models.items()}
+
+    def state(self):
+        return [self.ret, self.top] + list(self.reg.values())
+
+    # Slot of each permno, new stocks are appended
+    def slots(self, permno):
+        i = self.live.get_indexer(permno)
+        if (i<0).any():
+            self.live = self.live.append(pd.Index(pd.unique(permno[i<0])))
+            for s in self.state():
+                s.reserve(len(self.live))
+
+            i = self.live.get_indexer(permno)
+
+        return i
+
+    def add(self, df):
+        df = df.drop_duplicates(['permno', 'date'], keep='last')
+        r = df['ret'].to_numpy(dtype=float)
+        ok = r > -1
+        r = r[ok]
+        slot = self.slots(df['permno'].to_numpy(dtype=np.int64)[ok])
+        d = self.cal.day_index(df['date'].to_numpy()[ok])
+        self.ret.update(slot, r[:, None])
+        self.top.update(slot, r)
+        for name, factors in models.items():
+            z = np.column_stack([r-self.cal.take('rf', d)]
+                + [self.cal.take(i, d) for i in factors])
+            ok = ~np.isnan(z).any(axis=1)
+            self.reg[name].update(slot[ok], z[ok])
+
+    # Rows of one block: permno, date, ret. Returns the months that are
+    # closed by the block
+    def update(self, block):
+        if len(block) == 0:
+            return []
+
+        if self.pending is not None:
+            if block['date'].min() < self.pending['date'].iloc[0]:
+                raise ValueError('daily data should be in date order')
+
+            block = pd.concat([self.pending, block], ignore_index=True)
+
+        # Rows of the last date may continue in the next block
+        last = (block['date'] == block['date'].max()).to_numpy()
+        self.pending = block[last]
+        return self.months(block[~last])
+
+    def months(self, block):
+        date = pd.DatetimeIndex(block['date'])
+        ym = (date.year*100 + date.month).to_numpy()
+        res = []
+        for m in np.unique(ym):
+            if self.yyyymm is not None and m < self.yyyymm:
+                raise ValueError('daily data should be in date order')
+
+            if self.yyyymm is not None and m > self.yyyymm:
+                df = self.close()
+                if df is not None:
+                    res.append(df)
+
+            self.yyyymm = m
+            self.add(block[ym==m])
+
+        return res
+
+    # Add the rows held back and close the last month
+    def flush(self):
+        res = []
+        if self.pending is not None:
+            res = self.months(self.pending)
+            self.pending = None
+
+        df = self.close()
+        if df is not None:
+            res.append(df)
+
+        return res
+
+    # Characteristics of the current month and free the state
+    def close(self):
+        m = len(self.live)
+        if m == 0:
+            return None
+
+        df = pd.DataFrame({'permno': self.live.to_numpy(),
+            'yyyymm': self.yyyymm})
+        # Require at least 15 days in a month
+        n, c2, _ = self.ret.central(m)
+        ok = n >= self.min_n
+        df['tvol'] = np.where(ok, np.sqrt(c2[:, 0, 0]/np.maximum(n-1, 1)),
+            np.nan)
+        mdr = self.top.mean(m)
+        for i in range(self.k):
+            df['mdr'+str(i+1)] = np.where(ok, mdr[:, i], np.nan)
+
+        # Skewness: residual e = u - b*v of the demeaned excess return u on
+        # the demeaned market excess return v
+        n, c2, c3 = self.reg['capm'].central(m)
+        ok = (n>=self.min_n) & (c2[:, 0, 0]>0)
+        n, c2, c3 = n[ok], c2[ok], c3[ok]
+        b = c2[:, 0, 1] / c2[:, 1, 1]
+        e2 = c2[:, 0, 0] - b*c2[:, 0, 1]
+        e3 = (c3[:, 0, 0, 0] - 3*b*c3[:, 0, 0, 1] + 3*b**2*c3[:, 0, 1, 1]
+            - b**3*c3[:, 1, 1, 1])
+        ev2 = c3[:, 0, 1, 1] - b*c3[:, 1, 1, 1]
+        pos = e2 > 0
+        e2 = np.where(pos, e2, np.nan)
+        # Adjusted for bias as pandas skew, which is 0 if e2 is 0
+        iskew = np.sqrt(n*(n-1))/(n-2) * (e3/n) / (e2/n)**1.5
+        df['iskew'] = np.nan
+        df.loc[ok, 'iskew'] = np.where(pos, iskew, 0)
+        df['coskew'] = np.nan
+        df.loc[ok, 'coskew'] = (ev2/n) / (np.sqrt(e2/n)*c2[:, 1, 1]/n)
+
+        # Idiosyncratic volatility: std of residuals (n-1 as pandas std)
+        for name in models:
+            n, c2, _ = self.reg[name].central(m)
+            ok = (n>=self.min_n) & (c2[:, 0, 0]>0)
+            n, c2 = n[ok], c2[ok]
+            cxy = c2[:, 1:, 0]
+            b = (np.linalg.pinv(c2[:, 1:, 1:]) @ cxy[:, :, None])[:, :, 0]
+            sse = np.maximum(c2[:, 0, 0] - (cxy*b).sum(axis=1), 0)
+            df['ivol_'+name] = np.nan
+            df.loc[ok, 'ivol_'+name] = np.sqrt(sse/(n-1))
+
+        chars = [i for i in df.columns if i not in ['permno', 'yyyymm']]
+        df = df.dropna(subset=chars, how='all')
+        df = df.sort_values('permno', ignore_index=True)
+        self.reset()
+        return df
+
+    def run(self, blocks):
+        for block in blocks:
+            yield from self.update(block)
+
+        yield from self.flush()
+
+if __name__ == '__main__':
+    start_time = time.time()
+    pass_dir = '~/.pass'
+    cfg = cp.ConfigParser()
+    cfg.read(os.path.join(os.path.expanduser(pass_dir), 'credentials.cfg'))
+    conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
+
+    ff3 = conn.raw_sql("""
+        select date, mktrf, smb, hml, rf
+        from ff.factors_daily
+        order by date
+    """, date_cols=['date'])
+    cal = ap_calendar(ff3['date'])
+    cal.add(ff3, ['mktrf', 'smb', 'hml', 'rf'])
+
+    # CRSP daily data in date order, one chunk at a time
+    blocks = fetch_chunks(conn, """
+        select a.permno, a.date, a.ret
+        from crsp.dsf a left join crsp.msenames b
+            on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
+        where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
+        order by a.date, a.permno
+    """, date_cols=['date'])
+
+    st = ap_stream(cal)
+    df = pd.concat(st.run(blocks), ignore_index=True)
+    df = sort_panel(df, ['permno', 'yyyymm'])
+
+    end_time = time.time()
+    print('\n--------- Streaming estimation ---------')
+    print(f'Obs: {len(df)}')
+    print(f'Time used: {(end_time-start_time)/60: 3.1f} mins\n')
+
+    data_dir = '/Volumes/Seagate/asset_pricing_data'
+    df.to_csv(os.path.join(data_dir, 'stream.txt'), sep='\t', index=False)
+    print('Done: data is generated')
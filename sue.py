@@ -54,10 +54,12 @@ import configparser as cp
 import pandas as pd
 import numpy as np
 from datetime import timedelta
-from dateutil import relativedelta
 import os
 import time
 import warnings
+from panel import sort_panel
+from memo import memoize, query, source
+from revision import ap_revision
 
 warnings.filterwarnings('ignore', category=pd.errors.PerformanceWarning)
 
@@ -71,7 +73,7 @@ class ap_sue:
 
         # Extract CRSP daily data
         # Start from fiscal year 1962
-        fundq = conn.raw_sql("""
+        fundq, fundq_key = query(conn, """
             select gvkey, datadate, fyearq, fqtr, rdq,
                 epspxq, saleq, cshprq, ajexq
             from comp.fundq
@@ -81,8 +83,7 @@ class ap_sue:
         """, date_cols=['datadate', 'rdq'])
 
         # Keep the most recent one for each fiscal quarter
-        fundq = fundq.sort_values(['gvkey', 'fyearq', 'fqtr', 'datadate'],
-            ignore_index=True)
+        fundq = sort_panel(fundq, ['gvkey', 'fyearq', 'fqtr', 'datadate'])
         fundq = fundq.drop_duplicates(['gvkey', 'fyearq', 'fqtr'], keep='last')
         # split-adjusted EPS
         fundq.loc[fundq['ajexq']<=0, 'ajexq'] = np.nan
@@ -101,18 +102,20 @@ class ap_sue:
         fundq['date'] = fundq['datadate'] + pd.offsets.MonthEnd(0)
         fundq['date'] = fundq['date'] + pd.offsets.MonthEnd(3)
         # Generate quarter index to control quarter gaps later
-        qidx = fundq[['fyearq', 'fqtr']].copy()
-        qidx = qidx.drop_duplicates(['fyearq', 'fqtr']).copy()
-        qidx = qidx.sort_values(['fyearq', 'fqtr'], ignore_index=True)
+        qidx = fundq[['fyearq', 'fqtr']]
+        qidx = qidx.drop_duplicates(['fyearq', 'fqtr'])
+        qidx = sort_panel(qidx, ['fyearq', 'fqtr'])
         qidx['qidx'] = qidx.index + 1
 
         fundq = fundq.merge(qidx, how='left', on=['fyearq', 'fqtr'])
-        fundq = fundq[['gvkey', 'date', 'eps', 'rps', 'qidx', 'datadate']]
-        fundq = fundq.sort_values(['gvkey', 'datadate'], ignore_index=True)
-        self.fundq = fundq.copy()
+        # rdq is kept for earnings announcement events (event_study.py)
+        fundq = fundq[['gvkey', 'date', 'eps', 'rps', 'qidx', 'datadate',
+            'rdq']]
+        fundq = sort_panel(fundq, ['gvkey', 'datadate'])
+        self.fundq = fundq
 
        # PERMNO-GVKEY link for common shares in NYSE/AMEX/NASDAQ
-        permno_gvkey = conn.raw_sql("""
+        permno_gvkey, permno_gvkey_key = query(conn, """
             select distinct a.permno, b.gvkey, c.namedt, c.nameendt
             from crsp.msenames a
             inner join comp.security b on a.ncusip=substring(b.cusip, 1, 8)
@@ -124,7 +127,8 @@ class ap_sue:
         """, date_cols=['namedt', 'nameendt'])
 
         permno_gvkey['permno'] = permno_gvkey['permno'].astype(int)
-        self.permno_gvkey = permno_gvkey.copy()
+        self.permno_gvkey = permno_gvkey
+        source(self, fundq=fundq_key, permno_gvkey=permno_gvkey_key)
 
         end_time = time.time()
         print('\n--------- Extract data from WRDS ---------')
@@ -132,66 +136,100 @@ class ap_sue:
         print(f'Percent (rdq>datadate+90): {obs90/len(fundq): 3.2%}')
         print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
 
-    def sue_est(self, var, name):
+    # var_list: list of (variable, name), e.g. [('eps', 'sue'), ('rps', 'sur')]
+    # Lags, gap controls and rolling std are computed for all variables as
+    # columns of one frame, which is then expanded and linked once
+    @memoize('fundq', 'permno_gvkey')
+    def sue_multi_est(self, var_list):
         start_time = time.time()
-        df = self.fundq.copy()
-
-        df = df.sort_values(['gvkey', 'qidx'], ignore_index=True)
-        df['l4'+var] = df.groupby(['gvkey'])[var].shift(4)
-        df['l4qidx'] = df.groupby(['gvkey'])['qidx'].shift(4)
-        df['qgap'] = df['qidx'] - df['l4qidx']
+        df = self.fundq.copy(deep=False)
+        var_cols = [i for i, j in var_list]
+        name_list = [j for i, j in var_list]
+        diff_list = [i+'_diff' for i in var_cols]
+        std_list = [i+'_diff_std' for i in var_cols]
+
+        df = sort_panel(df, ['gvkey', 'qidx'])
+        l4 = df.groupby(['gvkey'])[var_cols+['qidx']].shift(4)
+        df['qgap'] = df['qidx'] - l4['qidx']
         # 4 quarters lag info is set to missing if the quarter gap is not 4
-        df.loc[df['qgap']!=4, 'l4'+var] = np.nan
-        df[var+'_diff'] = df[var] - df['l4'+var]
-        df = df.sort_values(['gvkey', 'qidx'], ignore_index=True)
+        l4.loc[df['qgap']!=4, var_cols] = np.nan
+        df[diff_list] = df[var_cols].to_numpy() - l4[var_cols].to_numpy()
         # Use difference in past 8 quarters and require at least 6 quarters
-        df[var+'_diff_std'] = (df.groupby('gvkey')[var+'_diff']
-            .rolling(window=8, min_periods=6).std().reset_index(drop=True))
+        df[std_list] = (df.groupby('gvkey')[diff_list]
+            .rolling(window=8, min_periods=6).std().reset_index(drop=True)
+            .to_numpy())
         df['l7qidx'] = df.groupby(['gvkey'])['qidx'].shift(7)
         df['qgap'] = df['qidx'] - df['l7qidx']
-        df.loc[df[var+'_diff_std']<=0, var+'_diff_std'] = np.nan
-        # Set to missing if outside past 8 quarters
-        df.loc[df['qgap']!=7, var+'_diff_std'] = np.nan
-        df[name] = df[var+'_diff'] / df[var+'_diff_std']
-        df = df[['gvkey', 'date', 'datadate', name]].copy()
+        for var, name in var_list:
+            df.loc[df[var+'_diff_std']<=0, var+'_diff_std'] = np.nan
+            # Set to missing if outside past 8 quarters
+            df.loc[df['qgap']!=7, var+'_diff_std'] = np.nan
+            df[name] = df[var+'_diff'] / df[var+'_diff_std']
+
+        df = df[['gvkey', 'date', 'datadate']+name_list]
 
         # Expand data to distibute surprise to monthly frequence
         df = pd.concat([df]*3, ignore_index=True)
         df['month_gap'] = (df.groupby(['gvkey', 'date'])
             ['date'].cumcount())
-        df = df.sort_values(['gvkey', 'date', 'month_gap'], ignore_index=True)
-        df['month_gap'] = (df['month_gap']
-            .apply(lambda x: relativedelta.relativedelta(months=x)))
-        df['date'] = df['date'] + df['month_gap'] + pd.offsets.MonthEnd(0)
+        df = sort_panel(df, ['gvkey', 'date', 'month_gap'])
+        # Month end of date plus month_gap months
+        m = (df['date'].to_numpy().astype('datetime64[M]')
+            + df['month_gap'].to_numpy())
+        df['date'] = ((m+1).astype('datetime64[D]') - np.timedelta64(1, 'D'))
+        df['date'] = df['date'].astype('datetime64[ns]')
         del df['month_gap']
-        df = df.sort_values(['gvkey', 'date', 'datadate'], ignore_index=True)
-        df = df.drop_duplicates(['gvkey', 'date'], keep='last').copy()
+        df = sort_panel(df, ['gvkey', 'date', 'datadate'])
+        df = df.drop_duplicates(['gvkey', 'date'], keep='last')
         df['yyyymm'] = df['date'].dt.year*100 + df['date'].dt.month
         # Get PERMNO to SUE data with date range condition
         # TODO: use CRSP-Compustat Merged data if available
         df = df.merge(self.permno_gvkey, how='left', on='gvkey')
-        df = df.query('namedt<=datadate<=nameendt').copy()
-        df = df[['permno', 'yyyymm', name, 'gvkey', 'datadate']]
-        df = df.sort_values(['permno', 'yyyymm', 'datadate'], ignore_index=True)
-        df = df.drop_duplicates(['permno', 'yyyymm'], keep='last').copy()
+        df = df.query('namedt<=datadate<=nameendt')
+        df = df[['permno', 'yyyymm']+name_list+['gvkey', 'datadate']]
+        df = sort_panel(df, ['permno', 'yyyymm', 'datadate'])
+        df = df.drop_duplicates(['permno', 'yyyymm'], keep='last')
         df['permno'] = df['permno'].astype('int')
         # Obs are too small before 196409
-        df = df[(df[name].notna()) & (df['yyyymm']>=196409)].copy()
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        df = df[(df[name_list].notna().any(axis=1))
+            & (df['yyyymm']>=196409)]
+        df = sort_panel(df, ['permno', 'yyyymm'])
 
         end_time = time.time()
-        print(f'--------- {name.upper()} estimation ---------')
+        print(f'--------- {", ".join(name_list).upper()} estimation ---------')
         print(f'Obs: {len(df)}')
         print(f'Time used: {(end_time-start_time)/60: 3.1f} mins')
         return df
 
+    def sue_est(self, var, name):
+        return self.sue_multi_est([(var, name)])
+
+    # Earnings announcement events: permno, gvkey, datadate, rdq
+    # The link is valid on the announcement date
+    def events(self):
+        df = self.fundq.dropna(subset=['rdq'])[['gvkey', 'datadate', 'rdq']]
+        df = df.merge(self.permno_gvkey, how='inner', on='gvkey')
+        df = df.query('namedt<=rdq<=nameendt')
+        df = df[['permno', 'gvkey', 'datadate', 'rdq']]
+        df['permno'] = df['permno'].astype('int')
+        df = sort_panel(df, ['permno', 'rdq', 'datadate'])
+        df = df.drop_duplicates(['permno', 'rdq'], keep='last')
+        return df.reset_index(drop=True)
+
 if __name__ == '__main__':
     db = ap_sue()
-    sue = db.sue_est('eps', 'sue')
-    sue = sue.sort_values(['permno', 'yyyymm'], ignore_index=True)
-    sur = db.sue_est('rps', 'sur')
-    sur = sur.sort_values(['permno', 'yyyymm'], ignore_index=True)
+    # Recompute the permno whose Compustat data or link is revised
+    rev = ap_revision('sue')
+    scope = rev.scope(db, {'fundq': 'gvkey', 'permno_gvkey': 'gvkey'},
+        link='permno_gvkey')
+    df = rev.estimate(db, 'sue_multi_est', scope,
+        [('eps', 'sue'), ('rps', 'sur')])
+    sue = (df.query('sue==sue')[['permno', 'yyyymm', 'sue', 'gvkey',
+        'datadate']].reset_index(drop=True))
+    sur = (df.query('sur==sur')[['permno', 'yyyymm', 'sur', 'gvkey',
+        'datadate']].reset_index(drop=True))
     data_dir = '/Volumes/Seagate/asset_pricing_data'
     sue.to_csv(os.path.join(data_dir, 'sue.txt'), sep='\t', index=False)
     sur.to_csv(os.path.join(data_dir, 'sur.txt'), sep='\t', index=False)
+    rev.commit()
     print('Done: data is generated')
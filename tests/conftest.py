@@ -0,0 +1,11 @@
+# Tests run from the repository root: python -m pytest tests
+# The result cache is turned off and checkpoints go to a temporary
+# directory, so tests never read the outputs of earlier runs
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['AP_CACHE_SIZE'] = '0'
+os.environ['AP_CHECKPOINT_DIR'] = tempfile.mkdtemp()
@@ -0,0 +1,115 @@
+# Monthly consensus of ap_ibes_detail against a month-end loop over the
+# estimates of each analyst, for any split of the detail file into chunks
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('wrds')
+from analysts import ap_ibes_detail
+
+def detail(seed=0):
+    rng = np.random.default_rng(seed)
+    fpe = pd.to_datetime(['2000-12-31', '2001-12-31', '2002-12-31'])
+    rows = []
+    for t in ['AAA', 'BBB', 'CCC', 'DDD', 'EEE']:
+        for a in range(rng.integers(1, 5)):
+            for f in fpe:
+                # Estimates from 500 days before to 10 days after the
+                # period end, one a day at most
+                days = np.sort(rng.choice(np.arange(-500, 10),
+                    rng.integers(1, 8), replace=False))
+                for x in days:
+                    rows.append((t, a, f, f + pd.Timedelta(days=int(x))))
+
+    df = pd.DataFrame(rows, columns=['ticker', 'analys', 'fpedats',
+        'anndats'])
+    # Values on a grid, so some revisions are unchanged
+    df['value'] = np.round(rng.normal(1, 0.2, len(df)), 1)
+    df.loc[rng.random(len(df))<0.02, 'value'] = 0
+    rev = df['anndats'] + pd.to_timedelta(rng.integers(0, 200, len(df)), 'D')
+    df['revdats'] = rev.where(rng.random(len(df))<0.8)
+    return df.sort_values(['ticker', 'anndats'], ignore_index=True)
+
+def brute(df, window, stale, horizon):
+    months = pd.date_range('1999-01-31', '2003-02-28', freq='ME')
+    res = []
+    for t, g in df.groupby('ticker'):
+        prev, prev_mean = {}, {}
+        for m in months:
+            cur = {}
+            for (a, f), h in g.groupby(['analys', 'fpedats']):
+                h = h[h['anndats']<=m]
+                if len(h) == 0 or m >= f:
+                    continue
+
+                x = h.iloc[-1]
+                if window is not None and m > x['anndats'] + pd.Timedelta(
+                    days=window):
+                    continue
+
+                r = x['anndats'] if pd.isna(x['revdats']) else max(
+                    x['revdats'], x['anndats'])
+                if stale is not None and m > r + pd.Timedelta(days=stale):
+                    continue
+
+                cur[(a, f)] = x['value']
+
+            if len(cur) > 0:
+                fy1 = min(f for a, f in cur)
+                cur = {k: v for k, v in cur.items() if k[1]==fy1}
+                if (fy1-m).days <= horizon:
+                    cur = {}
+
+            mean = {}
+            if len(cur) > 0:
+                v = np.array(list(cur.values()))
+                up = sum(v > prev[k] for k, v in cur.items() if k in prev)
+                down = sum(v < prev[k] for k, v in cur.items() if k in prev)
+                p = prev_mean.get(fy1, np.nan)
+                mean[fy1] = v.mean()
+                res.append((t, m, m.year*100+m.month, fy1, len(v), v.mean(),
+                    v.std(ddof=1) if len(v) > 1 else np.nan, up, down,
+                    (up-down)/len(v),
+                    np.nan if p == 0 else (v.mean()-p)/abs(p)))
+
+            prev, prev_mean = cur, mean
+
+    return pd.DataFrame(res, columns=['ticker', 'statpers', 'yyyymm',
+        'fpedats', 'numest', 'meanest', 'stdev', 'n_up', 'n_down', 'rev',
+        'fchg'])
+
+def compare(got, ref):
+    keys = ['ticker', 'yyyymm']
+    got = got.sort_values(keys, ignore_index=True)
+    ref = ref.sort_values(keys, ignore_index=True)
+    assert len(got) == len(ref) and len(ref) > 0
+    for i in ['ticker', 'yyyymm', 'numest', 'n_up', 'n_down']:
+        assert (got[i].to_numpy() == ref[i].to_numpy()).all(), i
+
+    for i in ['statpers', 'fpedats']:
+        assert (pd.DatetimeIndex(got[i]) == pd.DatetimeIndex(ref[i])).all(), i
+
+    for i in ['meanest', 'stdev', 'rev', 'fchg']:
+        assert np.allclose(got[i].to_numpy(dtype=float),
+            ref[i].to_numpy(dtype=float), rtol=1e-10, equal_nan=True), i
+
+@pytest.mark.parametrize('window,stale', [(None, None), (120, 60)])
+def test_detail(window, stale):
+    df = detail()
+    ref = brute(df, window, stale, 30)
+    assert (ref['n_up']>0).any() and (ref['n_down']>0).any()
+    assert ref['fchg'].notna().any()
+    # Rows without ticker come last in the ticker order
+    nulls = df.iloc[:3].assign(ticker=np.nan)
+    raw = pd.concat([df, nulls], ignore_index=True)
+    for size in [1, 7, 50, len(raw)]:
+        st = ap_ibes_detail(window, stale, 30)
+        res = []
+        for i in range(0, len(raw), size):
+            res += st.update(raw.iloc[i:i+size])
+            # Only the rows of the last ticker are carried
+            assert st.carry is None or st.carry['ticker'].nunique() <= 1
+            assert st.carry is None or st.carry['ticker'].notna().all()
+
+        res.append(st.flush())
+        compare(pd.concat(res, ignore_index=True), ref)
@@ -0,0 +1,84 @@
+# Portfolio returns against merges and group-bys of the panel. The
+# portfolio assignment is the one of the backtest (see
+# test_cross_section.py for the breakpoints)
+import numpy as np
+import pandas as pd
+import pytest
+from backtest import ap_backtest, month_index
+
+def panel(seed=0):
+    rng = np.random.default_rng(seed)
+    chars = pd.DataFrame({'permno': np.repeat(np.arange(10001, 10201), 36),
+        'yyyymm': np.tile([200001+i//12*100+i%12 for i in range(36)], 200)})
+    n = len(chars)
+    chars['nyse'] = (chars['permno']%3==0).astype(float)
+    chars['x1'] = rng.normal(0, 1, n)
+    chars['x2'] = np.round(rng.normal(0, 1, n), 1)
+    chars.loc[rng.random(n)<0.1, 'x1'] = np.nan
+    # Stocks that are missing in some months
+    chars = chars[rng.random(n)>0.05].reset_index(drop=True)
+    ret = chars[['permno', 'yyyymm']]
+    ret['ret'] = rng.normal(0.01, 0.1, len(ret))
+    ret['me'] = np.exp(rng.normal(5, 2, len(ret)))
+    ret.loc[rng.random(len(ret))<0.05, 'ret'] = np.nan
+    ret.loc[rng.random(len(ret))<0.05, 'me'] = np.nan
+    ret.loc[rng.random(len(ret))<0.02, 'me'] = 0
+    return chars, ret
+
+def shift(yyyymm, h):
+    m = month_index(yyyymm) + h
+    return (m//12)*100 + m%12 + 1
+
+def reference(chars, ret, port, c, q, lags):
+    r = ret.set_index(['permno', 'yyyymm'])
+    res = []
+    for h in lags:
+        df = chars[['permno', 'yyyymm']].assign(b=port[c].to_numpy())
+        df['t'] = shift(df['yyyymm'], h)
+        df['ret'] = r['ret'].reindex(list(zip(df['permno'], df['t']))).to_numpy()
+        df['w'] = r['me'].reindex(list(zip(df['permno'],
+            shift(df['yyyymm'], h-1)))).to_numpy()
+        df = df.dropna(subset=['b', 'ret'])
+        ew = df.groupby(['t', 'b'])['ret'].mean()
+        v = df[df['w']>0]
+        vw = ((v['w']*v['ret']).groupby([v['t'], v['b']]).sum()
+            / v.groupby(['t', 'b'])['w'].sum())
+        res.append(pd.DataFrame({'ew': ew, 'vw': vw}))
+
+    # Average of the overlapping portfolios of each month
+    df = pd.concat(res).groupby(level=[0, 1]).mean()
+    out = []
+    for k in ['ew', 'vw']:
+        x = df[k].unstack().reindex(columns=np.arange(1, q+1))
+        x.columns = [k+str(i) for i in range(1, q+1)]
+        x[k+'_hl'] = x[k+str(q)] - x[k+'1']
+        out.append(x)
+
+    df = pd.concat(out, axis=1).dropna(subset=['ew_hl', 'vw_hl'], how='all')
+    return df.rename_axis('yyyymm').reset_index()
+
+@pytest.mark.parametrize('q, nyse, wait, hold', [(10, None, 0, 1),
+    (5, 'nyse', 1, 3)])
+def test_port_ret(q, nyse, wait, hold):
+    chars, ret = panel()
+    bt = ap_backtest(chars, ret, ['x1', 'x2'], q=q, nyse=nyse, wait=wait,
+        hold=hold)
+    port = bt.port_ret()
+    for c in ['x1', 'x2']:
+        got = port[port['char']==c].drop(columns='char').reset_index(drop=True)
+        ref = reference(chars, ret, bt.port, c, q, bt.lags)
+        assert list(got.columns) == list(ref.columns)
+        assert (got['yyyymm'].to_numpy() == ref['yyyymm'].to_numpy()).all()
+        assert np.allclose(got.iloc[:, 1:].to_numpy(dtype=float),
+            ref.iloc[:, 1:].to_numpy(dtype=float), equal_nan=True)
+
+def test_summary():
+    chars, ret = panel()
+    bt = ap_backtest(chars, ret, ['x1'], q=5)
+    port = bt.port_ret()
+    table = bt.summary(port).set_index(['char', 'port'])
+    x = port['ew_hl'].dropna()
+    assert np.isclose(table.loc[('x1', 'ew_hl'), 'mean'], x.mean())
+    assert np.isclose(table.loc[('x1', 'ew_hl'), 't'],
+        x.mean()/(x.std()/np.sqrt(len(x))))
+    assert table.loc[('x1', 'ew_hl'), 'n'] == len(x)
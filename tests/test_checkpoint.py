@@ -0,0 +1,24 @@
+import pandas as pd
+from checkpoint import ap_checkpoint
+
+def test_checkpoint_key(tmp_path):
+    df = pd.DataFrame({'x': [1.0, 2.0]})
+    ckpt = ap_checkpoint('ivol', tmp_path, key=('dsf_v1', 'code_v1'))
+    ckpt.save('coef_capm/part', df)
+    ckpt.save('dsf', df)
+
+    # Same inputs and code: stages are resumed
+    ckpt = ap_checkpoint('ivol', tmp_path, key=('dsf_v1', 'code_v1'))
+    assert ckpt.has('dsf') and ckpt.has('coef_capm/part')
+    assert ckpt.load('dsf').equals(df)
+
+    # New data or code: stages of the old run are removed
+    ckpt = ap_checkpoint('ivol', tmp_path, key=('dsf_v2', 'code_v1'))
+    assert not ckpt.has('dsf') and not ckpt.has('coef_capm/part')
+    ckpt.save('dsf', df)
+    ckpt = ap_checkpoint('ivol', tmp_path, key=('dsf_v2', 'code_v2'))
+    assert not ckpt.has('dsf')
+
+    # Without a key stages are not checked
+    ckpt.save('dsf', df)
+    assert ap_checkpoint('ivol', tmp_path).has('dsf')
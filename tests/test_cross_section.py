@@ -0,0 +1,93 @@
+# Monthly statistics against pandas group-bys on a panel with ties,
+# missing values, a month with one stock and a month without NYSE stocks
+import numpy as np
+import pandas as pd
+import pytest
+from cross_section import ap_cross_section, nsi_scheme
+
+def panel(seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'permno': np.tile(np.arange(10001, 10101), 12),
+        'yyyymm': np.repeat([200001+i for i in range(12)], 100)})
+    n = len(df)
+    df['nyse'] = rng.random(n) < 0.4
+    df['x'] = rng.normal(0, 1, n)
+    # Ties
+    df['y'] = np.round(rng.normal(0, 1, n), 1)
+    # nsi: negative, zero and positive values
+    df['nsi'] = np.where(rng.random(n)<0.3, 0, rng.normal(0, 0.1, n))
+    for i in ['x', 'y', 'nsi']:
+        df.loc[rng.random(n)<0.1, i] = np.nan
+
+    df.loc[df['yyyymm']==200005, 'nyse'] = False
+    df = df[(df['yyyymm']!=200009) | (df['permno']==10001)]
+    # Rows out of order
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+def check(got, ref):
+    assert np.allclose(np.asarray(got, dtype=float),
+        np.asarray(ref, dtype=float), equal_nan=True)
+
+def test_winsorize_rank_zscore():
+    df = panel()
+    cs = ap_cross_section(df, ['x', 'y'])
+    g = df.groupby('yyyymm')
+    w, r, z = cs.winsorize(None, 0.05, 0.9), cs.rank(), cs.zscore()
+    for i in ['x', 'y']:
+        lo = g[i].transform(lambda s: s.quantile(0.05))
+        hi = g[i].transform(lambda s: s.quantile(0.9))
+        check(w[i], df[i].clip(lo, hi))
+        check(r[i], g[i].rank(pct=True))
+        check(z[i], (df[i]-g[i].transform('mean')) / g[i].transform('std'))
+
+    assert (w[['permno', 'yyyymm']] == df[['permno', 'yyyymm']]).all().all()
+
+def ref_breakpoints(df, char, q, nyse):
+    x = df[df['nyse']] if nyse else df
+    x = x.dropna(subset=[char])
+    bp = x.groupby('yyyymm')[char].quantile(np.arange(1, q)/q).unstack()
+    return bp.reindex(np.unique(df['yyyymm']))
+
+# Portfolio k+1 if the value is greater than the k-th breakpoint
+def ref_bucket(x, bp):
+    port = 1 + (x.to_numpy()[:, None] > bp.to_numpy()).sum(axis=1)
+    return np.where(x.isna() | bp.isna().all(axis=1).to_numpy(), np.nan, port)
+
+@pytest.mark.parametrize('nyse', [False, True])
+def test_breakpoints_bucket(nyse):
+    df = panel()
+    cs = ap_cross_section(df, ['x', 'y'], nyse='nyse')
+    port = cs.bucket(None, 5, nyse=nyse)
+    for i in ['x', 'y']:
+        bp = ref_breakpoints(df, i, 5, nyse)
+        check(cs.breakpoints(i, 5, nyse).set_index('yyyymm'), bp)
+        check(port[i], ref_bucket(df[i], bp.loc[df['yyyymm']]))
+
+    if nyse:
+        assert port.loc[df['yyyymm']==200005, ['x', 'y']].isna().all().all()
+
+# Missing exchange (e.g. from a left merge) is not NYSE
+@pytest.mark.parametrize('dtype', [float, 'boolean'])
+def test_nyse_missing(dtype):
+    df = panel()
+    miss = np.random.default_rng(1).random(len(df)) < 0.2
+    df['nyse_m'] = df['nyse'].astype(dtype)
+    df.loc[miss, 'nyse_m'] = None
+    df['nyse'] = df['nyse'] & ~miss
+    cs = ap_cross_section(df, ['x'], nyse='nyse_m')
+    check(cs.breakpoints('x', 5, True).set_index('yyyymm'),
+        ref_breakpoints(df, 'x', 5, True))
+
+@pytest.mark.parametrize('nyse', [False, True])
+def test_segment_bucket(nyse):
+    df = panel()
+    cs = ap_cross_section(df, ['nsi'], nyse='nyse')
+    port = cs.segment_bucket('nsi', nsi_scheme, nyse)['nsi']
+    ref = pd.Series(np.nan, index=df.index)
+    neg, pos = df[df['nsi']<0], df[df['nsi']>0]
+    ref[neg.index] = ref_bucket(neg['nsi'],
+        ref_breakpoints(neg, 'nsi', 2, nyse).loc[neg['yyyymm']])
+    ref[df['nsi']==0] = 3
+    ref[pos.index] = 3 + ref_bucket(pos['nsi'],
+        ref_breakpoints(pos, 'nsi', 7, nyse).loc[pos['yyyymm']])
+    check(port, ref)
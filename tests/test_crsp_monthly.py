@@ -0,0 +1,60 @@
+# Monthly data from daily data against compounding by hand
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('wrds')
+
+def daily(seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', '2000-06-30')
+    df = pd.DataFrame({'permno': np.repeat([10001, 10002], len(dates)),
+        'date': np.tile(dates, 2)})
+    n = len(df)
+    df['ret'] = rng.normal(0.001, 0.02, n)
+    df.loc[rng.random(n)<0.1, 'ret'] = np.nan
+    # Codes below -1 are not returns
+    df.loc[rng.random(n)<0.02, 'ret'] = -66
+    # Negative prices are bid-ask averages
+    df['prc'] = np.round(rng.random(n)*50+1, 2) * np.where(rng.random(n)<0.2,
+        -1, 1)
+    df['shrout'] = rng.integers(1000, 2000, n).astype(float)
+    ym = df['date'].dt.year*100 + df['date'].dt.month
+    df.loc[(df['permno']==10002) & (ym==200003), 'ret'] = np.nan
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+def test_msf_from_dsf():
+    from crsp_monthly import msf_from_dsf
+    dsf = daily()
+    msf = msf_from_dsf(dsf)
+    dsf['yyyymm'] = dsf['date'].dt.year*100 + dsf['date'].dt.month
+    keys = sorted(set(zip(dsf['permno'], dsf['yyyymm'])))
+    assert list(zip(msf['permno'], msf['yyyymm'])) == keys
+    for k, (p, ym) in enumerate(keys):
+        g = dsf[(dsf['permno']==p) & (dsf['yyyymm']==ym)].sort_values('date')
+        r = g['ret'][g['ret']>-1]
+        ret = np.prod(1+r.to_numpy()) - 1 if len(r) else np.nan
+        assert np.isclose(msf['ret'][k], ret, equal_nan=True)
+        assert msf['n_day'][k] == len(r)
+        assert msf['date'][k] == g['date'].iloc[-1]
+        assert msf['prc'][k] == abs(g['prc'].iloc[-1])
+        assert msf['shrout'][k] == g['shrout'].iloc[-1]
+
+    assert msf['ret'].isna().sum() == 1
+
+def test_msf_reconcile():
+    from crsp_monthly import msf_from_dsf, msf_reconcile
+    msf = msf_from_dsf(daily())
+    crsp = msf.drop(columns='n_day')
+    crsp.loc[3, 'ret'] += 0.01
+    crsp.loc[5, 'prc'] = np.nan
+    crsp = crsp.drop(index=7)
+    extra = crsp.iloc[[0]].assign(yyyymm=199912)
+    crsp = pd.concat([crsp, extra], ignore_index=True)
+    diff = msf_reconcile(msf, crsp)
+    got = set(zip(diff['permno'], diff['yyyymm'], diff['source']))
+    ref = {(msf['permno'][3], msf['yyyymm'][3], 'both'),
+        (msf['permno'][5], msf['yyyymm'][5], 'both'),
+        (msf['permno'][7], msf['yyyymm'][7], 'left_only'),
+        (extra['permno'][0], 199912, 'right_only')}
+    assert got == ref
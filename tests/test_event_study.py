@@ -0,0 +1,99 @@
+# car_est against a loop over events on a synthetic panel. Stocks start
+# and end within the calendar, so some windows are cut by the first or
+# last trading day of a stock
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('wrds')
+
+factors = {'market': [], 'capm': ['mktrf'], 'ff3': ['mktrf', 'smb', 'hml']}
+
+def setup(seed=0):
+    from trading_calendar import ap_calendar
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', periods=800)
+    ff3 = pd.DataFrame({'date': dates, 'rf': 1e-4})
+    for i in ['mktrf', 'smb', 'hml']:
+        ff3[i] = rng.normal(0, 0.01, len(dates))
+
+    cal = ap_calendar(dates)
+    cal.add(ff3, ['mktrf', 'smb', 'hml', 'rf'])
+    rows = []
+    for p in range(10001, 10021):
+        d = np.arange(rng.integers(0, 300), len(dates)-rng.integers(0, 300))
+        d = d[rng.random(len(d))>0.03]
+        ret = ff3['mktrf'].to_numpy()[d] + rng.normal(0, 0.02, len(d))
+        # Delisting codes below -1 are not returns
+        ret[rng.random(len(d))<0.01] = -66
+        rows.append(pd.DataFrame({'permno': p, 'date': dates[d], 'ret': ret}))
+
+    dsf = pd.concat(rows, ignore_index=True)
+    events = pd.DataFrame({'permno': rng.integers(10001, 10021, 400),
+        'rdq': dates[0] + pd.to_timedelta(rng.integers(0, 1150, 400), 'D')})
+    return dsf, ff3, cal, events
+
+# car and number of days with abnormal returns of one event
+# ret: day index to return of the stock, f: factors (days x columns)
+def brute(ret, f, d0, lo, hi, model, min_obs):
+    if d0 >= len(f):
+        return np.nan, 0
+
+    days = lambda a, b: [j for j in range(max(d0+a, 0), min(d0+b+1, len(f)))
+        if j in ret]
+    x = f[factors[model]].to_numpy()
+    coef = np.zeros(x.shape[1]+1)
+    if model != 'market':
+        t = days(-250, -31)
+        if len(t) < 100:
+            return np.nan, 0
+
+        y = np.array([ret[j] for j in t]) - f['rf'].to_numpy()[t]
+        coef = np.linalg.lstsq(np.c_[np.ones(len(t)), x[t]], y,
+            rcond=None)[0]
+
+    t = days(lo, hi)
+    ar = np.array([ret[j] for j in t]) - f['rf'].to_numpy()[t] - coef[0]
+    if model == 'market':
+        ar = ar - f['mktrf'].to_numpy()[t]
+    else:
+        ar = ar - x[t] @ coef[1:]
+
+    need = hi-lo+1 if min_obs is None else min_obs
+    return (ar.sum() if len(t)>=max(need, 1) else np.nan), len(t)
+
+@pytest.mark.parametrize('model', ['market', 'capm', 'ff3'])
+@pytest.mark.parametrize('min_obs', [None, 20])
+def test_car_est(model, min_obs):
+    from event_study import ap_event
+    dsf, ff3, cal, events = setup()
+    ev = ap_event(dsf, cal)
+    res = ev.car_est(events, [(-1, 1), (-2, 60)], model, min_obs=min_obs)
+    d = np.searchsorted(cal.date, dsf['date'].to_numpy())
+    ret = {}
+    for p, j, r in zip(dsf['permno'], d, dsf['ret']):
+        if r > -1:
+            ret.setdefault(p, {})[j] = r
+
+    d0 = np.searchsorted(cal.date, events['rdq'].to_numpy())
+    cut = 0
+    for k in range(len(events)):
+        for lo, hi, name in [(-1, 1, 'car_m1_p1'), (-2, 60, 'car_m2_p60')]:
+            car, n = brute(ret.get(events['permno'][k], {}), ff3, d0[k],
+                lo, hi, model, min_obs)
+            assert res['n_'+name][k] == n
+            assert np.isclose(res[name][k], car, atol=1e-10, equal_nan=True)
+            cut += 0 < n < hi-lo+1
+
+    # Some windows are cut and are missing with full coverage
+    assert cut > 0
+
+def test_abr_est():
+    from event_study import ap_event
+    dsf, ff3, cal, events = setup()
+    ev = ap_event(dsf, cal)
+    abr = ev.abr_est(events)
+    car = ev.car_est(events, [(-2, 1)])
+    assert not abr.duplicated(['permno', 'yyyymm']).any()
+    assert abr['abr'].notna().all()
+    assert abr['abr'].isin(car['car_m2_p1'].dropna()).all()
@@ -0,0 +1,83 @@
+# Low-rank covariance of ap_factor_cov against the dense matrix
+# B F B' + diag(sigma^2), with F the sample covariance of the daily
+# factor returns of the window
+import numpy as np
+import pandas as pd
+import pytest
+from factor_cov import ap_factor_cov
+
+factor_list = ['mktrf', 'smb', 'hml']
+
+def data(seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', '2001-02-28')
+    factors = pd.DataFrame({'date': dates})
+    for i in factor_list:
+        factors[i] = rng.normal(0, 0.01, len(dates))
+
+    factors.loc[rng.random(len(dates))<0.05, 'smb'] = np.nan
+    months = [200011, 200012, 200101, 200102]
+    loadings = pd.DataFrame({'permno': np.tile(10000+np.arange(30), 4),
+        'yyyymm': np.repeat(months, 30)})
+    for i in range(3):
+        loadings['b'+str(i+1)] = rng.normal(1 if i == 0 else 0, 0.5,
+            len(loadings))
+
+    loadings['sigma'] = rng.random(len(loadings))*0.03 + 0.01
+    loadings.loc[rng.random(len(loadings))<0.1, 'b2'] = np.nan
+    # Loadings are not in month order
+    loadings = loadings.sample(frac=1, random_state=seed)
+    return loadings, factors, rng
+
+def reference(loadings, factors, yyyymm, window, shrink):
+    df = loadings.query(f'yyyymm=={yyyymm}').dropna()
+    df = df.sort_values('permno')
+    B = df[['b1', 'b2', 'b3']].to_numpy()
+    d = df['sigma'].to_numpy()**2
+    B = (1-shrink)*B + shrink*B.mean(axis=0)
+    d = (1-shrink)*d + shrink*d.mean()
+    f = factors.dropna()
+    fm = f['date'].dt.year*100 + f['date'].dt.month
+    months = np.unique(fm)
+    i = np.flatnonzero(months==yyyymm)[0]
+    x = f.loc[fm.isin(months[max(i-window+1, 0):i+1]), factor_list]
+    F = np.cov(x.to_numpy(), rowvar=False)
+    return df['permno'].to_numpy(), F, B @ F @ B.T + np.diag(d)
+
+@pytest.mark.parametrize('window,shrink', [(1, 0), (3, 0), (12, 0.3)])
+def test_factor_cov(window, shrink):
+    loadings, factors, rng = data()
+    fc = ap_factor_cov(loadings, factors, factor_list, window, shrink)
+    for yyyymm in [200011, 200102]:
+        permno, F, V = reference(loadings, factors, yyyymm, window, shrink)
+        v = fc.month(yyyymm)
+        assert (v.permno == permno).all() and len(v) == len(permno)
+        assert np.allclose(v.F, F, rtol=1e-10, atol=0)
+        assert np.allclose(v.dense(), V, rtol=1e-10, atol=0)
+
+        w = rng.normal(size=len(v))
+        assert np.allclose(v.matvec(w), V @ w, rtol=1e-10, atol=1e-16)
+        assert np.isclose(v.port_var(w), w @ V @ w, rtol=1e-10)
+        W = rng.normal(size=(len(v), 4))
+        assert np.allclose(v.port_var(W), np.einsum('np,nm,mp->p', W, V, W),
+            rtol=1e-10)
+
+def test_series_weight():
+    loadings, factors, rng = data()
+    v = ap_factor_cov(loadings, factors, factor_list, 3).month(200101)
+    permno, _, V = reference(loadings, factors, 200101, 3, 0)
+    # Shuffled, a permno twice, a permno not in the model and a permno
+    # of the model without weight
+    w = pd.Series(rng.normal(size=len(permno)), index=permno)
+    w = pd.concat([w.iloc[1:].sample(frac=1, random_state=1),
+        pd.Series([0.5, 2.0], index=[permno[3], 99999])])
+    x = np.array([w[w.index==i].sum() for i in permno])
+    assert x[0] == 0
+    assert np.allclose(v.matvec(w), V @ x, rtol=1e-10, atol=1e-16)
+    assert np.isclose(v.port_var(w), x @ V @ x, rtol=1e-10)
+
+def test_missing_month():
+    loadings, factors, _ = data()
+    fc = ap_factor_cov(loadings, factors, factor_list)
+    with pytest.raises(ValueError):
+        fc.month(200010)
@@ -0,0 +1,54 @@
+# Monthly coefficients against a least-squares regression of each month.
+# Months where a regressor is constant or collinear are dropped
+import numpy as np
+import pandas as pd
+from fama_macbeth import ap_fama_macbeth
+
+def panel(seed=0):
+    rng = np.random.default_rng(seed)
+    months = [200001+i for i in range(12)]
+    chars = pd.DataFrame({'permno': np.tile(np.arange(10001, 10061), 13),
+        'yyyymm': np.repeat(months+[200101], 60)})
+    n = len(chars)
+    chars['a'] = rng.normal(0, 1, n)
+    chars['b'] = rng.normal(0, 1, n)
+    # Large mean and small dispersion: not collinear with the intercept
+    chars['c'] = 100 + rng.normal(0, 0.1, n)
+    chars.loc[rng.random(n)<0.1, 'b'] = np.nan
+    ym = chars['yyyymm']
+    # Constant in 200003, collinear with a in 200005
+    chars.loc[ym==200003, 'b'] = 0.5
+    chars.loc[ym==200005, 'b'] = 2*chars['a'] + 3
+    # Fewer stocks than regressors in 200007
+    chars.loc[(ym==200007) & (chars['permno']>10002), 'a'] = np.nan
+    ret = chars[['permno', 'yyyymm']]
+    ret['ret'] = rng.normal(0, 0.1, n)
+    ret.loc[rng.random(n)<0.05, 'ret'] = np.nan
+    return chars, ret
+
+def test_monthly():
+    chars, ret = panel()
+    fm = ap_fama_macbeth(chars, ret)
+    x_var = ['a', 'b', 'c']
+    res = fm.monthly(x_var).set_index('yyyymm')
+    # Return of month t+1 on the row of month t
+    ym = ret['yyyymm']
+    nxt = ret.assign(yyyymm=np.where(ym%100==1, ym-89, ym-1))
+    df = chars.merge(nxt, how='left', on=['permno', 'yyyymm'])
+    for m, g in df.groupby('yyyymm'):
+        g = g.dropna(subset=x_var+['ret'])
+        X = np.c_[np.ones(len(g)), g[x_var].to_numpy()]
+        y = g['ret'].to_numpy()
+        if len(g) <= X.shape[1] or np.linalg.matrix_rank(X) < X.shape[1]:
+            assert m not in res.index
+            continue
+
+        b = np.linalg.lstsq(X, y, rcond=None)[0]
+        e = y - X@b
+        assert np.allclose(res.loc[m, ['const']+x_var], b, rtol=1e-6,
+            atol=1e-8)
+        assert np.isclose(res.loc[m, 'r2'], 1 - e@e/((y-y.mean())@(y-y.mean())))
+        assert res.loc[m, 'n'] == len(g)
+
+    assert not res.index.isin([200003, 200005, 200007]).any()
+    assert len(res) == 9
@@ -0,0 +1,107 @@
+import sys
+import types
+import pytest
+import memo
+
+def test_code_version_covers_helpers(monkeypatch):
+    import rolling
+    import trading_calendar
+    deps = memo.repo_modules('rolling')
+    assert deps == {'rolling'}
+
+    # A module that imports a helper function depends on its module
+    m = types.ModuleType('ap_test_estimator')
+    m.__file__ = memo.__file__.replace('memo.py', 'ap_test_estimator.py')
+    m.window_start = rolling.window_start
+    m.ap_calendar = trading_calendar.ap_calendar
+    monkeypatch.setitem(sys.modules, 'ap_test_estimator', m)
+    assert memo.repo_modules('ap_test_estimator') == {'ap_test_estimator',
+        'rolling', 'trading_calendar'}
+
+    # A change in the source of a helper is a new code version
+    memo.code_version.cache_clear()
+    v0 = memo.code_version('ap_test_estimator')
+    src = memo.inspect.getsource
+
+    def edited(x):
+        if x is m:
+            return ''
+
+        return src(x) + ('# edit' if x is rolling else '')
+
+    monkeypatch.setattr(memo.inspect, 'getsource', edited)
+    memo.code_version.cache_clear()
+    assert memo.code_version('ap_test_estimator') != v0
+    memo.code_version.cache_clear()
+
+class fake_conn:
+    def __init__(self):
+        self.reltuples = 100
+        self.reads = 0
+
+    def raw_sql(self, sql, params=None, **kwargs):
+        if params is not None:
+            return memo.pd.DataFrame({'nspname': [params['schema']],
+                'relname': [params['table']], 'reltuples': [self.reltuples]})
+
+        self.reads += 1
+        return memo.pd.DataFrame({'x': [1.0, 2.0]})
+
+def test_query_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(memo, 'cache_dir', str(tmp_path))
+    monkeypatch.setattr(memo, 'cache_size', 1024**3)
+    conn = fake_conn()
+    sql = 'select x from crsp.dsf'
+    df, key = memo.query(conn, sql)
+    assert conn.reads == 1 and key is not None
+
+    # Same query and snapshot: the local copy, whitespace does not matter
+    df2, key2 = memo.query(conn, ' select x\n  from crsp.dsf ')
+    assert conn.reads == 1 and key2 == key
+    assert df2.equals(df)
+
+    # Parameters of read are part of the key
+    _, key3 = memo.query(conn, sql, tag=(21,))
+    assert conn.reads == 2 and key3 != key
+
+    # An update of the source table is a new key
+    conn.reltuples = 101
+    _, key4 = memo.query(conn, sql)
+    assert conn.reads == 3 and key4 != key
+
+def test_source_keys_skip_hashing(monkeypatch, tmp_path):
+    monkeypatch.setattr(memo, 'cache_dir', str(tmp_path))
+    monkeypatch.setattr(memo, 'cache_size', 1024**3)
+
+    class est:
+        calls = 0
+
+        @memo.memoize('dsf')
+        def run(self):
+            est.calls += 1
+            return self.dsf
+
+    def fail(df):
+        raise AssertionError('frame is hashed')
+
+    db = est()
+    db.dsf = memo.pd.DataFrame({'x': [1.0, 2.0]})
+    memo.source(db, dsf='k1')
+    monkeypatch.setattr(memo, 'frame_fingerprint', fail)
+    db.run()
+    db.run()
+    assert est.calls == 1
+
+    # A frame from another query is a new input
+    db2 = est()
+    db2.dsf = db.dsf
+    memo.source(db2, dsf='k2')
+    db2.run()
+    assert est.calls == 2
+
+    # Without a key the frame is hashed
+    db3 = est()
+    db3.dsf = db.dsf
+    memo.source(db3, dsf=None)
+    with pytest.raises(AssertionError, match='frame is hashed'):
+        db3.run()
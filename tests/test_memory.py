@@ -0,0 +1,111 @@
+# Peak memory of the estimators on synthetic panels, relative to the size
+# of the input frame. Inputs are used without copies (copy-on-write) and
+# are not changed by the estimators. Daily rolling estimators work on
+# blocks of stocks, so small blocks are used to make the peak scale with
+# the input. The bounds fail if an estimator keeps one more copy of its
+# input
+import functools
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pytest
+from checkpoint import ap_checkpoint
+
+pytest.importorskip('wrds')
+
+def peak(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def size(df):
+    return df.memory_usage(deep=True).sum()
+
+def daily(n_stock, n_day, cols, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', periods=n_day)
+    d = np.tile(np.arange(n_day), n_stock)
+    df = pd.DataFrame({'permno': np.repeat(np.arange(n_stock)+10001, n_day),
+        'date': dates[d], 'd': d})
+    for i in cols:
+        df[i] = rng.normal(0, 0.02, len(d))
+
+    return df, dates, rng
+
+# Values are the same and numeric columns are the same buffers (string
+# columns are converted by to_numpy)
+def unchanged(df, copy):
+    assert df.equals(copy)
+    for i in df.columns:
+        if df[i].dtype.kind in 'iufM':
+            assert np.shares_memory(df[i].to_numpy(), copy[i].to_numpy())
+
+def test_volume_memory():
+    from volume import ap_volume
+    dsf, _, _ = daily(500, 1000, ['to_d', 'dvol_d', 'illiq_d'])
+    dsf = dsf.drop(columns='d')
+    db = ap_volume.__new__(ap_volume)
+    db.dsf, db.vol_m = dsf, None
+    ref = dsf.copy(deep=False)
+    p = peak(lambda: db.vol_multi_est([(6, 50, 'to_d', 'tur6'),
+        (12, 100, 'dvol_d', 'dvol12'), (12, 100, 'illiq_d', 'illiq12')]))
+    assert p < 1.75*size(dsf)
+    unchanged(db.dsf, ref)
+
+def ivol(dsf, dates, rng):
+    from trading_calendar import ap_calendar
+    from idiosyncratic_volatility import ap_ivol
+    ff3 = pd.DataFrame({'date': dates, 'rf': 0.0})
+    for i in ['mktrf', 'smb', 'hml']:
+        ff3[i] = rng.normal(0, 0.01, len(dates))
+
+    db = ap_ivol.__new__(ap_ivol)
+    db.cal = ap_calendar(dates)
+    db.cal.add(ff3, ['mktrf', 'smb', 'hml', 'rf'])
+    db.dsf, db.ff3 = dsf, ff3
+    return db
+
+def test_ivol_rolling_memory(monkeypatch):
+    import rolling
+    import idiosyncratic_volatility
+    monkeypatch.setattr(idiosyncratic_volatility, 'permno_blocks',
+        functools.partial(rolling.permno_blocks, rows=20000))
+    db = ivol(*daily(500, 1000, ['ret']))
+    ref = db.dsf.copy(deep=False)
+    p = peak(lambda: db.ivol_rolling_est('ff3', (21, 252)))
+    assert p < 5.75*size(db.dsf)
+    unchanged(db.dsf, ref)
+
+def test_ivol_memory(tmp_path):
+    db = ivol(*daily(20, 500, ['ret']))
+    db.ckpt = ap_checkpoint('ivol', tmp_path)
+    ref = db.dsf.copy(deep=False)
+    p = peak(lambda: db.loading_est('capm'))
+    assert p < 7.5*size(db.dsf)
+    unchanged(db.dsf, ref)
+
+def test_accounting_memory(tmp_path):
+    from accounting import ap_accounting
+    rng = np.random.default_rng(0)
+    n_firm, n_year = 2000, 30
+    fyear = np.tile(np.arange(1990, 1990+n_year), n_firm)
+    funda = pd.DataFrame({'gvkey': np.repeat([f'{i:06d}' for i in
+        range(n_firm)], n_year), 'fyear': fyear})
+    funda['datadate'] = pd.to_datetime(fyear*10000+1231, format='%Y%m%d')
+    for i in ['at', 'ceq', 'pstk', 'capx', 'sale', 'invt', 'ppegt', 'che',
+        'dlc', 'dltt', 'mib', 'ppent', 'intan', 'ao', 'lo', 'dp', 'csho',
+        'ajex', 'act', 'lct', 'txp', 'ni', 'oancf', 'ivao', 'lt', 'ivst',
+        'ivncf', 'fincf', 'prstkc', 'sstk', 'dv']:
+        funda[i] = rng.random(len(fyear))*100 + 1
+
+    funda['date'] = funda['datadate'] + pd.offsets.MonthEnd(6)
+    db = ap_accounting.__new__(ap_accounting)
+    db.funda = funda
+    db.ckpt = ap_checkpoint('accounting', tmp_path)
+    ref = funda.copy(deep=False)
+    p = peak(db.annual_est)
+    assert p < 1.75*size(funda)
+    unchanged(db.funda, ref)
@@ -0,0 +1,56 @@
+# Past returns from a daily panel against compounding daily returns
+# month by month
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('wrds')
+
+def daily(seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', '2002-06-28')
+    df = pd.DataFrame({'permno': np.repeat([10001, 10002, 10003], len(dates)),
+        'date': np.tile(dates, 3)})
+    df['ret'] = rng.normal(0.001, 0.02, len(df))
+    df.loc[rng.random(len(df))<0.05, 'ret'] = np.nan
+    ym = df['date'].dt.year*100 + df['date'].dt.month
+    # No trading in 200106 for 10002, no valid return in 200103 for 10003
+    df = df[~((df['permno']==10002) & (ym==200106))]
+    df.loc[(df['permno']==10003) & (ym==200103), 'ret'] = np.nan
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+def reference(dsf, windows):
+    df = dsf.assign(yyyymm=dsf['date'].dt.year*100 + dsf['date'].dt.month)
+    df['g'] = 1 + df['ret'].where(df['ret']>-1)
+    m = df.groupby(['permno', 'yyyymm'])['g'].agg(['prod', 'count'])
+    res = []
+    for (p, ym) in m.index:
+        t = (ym//100)*12 + ym%100 - 1
+        row = {'permno': p, 'yyyymm': ym}
+        for name, (s, e) in windows.items():
+            past = [((t-j)//12)*100 + (t-j)%12 + 1 for j in range(1, e+1)]
+            keys = [(p, i) for i in past]
+            row[name] = np.nan
+            if all(k in m.index for k in keys):
+                n = sum(m.loc[k, 'count']>0 for k in keys)
+                if n >= e-1:
+                    row[name] = np.prod([m.loc[k, 'prod'] for k in keys[s-1:]
+                        if m.loc[k, 'count']>0]) - 1
+
+        res.append(row)
+
+    df = pd.DataFrame(res).dropna(subset=list(windows), how='all')
+    return df.reset_index(drop=True)
+
+def test_preret_from_dsf():
+    from past_returns import ap_preret
+    dsf = daily()
+    windows = {'pre3ret': (1, 3), 'pre6ret': (1, 6), 'pre12_7ret': (7, 12)}
+    db = ap_preret(dsf)
+    got = db.preret_multi_est(windows)
+    ref = reference(dsf, windows)
+    assert (got[['permno', 'yyyymm']].to_numpy()
+        == ref[['permno', 'yyyymm']].to_numpy()).all()
+    assert np.allclose(got[list(windows)], ref[list(windows)], equal_nan=True)
+    # Gaps and months without returns are covered
+    assert got['pre6ret'].isna().any() and got['pre6ret'].notna().any()
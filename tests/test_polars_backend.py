@@ -0,0 +1,79 @@
+# The polars backend gives the same output as the pandas code on a
+# synthetic daily panel with missing returns, ties, short months and
+# months without trading
+import importlib
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('wrds')
+pytest.importorskip('polars')
+
+def panel(n_stock=40, n_day=600, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', periods=n_day)
+    permno = np.repeat(np.arange(n_stock)+10001, n_day)
+    date = np.tile(dates, n_stock)
+    # Returns on a grid, so some days of a month have the same return
+    ret = np.round(rng.normal(0, 0.02, len(permno)), 3)
+    ret[rng.random(len(ret))<0.05] = np.nan
+    df = pd.DataFrame({'permno': permno, 'date': date, 'ret': ret})
+    # Short months and months without trading
+    drop = rng.random(len(df)) < 0.2
+    ym = df['date'].dt.year*100 + df['date'].dt.month
+    gap = (df['permno']%5==0) & ym.isin([200004, 200011, 200103])
+    df = df[~(drop & (df['permno']%3==0)) & ~gap].reset_index(drop=True)
+    df['yyyymm'] = df['date'].dt.year*100 + df['date'].dt.month
+    n = len(df)
+    df['to_d'] = rng.random(n)
+    df['dvol_d'] = np.where(rng.random(n)<0.1, 0, rng.random(n)*1e6)
+    df['illiq_d'] = np.where(rng.random(n)<0.1, np.nan, rng.random(n))
+    df['prc'] = np.where(rng.random(n)<0.02, np.nan,
+        np.round(rng.random(n)*50+1, 1))
+    return df
+
+def compare(a, b, keys):
+    a = a.sort_values(keys).reset_index(drop=True)
+    b = b.sort_values(keys).reset_index(drop=True)
+    assert list(a.columns) == list(b.columns)
+    assert len(a) == len(b) and len(a) > 0
+    for i in keys:
+        assert (a[i].to_numpy() == b[i].to_numpy()).all()
+
+    for i in a.columns.difference(keys):
+        assert np.allclose(a[i].to_numpy(dtype=float),
+            b[i].to_numpy(dtype=float), rtol=1e-10, atol=1e-12,
+            equal_nan=True), i
+
+def estimator(module, cls, dsf):
+    db = getattr(importlib.import_module(module), cls).__new__(
+        getattr(importlib.import_module(module), cls))
+    db.dsf = dsf
+    return db
+
+def test_tvol():
+    dsf = panel()[['permno', 'date', 'ret']]
+    db = estimator('total_volatility', 'ap_tvol', dsf)
+    compare(db.tvol_est(), db.tvol_est(backend='polars'),
+        ['permno', 'yyyymm'])
+
+def test_maxret():
+    dsf = panel()[['permno', 'date', 'ret', 'yyyymm']].dropna()
+    db = estimator('max_daily_return', 'ap_maxret', dsf)
+    compare(db.maxret_all(5), db.maxret_all(5, backend='polars'),
+        ['permno', 'yyyymm'])
+
+def test_vol():
+    dsf = panel()[['permno', 'date', 'to_d', 'dvol_d', 'illiq_d']]
+    db = estimator('volume', 'ap_volume', dsf)
+    db.vol_m = None
+    specs = [(1, 10, 'to_d', 'tur1'), (6, 50, 'to_d', 'tur6'),
+        (3, 30, 'dvol_d', 'dvol3'), (6, 50, 'illiq_d', 'illiq6')]
+    compare(db.vol_multi_est(specs), db.vol_multi_est(specs,
+        backend='polars'), ['permno', 'yyyymm'])
+
+def test_week52_high():
+    dsf = panel()[['permno', 'yyyymm', 'date', 'prc']]
+    db = estimator('52week_high', 'ap_week52_high', dsf)
+    compare(db.week52_high(), db.week52_high(backend='polars'),
+        ['permno', 'yyyymm'])
@@ -0,0 +1,127 @@
+# Revise one gvkey, ticker or permno between two snapshots: the spliced
+# output of ap_revision equals a full rebuild on the new inputs
+import numpy as np
+import pandas as pd
+import pytest
+from checkpoint import ap_checkpoint
+from revision import ap_revision
+
+pytest.importorskip('wrds')
+
+# Permno 10002 is linked to gvkey 000002 before 2000 and 000003 after,
+# so a revision of 000003 recomputes 10002 with the rows of both
+def link(n):
+    df = pd.DataFrame({'permno': 10000+np.arange(n), 'gvkey':
+        [f'{i:06d}' for i in range(n)], 'namedt': pd.Timestamp('1980-01-01'),
+        'nameendt': pd.Timestamp('2030-12-31')})
+    df.loc[2, 'nameendt'] = pd.Timestamp('1999-12-31')
+    extra = {'permno': 10002, 'gvkey': '000003',
+        'namedt': pd.Timestamp('2000-01-01'),
+        'nameendt': pd.Timestamp('2030-12-31')}
+    return pd.concat([df, pd.DataFrame([extra])], ignore_index=True)
+
+def sue(rng, n=8, n_q=40):
+    from sue import ap_sue
+    q = np.arange(n_q)
+    datadate = pd.date_range('1990-03-31', periods=n_q, freq='QE')
+    fundq = pd.DataFrame({'gvkey': np.repeat([f'{i:06d}' for i in range(n)],
+        n_q), 'datadate': np.tile(datadate, n), 'qidx': np.tile(q+1, n)})
+    fundq['date'] = fundq['datadate'] + pd.offsets.MonthEnd(3)
+    fundq['rdq'] = fundq['datadate'] + pd.Timedelta(days=30)
+    fundq['eps'] = rng.normal(1, 0.5, len(fundq))
+    fundq['rps'] = rng.normal(5, 1, len(fundq))
+    db = ap_sue.__new__(ap_sue)
+    db.fundq, db.permno_gvkey = fundq, link(n)
+    keyed = {'fundq': 'gvkey', 'permno_gvkey': 'gvkey'}
+    return db, 'fundq', 'gvkey', '000003', keyed, 'permno_gvkey', \
+        'sue_multi_est', ([('eps', 'sue'), ('rps', 'sur')],)
+
+def accounting(rng, n=8, n_year=12):
+    from accounting import ap_accounting
+    fyear = np.tile(np.arange(1990, 1990+n_year), n)
+    funda = pd.DataFrame({'gvkey': np.repeat([f'{i:06d}' for i in range(n)],
+        n_year), 'fyear': fyear})
+    funda['datadate'] = pd.to_datetime(fyear*10000+1231, format='%Y%m%d')
+    for i in ['at', 'ceq', 'pstk', 'capx', 'sale', 'invt', 'ppegt', 'che',
+        'dlc', 'dltt', 'mib', 'ppent', 'intan', 'ao', 'lo', 'dp', 'csho',
+        'ajex', 'act', 'lct', 'txp', 'ni', 'oancf', 'ivao', 'lt', 'ivst',
+        'ivncf', 'fincf', 'prstkc', 'sstk', 'dv']:
+        funda[i] = rng.random(len(fyear))*100 + 1
+
+    funda['date'] = funda['datadate'] + pd.offsets.MonthEnd(6)
+    db = ap_accounting.__new__(ap_accounting)
+    db.funda, db.permno_gvkey = funda, link(n)
+    keyed = {'funda': 'gvkey', 'permno_gvkey': 'gvkey'}
+    return db, 'funda', 'gvkey', '000003', keyed, 'permno_gvkey', \
+        'accounting_est', ()
+
+def analysts(rng, n=8, n_month=36):
+    from analysts import ap_analysts
+    ym = np.array([(2000+i//12)*100 + i%12 + 1 for i in range(n_month)])
+    ibes = pd.DataFrame({'ticker': np.repeat([f'T{i}' for i in range(n)],
+        n_month), 'permno': np.repeat(10000+np.arange(n), n_month),
+        'yyyymm': np.tile(ym, n)})
+    # Ticker T3 moves to permno 10002 in 2002
+    ibes.loc[(ibes['ticker']=='T3') & (ibes['yyyymm']>=200201), 'permno'] = 10002
+    ibes = ibes.drop_duplicates(['permno', 'yyyymm'], keep='last')
+    ibes['numest'] = rng.integers(1, 10, len(ibes))
+    ibes['meanest'] = np.round(rng.normal(1, 1, len(ibes)), 2)
+    ibes['stdev'] = rng.random(len(ibes))
+    db = ap_analysts.__new__(ap_analysts)
+    db.ibes = ibes
+    return db, 'ibes', 'ticker', 'T3', {'ibes': 'ticker'}, 'ibes', \
+        'analysts_est', ()
+
+def tvol(rng, n=8, n_day=120):
+    from total_volatility import ap_tvol
+    dates = pd.bdate_range('2000-01-03', periods=n_day)
+    dsf = pd.DataFrame({'permno': np.repeat(10000+np.arange(n), n_day),
+        'date': np.tile(dates, n), 'ret': rng.normal(0, 0.02, n*n_day)})
+    db = ap_tvol.__new__(ap_tvol)
+    db.dsf = dsf
+    return db, 'dsf', 'permno', 10003, {'dsf': 'permno'}, None, 'tvol_est', ()
+
+@pytest.mark.parametrize('build', [sue, accounting, analysts, tvol])
+def test_splice(build, tmp_path):
+    rng = np.random.default_rng(0)
+    db, attr, key, changed, keyed, link_attr, method, args = build(rng)
+    name = build.__name__
+    if hasattr(db, 'funda'):
+        db.ckpt = ap_checkpoint('accounting', tmp_path/'ckpt1')
+
+    rev = ap_revision(name, tmp_path)
+    scope = rev.scope(db, keyed, link=link_attr)
+    assert scope is None
+    old = rev.estimate(db, method, scope, *args)
+    rev.commit()
+
+    # Revise the rows of one key
+    df = getattr(db, attr).copy()
+    col = [i for i in df.columns if df[i].dtype.kind=='f'][0]
+    sel = df[key]==changed
+    df.loc[sel, col] = df.loc[sel, col] + rng.normal(0, 1, sel.sum())
+    setattr(db, attr, df)
+    if hasattr(db, 'funda'):
+        db.ckpt = ap_checkpoint('accounting', tmp_path/'ckpt2')
+
+    rev = ap_revision(name, tmp_path)
+    scope = rev.scope(db, keyed, link=link_attr)
+    assert scope is not None
+    n_permno = len(pd.unique(old['permno']))
+    assert 0 < len(scope[0]) < n_permno
+    got = rev.estimate(db, method, scope, *args)
+    rev.commit()
+
+    ref = getattr(db, method)(*args).reset_index(drop=True)
+    with pytest.raises(AssertionError):
+        pd.testing.assert_frame_equal(old.reset_index(drop=True), ref,
+            check_dtype=False)
+
+    pd.testing.assert_frame_equal(got, ref, check_dtype=False)
+
+    # No revision: the previous output is kept
+    rev = ap_revision(name, tmp_path)
+    scope = rev.scope(db, keyed, link=link_attr)
+    assert len(scope[0]) == 0
+    pd.testing.assert_frame_equal(rev.estimate(db, method, scope, *args),
+        ref, check_dtype=False)
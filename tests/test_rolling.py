@@ -0,0 +1,146 @@
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from rolling import window_start, window_moments, window_topk, topk_mean
+
+# Stocks with gaps in trading days and runs of constant returns
+def panel(seed=1):
+    rng = np.random.default_rng(seed)
+    permno, d = [], []
+    for p in [3, 7, 8, 20]:
+        x = np.sort(rng.choice(np.arange(400), rng.integers(30, 300),
+            replace=False))
+        permno.append(np.full(len(x), p))
+        d.append(x)
+
+    permno, d = np.concatenate(permno), np.concatenate(d)
+    x = np.round(rng.normal(0, 0.02, len(d)), 2)
+    # A large first return and constant returns after it
+    x[0] = 0.5
+    x[1:60] = 0.01
+    x[200:260] = -0.03
+    return permno, d, x, rng
+
+def brute_start(permno, d, w):
+    return np.array([np.flatnonzero((permno==permno[i]) & (d>d[i]-w)
+        & (d<=d[i]))[0] for i in range(len(d))])
+
+@pytest.mark.parametrize('w', [1, 5, 21, 63])
+def test_window_moments(w):
+    permno, d, x, rng = panel()
+    start = window_start(permno, d, w)
+    assert (start==brute_start(permno, d, w)).all()
+    z = np.column_stack([x, rng.normal(size=len(x))])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        n, c2 = window_moments(z, permno, start)
+
+    for i in range(len(x)):
+        win = z[start[i]:i+1]
+        c = (win-win.mean(0)).T @ (win-win.mean(0))
+        assert n[i] == len(win)
+        assert np.allclose(c2[i], c, atol=1e-12)
+        # Constant returns have exactly zero variance
+        if (win[:, 0]==win[0, 0]).all():
+            assert c2[i, 0, 0] == 0 and c2[i, 0, 1] == 0
+        else:
+            assert c2[i, 0, 0] > 0
+
+@pytest.mark.parametrize('w,k', [(1, 1), (5, 3), (21, 5), (63, 5)])
+def test_window_topk(w, k):
+    permno, d, x, _ = panel()
+    start = window_start(permno, d, w)
+    mean = topk_mean(*window_topk(x, permno, d, w, k))
+    for i in range(len(x)):
+        win = x[start[i]:i+1]
+        s = np.sort(win)[::-1]
+        for j in range(k):
+            ref = win[win>=s[j]].mean() if j < len(s) else np.nan
+            assert np.isclose(mean[i, j], ref, equal_nan=True, atol=1e-12)
+
+# Windows are counted on the CRSP trading days (dsi), so the output of a
+# stock does not depend on the days other stocks trade
+@pytest.mark.parametrize('only', [None, 3])
+def test_tvol_rolling_constant(only):
+    pytest.importorskip('wrds')
+    from total_volatility import ap_tvol
+    permno, d, x, _ = panel()
+    if only is not None:
+        permno, d, x = permno[permno==only], d[permno==only], x[permno==only]
+
+    dates = pd.bdate_range('2000-01-03', periods=400)
+    dsf = pd.DataFrame({'permno': permno, 'date': dates[d], 'ret': x})
+    db = ap_tvol.__new__(ap_tvol)
+    db.dsf = dsf
+    db.dsi = pd.DataFrame({'date': dates})
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        df = db.tvol_rolling_est((21,))
+
+    start = brute_start(permno, d, 21)
+    ref = np.array([x[start[i]:i+1].std(ddof=1) if i-start[i]+1>=15
+        else np.nan for i in range(len(x))])
+    const = np.array([(x[start[i]:i+1]==x[i]).all() for i in range(len(x))])
+    got = dsf.merge(df, how='left', on=['permno', 'date'])['tvol_21d']
+    assert np.allclose(got, ref, atol=1e-12, equal_nan=True)
+    if only is None:
+        assert (const & ~np.isnan(ref)).sum() > 0
+        assert (got[const & ~np.isnan(ref)]==0).all()
+
+@pytest.mark.parametrize('only', [None, 3])
+def test_maxret_rolling(only):
+    pytest.importorskip('wrds')
+    from max_daily_return import ap_maxret
+    permno, d, x, _ = panel()
+    if only is not None:
+        permno, d, x = permno[permno==only], d[permno==only], x[permno==only]
+
+    dates = pd.bdate_range('2000-01-03', periods=400)
+    dsf = pd.DataFrame({'permno': permno, 'date': dates[d], 'ret': x})
+    db = ap_maxret.__new__(ap_maxret)
+    db.dsf = dsf
+    db.dsi = pd.DataFrame({'date': dates})
+    df = db.maxret_rolling_est(3, (21,))
+
+    start = brute_start(permno, d, 21)
+    got = dsf.merge(df, how='left', on=['permno', 'date'])
+    for i in range(len(x)):
+        win = x[start[i]:i+1]
+        s = np.sort(win)[::-1]
+        for j in range(3):
+            ref = win[win>=s[j]].mean() if len(win) >= 15 else np.nan
+            assert np.isclose(got[f'mdr{j+1}_21d'][i], ref, equal_nan=True,
+                atol=1e-12)
+
+# Standard deviation of excess returns must be greater than 0, so
+# constant windows have no ivol
+def test_ivol_rolling_constant():
+    pytest.importorskip('wrds')
+    from trading_calendar import ap_calendar
+    from idiosyncratic_volatility import ap_ivol
+    permno, d, x, rng = panel()
+    dates = pd.bdate_range('2000-01-03', periods=400)
+    ff3 = pd.DataFrame({'date': dates, 'mktrf': rng.normal(0, 0.01, 400),
+        'smb': rng.normal(0, 0.01, 400), 'hml': rng.normal(0, 0.01, 400),
+        'rf': 0.0})
+    db = ap_ivol.__new__(ap_ivol)
+    db.cal = ap_calendar(dates)
+    db.cal.add(ff3, ['mktrf', 'smb', 'hml', 'rf'])
+    db.ff3 = ff3
+    db.dsf = pd.DataFrame({'permno': permno, 'date': dates[d], 'ret': x,
+        'd': d})
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        df = db.ivol_rolling_est('capm', (21,))
+
+    start = brute_start(permno, d, 21)
+    got = db.dsf.merge(df, how='left', on=['permno', 'date'])['ivol_capm_21d']
+    for i in range(len(x)):
+        y, f = x[start[i]:i+1], ff3['mktrf'].to_numpy()[d[start[i]:i+1]]
+        if len(y) < 15 or (y==y[0]).all():
+            assert np.isnan(got[i])
+        else:
+            X = np.column_stack([np.ones(len(y)), f])
+            e = y - X @ np.linalg.lstsq(X, y, rcond=None)[0]
+            assert np.isclose(got[i], e.std(ddof=1), rtol=1e-7)
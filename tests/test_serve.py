@@ -0,0 +1,49 @@
+import urllib.error
+import numpy as np
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+
+def panel():
+    rng = np.random.default_rng(0)
+    ym = np.repeat([200001, 200002, 200003], 4)
+    return pd.DataFrame({'permno': np.tile([10001, 10002, 10005, 10007], 3),
+        'yyyymm': ym, 'tvol': rng.random(12), 'mdr1': rng.random(12)})
+
+def test_query(tmp_path):
+    from serve import build_store, ap_store, start_server, read_query
+    df = panel()
+    build_store(df, tmp_path)
+    server = start_server(ap_store(tmp_path), port=0)
+    try:
+        url = f'http://127.0.0.1:{server.server_port}'
+        res = read_query(url, ['tvol'], 200002, 200003, [10002, 10007, 99999])
+        ref = df[df['yyyymm'].between(200002, 200003)
+            & df['permno'].isin([10002, 10007])][['permno', 'yyyymm', 'tvol']]
+        assert res.equals(ref.reset_index(drop=True))
+    finally:
+        server.shutdown()
+
+# An error in a later month is an error status, not a truncated stream
+def test_query_error(tmp_path, monkeypatch):
+    from serve import build_store, ap_store, start_server, read_query
+    build_store(panel(), tmp_path)
+    store = ap_store(tmp_path)
+    month = store.month
+
+    def fail(i):
+        if i == 2:
+            raise OSError('read error')
+
+        return month(i)
+
+    monkeypatch.setattr(store, 'month', fail)
+    server = start_server(store, port=0)
+    try:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            read_query(f'http://127.0.0.1:{server.server_port}', ['tvol'])
+
+        assert e.value.code == 500
+    finally:
+        server.shutdown()
@@ -0,0 +1,107 @@
+# ap_stream gives the same characteristics as the batch estimators for
+# any split of the daily panel into blocks, including duplicated rows
+# that straddle two blocks, a stock with constant returns and tied top
+# returns
+import numpy as np
+import pandas as pd
+import pytest
+from panel import kway_join
+from trading_calendar import ap_calendar
+from checkpoint import ap_checkpoint
+from streaming import ap_stream
+
+pytest.importorskip('wrds')
+
+def panel(n_stock=12, n_day=130, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', periods=n_day)
+    permno = np.repeat(np.arange(n_stock)+10001, n_day)
+    date = np.tile(dates, n_stock)
+    # Returns on a grid, so the top returns of a month have ties
+    ret = np.round(rng.normal(0, 0.02, len(permno)), 2)
+    ret[rng.random(len(ret))<0.05] = np.nan
+    dsf = pd.DataFrame({'permno': permno, 'date': date, 'ret': ret})
+    # Constant returns
+    dsf.loc[dsf['permno']==10001, 'ret'] = 0.01
+    # Short months
+    drop = (dsf['permno']==10002) & (rng.random(len(dsf))<0.4)
+    dsf = dsf[~drop]
+    # Days without factors
+    ff3 = pd.DataFrame({'date': dates[rng.random(n_day)>0.03], 'rf': 0.0001})
+    for i in ['mktrf', 'smb', 'hml']:
+        ff3[i] = rng.normal(0, 0.01, len(ff3))
+
+    # Duplicated rows, the last one is kept
+    dup = dsf.query('permno!=10001').sample(40, random_state=seed)
+    dup['ret'] = 0.5
+    dsf = pd.concat([dsf, dup])
+    clean = dsf.drop_duplicates(['permno', 'date'], keep='last')
+    dsf = dsf.sort_values('date', kind='stable', ignore_index=True)
+    return dsf, clean, ff3
+
+def batch(dsf, ff3, tmp_path):
+    from total_volatility import ap_tvol
+    from max_daily_return import ap_maxret
+    from skewness import ap_skew
+    from idiosyncratic_volatility import ap_ivol
+    cal = ap_calendar(ff3['date'])
+    cal.add(ff3, ['mktrf', 'smb', 'hml', 'rf'])
+    dsf = dsf.sort_values(['permno', 'date'], ignore_index=True)
+    dsf['d'] = cal.day_index(dsf['date'])
+    res = []
+    db = ap_tvol.__new__(ap_tvol)
+    db.dsf = dsf[['permno', 'date', 'ret']]
+    res.append(db.tvol_est())
+    db = ap_maxret.__new__(ap_maxret)
+    db.dsf = dsf[['permno', 'date', 'ret']].dropna()
+    db.dsf['yyyymm'] = db.dsf['date'].dt.year*100 + db.dsf['date'].dt.month
+    res.append(db.maxret_all(5))
+    db = ap_skew.__new__(ap_skew)
+    db.dsf, db.mktrf, db.cal = dsf, ff3, cal
+    res.append(db.skew_est())
+    db = ap_ivol.__new__(ap_ivol)
+    db.dsf, db.ff3, db.cal, db.coef = dsf, ff3, cal, {}
+    db.ckpt = ap_checkpoint('ivol', tmp_path)
+    res.append(db.ivol_est('capm', 'ivol_capm'))
+    res.append(db.ivol_est('ff3', 'ivol_ff3'))
+    return kway_join(res, how='outer')
+
+def stream(dsf, ff3, size):
+    cal = ap_calendar(ff3['date'])
+    cal.add(ff3, ['mktrf', 'smb', 'hml', 'rf'])
+    st = ap_stream(cal)
+    blocks = (dsf.iloc[i:i+size] for i in range(0, len(dsf), size))
+    return pd.concat(st.run(blocks), ignore_index=True)
+
+@pytest.mark.parametrize('size', [1, 29, 500, 10**6])
+def test_stream(size, tmp_path):
+    dsf, clean, ff3 = panel()
+    ref = batch(clean, ff3, tmp_path)
+    got = stream(dsf, ff3, size)
+    chars = ['tvol'] + ['mdr'+str(i) for i in range(1, 6)] + ['iskew',
+        'coskew', 'ivol_capm', 'ivol_ff3']
+    assert list(got.columns) == ['permno', 'yyyymm'] + chars
+    df = ref.merge(got, how='outer', on=['permno', 'yyyymm'],
+        suffixes=('', '_s'), indicator=True)
+    assert (df['_merge']=='both').all()
+    for i in chars:
+        assert np.allclose(df[i].to_numpy(dtype=float),
+            df[i+'_s'].to_numpy(dtype=float), rtol=1e-8, atol=1e-12,
+            equal_nan=True), i
+
+    # Constant returns: zero tvol and no ivol or skewness
+    const = df.query('permno==10001')
+    assert len(const) > 0 and (const['tvol_s']==0).all()
+    assert const[['iskew_s', 'coskew_s', 'ivol_capm_s',
+        'ivol_ff3_s']].isna().all().all()
+    # Tied top returns are all averaged
+    r = clean.dropna().query('ret>-1')
+    r = r.assign(yyyymm=r['date'].dt.year*100 + r['date'].dt.month)
+    top = r.groupby(['permno', 'yyyymm'])['ret'].transform('max')
+    n_top = (r['ret']==top).groupby([r['permno'], r['yyyymm']]).sum()
+    assert (n_top>1).sum() > 0
+
+def test_stream_order():
+    dsf, _, ff3 = panel()
+    with pytest.raises(ValueError):
+        stream(dsf.iloc[::-1], ff3, 100)
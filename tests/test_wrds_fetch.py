@@ -0,0 +1,72 @@
+# fetch against a full read on a local database
+import numpy as np
+import pandas as pd
+import pytest
+
+sa = pytest.importorskip('sqlalchemy')
+
+class local_conn:
+    def __init__(self, path):
+        self.engine = sa.create_engine(f'sqlite:///{path}')
+
+    def raw_sql(self, sql, date_cols=None):
+        with self.engine.connect() as c:
+            return pd.read_sql_query(sa.text(sql), c, coerce_float=True,
+                parse_dates=date_cols)
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    import wrds_fetch
+    rng = np.random.default_rng(0)
+    n = 5000
+    df = pd.DataFrame({'permno': rng.integers(10000, 10100, n),
+        'date': pd.date_range('2000-01-01', periods=n, freq='h')
+            .strftime('%Y-%m-%d'),
+        'ret': rng.normal(size=n)})
+    df.loc[::7, 'ret'] = np.nan
+    # Text that is missing in the first chunks
+    df['ticker'] = np.where(np.arange(n)<3000, None, 'AB')
+    df.loc[4000, 'ticker'] = None
+    c = local_conn(tmp_path / 'db.sqlite')
+    df.to_sql('dsf', c.engine, index=False)
+    # Chunks of 1000 rows and a low estimate of the number of rows
+    monkeypatch.setattr(wrds_fetch, 'query_rows', lambda conn, sql: 100)
+    monkeypatch.setattr(wrds_fetch, 'chunk_rows', lambda sample, mem: 1000)
+    return c
+
+sql = 'select permno, date, ret, ticker from dsf'
+
+def test_fetch(conn):
+    from wrds_fetch import fetch
+    df = fetch(conn, sql, date_cols=['date'])
+    ref = conn.raw_sql(sql, date_cols=['date'])
+    assert df['ticker'].iloc[3000:].notna().sum() == 1999
+    assert df['ticker'].iloc[:3000].isna().all()
+    assert (df['ticker'].dropna() == 'AB').all()
+    pd.testing.assert_frame_equal(df, ref, check_dtype=False)
+
+# Numeric text is not converted
+def test_fetch_text(conn):
+    from wrds_fetch import fetch
+    with conn.engine.begin() as c:
+        c.execute(sa.text("update dsf set ticker='001234' where ticker='AB'"))
+
+    df = fetch(conn, sql)
+    assert (df['ticker'].dropna() == '001234').all()
+
+def test_fetch_spill(conn, tmp_path):
+    from wrds_fetch import fetch
+    spill = tmp_path / 'spill'
+    spill.mkdir()
+    # Parts of an earlier, longer run
+    stale = pd.DataFrame({'permno': [1], 'date': [pd.Timestamp('1990-01-01')],
+        'ret': [0.0], 'ticker': ['X']})
+    for j in range(10):
+        stale.to_parquet(spill / f'part-{j:05d}.parquet')
+
+    path = fetch(conn, sql, date_cols=['date'], spill=str(spill))
+    assert path == str(spill)
+    assert len(list(spill.iterdir())) == 5
+    df = pd.read_parquet(path)
+    ref = conn.raw_sql(sql, date_cols=['date'])
+    pd.testing.assert_frame_equal(df, ref, check_dtype=False)
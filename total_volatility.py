@@ -4,6 +4,11 @@
 # Total volatility is the standard deviation of daily returns in a
 # month with at least 15 daily returns
 #
+# tvol_rolling_est: standard deviation of daily returns over the past
+# 21, 63 and 252 trading days of each stock-day (tvol_21d, ...), at least
+# 15, 45 and 180 daily returns (see rolling.py). Trading days are the
+# days of the CRSP daily index file (crsp.dsi)
+#
 # Ang, Hodrick, Xing and Zhang (2006)
 # Hou, Xue and Zhang (2020)
 # ------------------------------------------------------------------
@@ -14,6 +19,13 @@ import pandas as pd
 import numpy as np
 import os
 import time
+from panel import sort_panel
+from trading_calendar import ap_calendar
+from rolling import min_days, permno_blocks, window_start, window_moments
+from memo import memoize, query, source
+from wrds_fetch import fetch
+from revision import ap_revision
+import polars_backend
 
 class ap_tvol:
     def __init__(self):
@@ -24,35 +36,50 @@ class ap_tvol:
         conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
         # Extract CRSP daily data
-        dsf = conn.raw_sql("""
+        dsf, dsf_key = query(conn, """
             select a.permno, a.date, a.ret
             from crsp.dsf a left join crsp.msenames b
                 on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
             where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
+        """, fetch,
+            date_cols=['date'])
+
+        # All CRSP trading days: rolling windows are counted on this
+        # calendar, not on the dates of the extracted stocks
+        dsi, dsi_key = query(conn, """
+            select date
+            from crsp.dsi
+            order by date
         """, date_cols=['date'])
 
         dsf = dsf.drop_duplicates(['permno', 'date'], keep='last')
         dsf.loc[dsf['ret']<=-1, 'ret'] = np.nan
         dsf['permno'] = dsf['permno'].astype(int)
-        self.dsf = dsf.copy()
+        self.dsf = dsf
+        self.dsi = dsi
+        source(self, dsf=dsf_key, dsi=dsi_key)
 
         end_time = time.time()
         print('\n--------- Extract data from WRDS ---------')
         print(f'Time used: {(end_time-start_time)/60: 3.1f} mins\n')
 
-    def tvol_est(self):
+    @memoize('dsf')
+    def tvol_est(self, backend='pandas'):
+        if backend == 'polars':
+            return polars_backend.tvol(self.dsf)
+
         start_time = time.time()
-        df = self.dsf.copy()
+        df = self.dsf.copy(deep=False)
 
         df['yyyymm'] = df['date'].dt.year*100 + df['date'].dt.month
         # Require at least 15 days in a month
         df = df.dropna()
         df['n'] = (df.groupby(['permno', 'yyyymm'])['ret'].transform('count'))
-        df = df.query('n>=15').copy()
+        df = df.query('n>=15')
         del df['n']
         df = (df.groupby(['permno', 'yyyymm'])
             ['ret'].std().to_frame('tvol').reset_index())
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        df = sort_panel(df, ['permno', 'yyyymm'])
 
         end_time = time.time()
         print(f'--------- Total volatility ---------\n')
@@ -60,10 +87,45 @@ class ap_tvol:
         print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
         return df
 
+    @memoize('dsf', 'dsi')
+    def tvol_rolling_est(self, windows=(21, 63, 252)):
+        start_time = time.time()
+        df = self.dsf.dropna()
+        cal = ap_calendar(self.dsi['date'])
+        df['d'] = cal.day_index(df['date'])
+        df = df.query('d>=0')
+        df = sort_panel(df, ['permno', 'd'])
+        permno = df['permno'].to_numpy()
+        d = df['d'].to_numpy()
+        ret = df['ret'].to_numpy(dtype=float)
+
+        res = {f'tvol_{w}d': np.full(len(df), np.nan) for w in windows}
+        for b, e in permno_blocks(permno):
+            for w in windows:
+                start = window_start(permno[b:e], d[b:e], w)
+                n, c2 = window_moments(ret[b:e, None], permno[b:e], start)
+                res[f'tvol_{w}d'][b:e] = np.where(n>=min_days(w),
+                    np.sqrt(c2[:, 0, 0]/np.maximum(n-1, 1)), np.nan)
+
+        df = df[['permno', 'date']]
+        for i in res:
+            df[i] = res[i]
+
+        df = df.dropna(subset=list(res), how='all').reset_index(drop=True)
+
+        end_time = time.time()
+        print(f'--------- Rolling total volatility ---------')
+        print(f'Obs: {len(df)}')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+        return df
+
 if __name__ == '__main__':
     db = ap_tvol()
-    tvol = db.tvol_est()
-    tvol = tvol.sort_values(['permno', 'yyyymm'], ignore_index=True)
+    # Recompute the permno whose daily returns are revised
+    rev = ap_revision('tvol')
+    scope = rev.scope(db, {'dsf': 'permno'})
+    tvol = rev.estimate(db, 'tvol_est', scope)
     data_dir = '/Volumes/Seagate/asset_pricing_data'
     tvol.to_csv(os.path.join(data_dir, 'tvol.txt'), sep='\t', index=False)
+    rev.commit()
     print('Done: data is generated')
@@ -0,0 +1,61 @@
+# ------------------------------------------------------------------
+#                       Trading-day calendar
+#
+# ap_calendar numbers the trading days of a date universe (factor or
+# CRSP dates) from 0. Daily rows carry the int32 day index instead of
+# being merged on datetime dates:
+#
+# factors are stored on the calendar and attached by take
+# yyyymm of a row is looked up by its day index
+#
+# "Last n trading days" windows are differences of the day index of a
+# stock (rolling.window_start). Monthly estimators select and check
+# months by yyyymm.
+#
+# Example
+# cal = ap_calendar(ff3['date'])
+# cal.add(ff3, ['mktrf', 'rf'])
+# d = cal.day_index(dsf['date'])   # -1 if the date is not a trading day
+# dsf['mktrf'] = cal.take('mktrf', d)
+# dsf['yyyymm'] = cal.yyyymm[d]
+# ------------------------------------------------------------------
+
+import pandas as pd
+import numpy as np
+
+class ap_calendar:
+    def __init__(self, dates):
+        self.date = np.unique(np.asarray(dates, dtype='datetime64[ns]'))
+        self.date = self.date[~np.isnat(self.date)]
+        d = pd.DatetimeIndex(self.date)
+        self.yyyymm = (d.year*100 + d.month).to_numpy(dtype=np.int32)
+        self.col = {}
+
+    def __len__(self):
+        return len(self.date)
+
+    # Day index of each date, -1 if it is not in the calendar
+    def day_index(self, dates):
+        x = np.asarray(dates, dtype='datetime64[ns]')
+        if len(self.date) == 0:
+            return np.full(len(x), -1, dtype=np.int32)
+
+        i = np.searchsorted(self.date, x)
+        i = np.minimum(i, len(self.date)-1)
+        return np.where(self.date[i]==x, i, -1).astype(np.int32)
+
+    # Store daily columns (e.g. factors) of df on the calendar
+    # Days that are not in df are missing
+    def add(self, df, cols):
+        d = self.day_index(df['date'])
+        ok = d >= 0
+        for i in cols:
+            x = np.full(len(self.date), np.nan)
+            x[d[ok]] = df[i].to_numpy(dtype=float)[ok]
+            self.col[i] = x
+
+    # Column values at day index d, missing where d is -1
+    def take(self, col, d):
+        d = np.asarray(d)
+        x = self.col[col][np.maximum(d, 0)]
+        return np.where(d>=0, x, np.nan)
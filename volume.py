@@ -36,6 +36,10 @@ import pandas as pd
 import numpy as np
 import os
 import time
+from panel import ap_panel
+from memo import memoize, query, source
+from wrds_fetch import fetch
+import polars_backend
 
 class ap_volume:
     def __init__(self):
@@ -46,20 +50,18 @@ class ap_volume:
         conn = wrds.Connection(wrds_username=cfg['wrds']['username'])
 
         # Extract CRSP daily data
-        # wrds package introduced new argument of `chunksize` from version 3.1.0
-        # to reduce memory usage and avoid memory error when retrieving large
-        # dataset. However, this requires dataframe appending which has poor
-        # performance. To speed up data retrieving, I do not apply `chunksize`.
-        # This will extract 77,734,734 (rows) by 7 (columns) and this is time
-        # consuming: around 40 mins (it might take more than 2 times longer if
-        # `chunksize` is enabled).
-        # Make `chunksize` enabled if you get memory error.
-        dsf = conn.raw_sql("""
+        # This will extract 77,734,734 (rows) by 7 (columns). `chunksize` in
+        # raw_sql avoids memory error but appends dataframes, which has poor
+        # performance. fetch reads chunks sized by a memory budget
+        # (AP_FETCH_MEM) into preallocated columns, so there is no appending
+        # and the columns become the data frame without a copy.
+        dsf, dsf_key = query(conn, """
             select a.permno, a.date, a.shrout, a.vol, a.ret, a.prc, b.exchcd
             from crsp.dsf a left join crsp.msenames b
                 on a.permno=b.permno and a.date>=b.namedt and a.date<=b.nameendt
             where b.exchcd between -2 and 3 and b.shrcd between 10 and 11
-        """, date_cols=['date'], chunksize=None)
+        """, fetch,
+            date_cols=['date'])
         end_time = time.time()
         sql_time = (end_time-start_time) / 60
         print('\n--------- Extract data from WRDS ---------')
@@ -87,65 +89,87 @@ class ap_volume:
         dsf['to_d'] = dsf['vol'] / dsf['shrout']
         dsf.loc[dsf['dvol_d']>0, 'illiq_d'] = dsf['ret'].abs() / dsf['dvol_d']
         dsf = dsf.drop(columns=['shrout', 'prc', 'ret', 'vol', 'exchcd'])
-        self.dsf = dsf.copy()
+        self.dsf = dsf
+        source(self, dsf=dsf_key)
+        self.vol_m = None
 
         end_time = time.time()
         print(f'Obs: {len(dsf)}')
         print(f'Time used (clean): {(end_time-start_time)/60: 3.1f} mins\n')
 
-    def vol_est(self, j, min_n, var, var_name):
+    # Monthly sums and number of days of to_d, dvol_d and illiq_d
+    # It is computed on the first request and reused by all windows
+    def vol_month(self):
+        if self.vol_m is not None and self.vol_m[0] is self.dsf:
+            return self.vol_m[1]
+
         start_time = time.time()
-        df = self.dsf.copy()
-        df['yyyymm'] = df['date'].dt.year * 100 + df['date'].dt.month
-
-        to_msum = (df.groupby(['permno', 'yyyymm'])
-            [var].sum(min_count=1).to_frame('var_m').reset_index())
-        to_mcount = (df.groupby(['permno', 'yyyymm'])
-            [var].count().to_frame('n').reset_index())
-        df = to_msum.merge(to_mcount, how='inner', on=['permno', 'yyyymm'])
-        df['date'] = pd.to_datetime(df['yyyymm'], format='%Y%m')
-        df['date'] = df['date'] + pd.offsets.MonthEnd(0)
-        df['midx'] = (df['date'].dt.year-1925) * 12 + df['date'].dt.month - 11
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
-        df['var_sum'] = (df.groupby('permno')['var_m']
-            .rolling(window=j, min_periods=1).sum().reset_index(drop=True))
-        df['day_sum'] = (df.groupby('permno')['n']
-            .rolling(window=j, min_periods=1).sum().reset_index(drop=True))
-        df['lmidx'] = df.groupby('permno')['midx'].shift(j-1)
-        df.loc[df['day_sum']<=0, 'day_sum'] = np.nan
-        df['v'] = df['var_sum'] / df['day_sum']
-        df.loc[df['day_sum']<min_n, 'v'] = np.nan
-        df['month_gap'] = df['midx'] - df['lmidx']
-        # Control month gap
-        df.loc[df['month_gap']!=j-1, 'v'] = np.nan
-        df = df.query('v==v').copy()
-        df[var_name] = df['v']
-        df = df[['permno', 'yyyymm', var_name]]
-        if var == 'dvol_d':
-            df.loc[df[var_name]<=0, var_name] = np.nan
-            df[var_name] = np.log(df[var_name])
-
-        df = df.sort_values(['permno', 'yyyymm'], ignore_index=True)
+        var_list = ['to_d', 'dvol_d', 'illiq_d']
+        df = self.dsf
+        yyyymm = df['date'].dt.year*100 + df['date'].dt.month
+        g = df[var_list].groupby([df['permno'], yyyymm.rename('yyyymm')])
+        df = g.sum().join(g.count(), rsuffix='_n').reset_index()
+        df['midx'] = (df['yyyymm']//100-1925) * 12 + df['yyyymm']%100 - 11
+        # Running sums within each stock for the rolling windows
+        csum = df.groupby('permno')[var_list+[i+'_n' for i in var_list]].cumsum()
+        df = df[['permno', 'yyyymm', 'midx']].join(csum)
+        self.vol_m = (self.dsf, df)
 
         end_time = time.time()
-        print(f'\n--------- {var_name} ---------')
+        print(f'\n--------- Monthly volume aggregates ---------')
         print(f'Obs: {len(df)}')
         print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
         return df
 
+    # Each spec is (j, min_n, var, var_name): average of daily var over
+    # past j months with at least min_n days
+    @memoize('dsf')
+    def vol_multi_est(self, specs, backend='pandas'):
+        if backend == 'polars':
+            return polars_backend.vol(self.dsf, specs)
+
+        start_time = time.time()
+        m = self.vol_month()
+        df = m[['permno', 'yyyymm']]
+
+        p = ap_panel(m, ['permno', 'yyyymm'])
+        midx = m['midx'].to_numpy()
+        grp_start = p.group_start(['permno'])
+        keep = np.zeros(len(m), dtype=bool)
+        for j, min_n, var, var_name in specs:
+            lo, ok = p.lag_index(j-1, ['permno'])
+            # Control month gap
+            ok &= (midx-midx[lo]) == j-1
+            # Rolling sums over past j months from running sums
+            prev = lo > grp_start
+            var_cs = m[var].to_numpy()
+            day_cs = m[var+'_n'].to_numpy()
+            var_sum = var_cs - np.where(prev, var_cs[lo-1], 0)
+            day_sum = day_cs - np.where(prev, day_cs[lo-1], 0)
+            ok &= (day_sum>0) & (day_sum>=min_n)
+            v = np.where(ok, var_sum/np.where(day_sum>0, day_sum, 1), np.nan)
+            if var == 'dvol_d':
+                v = np.log(np.where(v>0, v, np.nan))
+
+            df[var_name] = v
+            keep |= ok
+
+        df = df[keep].reset_index(drop=True)
+
+        end_time = time.time()
+        print(f'\n--------- {", ".join(i[3] for i in specs)} ---------')
+        print(f'Obs: {len(df)}')
+        print(f'Time used: {end_time-start_time: 3.1f} seconds\n')
+        return df
+
+    def vol_est(self, j, min_n, var, var_name):
+        return self.vol_multi_est([(j, min_n, var, var_name)])
+
 if __name__ == '__main__':
     db = ap_volume()
-    to6 = db.vol_est(6, 50, 'to_d', 'tur6')
-    to12 = db.vol_est(12, 100, 'to_d', 'tur12')
-    dvol6 = db.vol_est(6, 50, 'dvol_d', 'dvol6')
-    dvol12 = db.vol_est(12, 100, 'dvol_d', 'dvol12')
-    illiq6 = db.vol_est(6, 50, 'illiq_d', 'illiq6')
-    illiq12 = db.vol_est(12, 100, 'illiq_d', 'illiq12')
-    vol = (to6.merge(to12, how='outer', on=['permno', 'yyyymm'])
-        .merge(dvol6, how='outer', on=['permno', 'yyyymm'])
-        .merge(dvol12, how='outer', on=['permno', 'yyyymm'])
-        .merge(illiq6, how='outer', on=['permno', 'yyyymm'])
-        .merge(illiq12, how='outer', on=['permno', 'yyyymm']))
+    vol = db.vol_multi_est([(6, 50, 'to_d', 'tur6'), (12, 100, 'to_d', 'tur12'),
+        (6, 50, 'dvol_d', 'dvol6'), (12, 100, 'dvol_d', 'dvol12'),
+        (6, 50, 'illiq_d', 'illiq6'), (12, 100, 'illiq_d', 'illiq12')])
     print(f'Obs: {len(vol)}')
     data_dir = '/Volumes/Seagate/asset_pricing_data'
     vol.to_csv(os.path.join(data_dir, 'volume.txt'), sep='\t', index=False)
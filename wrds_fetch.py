@@ -0,0 +1,211 @@
+# ------------------------------------------------------------------
+#                       Chunked WRDS extraction
+#
+# raw_sql loads the whole result at once (memory error for large tables
+# such as crsp.dsf) or, with chunksize, appends data frames (slow).
+# fetch streams the result in chunks into preallocated numpy columns:
+#
+# 1. Estimate the number of rows (planner estimate) and the bytes per row
+#    (from the first rows of the result) of the query
+# 2. Pick the chunk size so that a chunk fits the memory budget
+# 3. Copy each chunk into column buffers at its offset. Buffers are
+#    allocated for the estimated number of rows and grow if needed.
+#    With spill, each chunk is written to a parquet file instead and
+#    the directory is returned.
+#
+# Numeric columns are float64 as in raw_sql. Columns in date_cols are
+# datetime64. Rows are streamed with a server-side cursor, so neither
+# the driver nor pandas holds more than one chunk of the result.
+#
+# Memory budget of a chunk: AP_FETCH_MEM in GB (default 1)
+#
+# Example
+# dsf = fetch(conn, 'select permno, date, ret from crsp.dsf',
+#     date_cols=['date'])
+# ------------------------------------------------------------------
+
+import pandas as pd
+import numpy as np
+import sqlalchemy as sa
+import json
+import os
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+fetch_mem = float(os.environ.get('AP_FETCH_MEM', 1)) * 1024**3
+
+# Planner estimate of the number of rows of a query (EXPLAIN), so the
+# query is not run twice. Buffers grow if the estimate is too low and
+# pages of unused buffer rows are never touched if it is too high
+def query_rows(conn, sql):
+    sql = sql.strip().rstrip(';')
+    plan = conn.raw_sql(f'explain (format json) {sql}').iloc[0, 0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
+# Bytes per row, with pandas overhead for strings
+def row_bytes(sample):
+    size = 0
+    for i in sample.columns:
+        x = sample[i]
+        if x.dtype == object:
+            size += 8 + 50 + (x.astype(str).str.len().mean() if len(x) else 0)
+        else:
+            size += 8
+
+    return max(size, 8)
+
+def chunk_rows(sample, mem=None):
+    mem = fetch_mem if mem is None else mem
+    # A chunk is held twice: in the driver and as a data frame
+    return max(int(mem / (2*row_bytes(sample))), 10000)
+
+# Rows are read through a server-side cursor (stream_results), so the
+# driver holds one chunk at a time instead of the whole result. Without
+# chunksize, the chunk size is set from the first rows of the stream.
+# The first chunk is returned even if it is empty (column names)
+def fetch_chunks(conn, sql, date_cols=None, chunksize=None, mem=None,
+    n_sample=1000):
+    date_cols = [] if date_cols is None else date_cols
+    with conn.engine.connect() as c:
+        res = c.execution_options(stream_results=True).execute(sa.text(sql))
+        cols = list(res.keys())
+        rows = res.fetchmany(n_sample if chunksize is None else chunksize)
+        if chunksize is None:
+            chunksize = chunk_rows(pd.DataFrame.from_records(rows,
+                columns=cols, coerce_float=True), mem)
+            if len(rows) == n_sample:
+                rows += res.fetchmany(max(chunksize-n_sample, 1))
+
+        first = True
+        while rows or first:
+            df = pd.DataFrame.from_records(rows, columns=cols,
+                coerce_float=True)
+            for i in date_cols:
+                df[i] = pd.to_datetime(df[i])
+
+            yield df
+            first = False
+            rows = res.fetchmany(chunksize)
+
+# Type of a column from the values of a chunk: None if all values are
+# missing (not known yet)
+def column_dtype(x, is_date):
+    if is_date:
+        return np.dtype('datetime64[ns]')
+    elif x.isna().all():
+        return None
+    elif pd.api.types.is_numeric_dtype(x):
+        return np.dtype(np.float64)
+    else:
+        return np.dtype(object)
+
+def missing(dtype, size):
+    x = np.empty(size, dtype=dtype)
+    x[:] = np.datetime64('NaT') if dtype.kind == 'M' else np.nan
+    return x
+
+def write_part(t, f):
+    tmp = f'{f}.{os.getpid()}.tmp'
+    pq.write_table(t, tmp)
+    os.replace(tmp, f)
+
+# Parts have the same column types: numeric columns are float64 as in
+# fetch, and a column gets its type from the first chunk where it has
+# values. Earlier parts, where it is missing, are rewritten with that
+# type. Other differences of types raise an error
+def spill_chunks(chunks, spill, date_cols):
+    if pa is None:
+        raise ImportError('pyarrow is required for spill')
+
+    os.makedirs(spill, exist_ok=True)
+    for i in os.listdir(spill):
+        if i.startswith('part-') and i.endswith('.parquet'):
+            os.remove(os.path.join(spill, i))
+
+    part = lambda j: os.path.join(spill, f'part-{j:05d}.parquet')
+    types = {}
+    for j, df in enumerate(chunks):
+        for i in df.columns:
+            dtype = column_dtype(df[i], i in date_cols)
+            if dtype is not None and dtype != object:
+                df[i] = df[i].astype(dtype)
+
+        t = pa.Table.from_pandas(df, preserve_index=False)
+        new = {i.name: i.type for i in t.schema
+            if i.name not in types and not pa.types.is_null(i.type)}
+        types.update(new)
+        schema = pa.schema([(i, types.get(i, pa.null())) for i in t.column_names])
+        write_part(t.cast(schema), part(j))
+        for j0 in range(j if new else 0):
+            t = pq.read_table(part(j0))
+            write_part(t.cast(schema), part(j0))
+
+    return spill
+
+# With spill, each chunk is written to a parquet file in the directory
+# spill (existing parts are removed first) and the directory is returned
+# instead of a data frame, so memory is bounded by one chunk. Read it
+# with pd.read_parquet or pyarrow.dataset
+def fetch(conn, sql, date_cols=None, mem=None, spill=None):
+    start_time = time.time()
+    date_cols = [] if date_cols is None else date_cols
+    chunks = fetch_chunks(conn, sql, date_cols, mem=mem)
+
+    if spill is not None:
+        return spill_chunks(chunks, spill, date_cols)
+
+    # Allocate 1% more than the estimate: rows may be added during
+    # the extraction. The type of a column is set by the first chunk
+    # where it has values (rows before are missing). A numeric column
+    # that later has text is widened to object, values are never coerced
+    size = int(query_rows(conn, sql)*1.01) + 1
+    buf = None
+    k = 0
+    for df in chunks:
+        if buf is None:
+            cols = list(df.columns)
+            chunksize = len(df)
+            buf = dict.fromkeys(cols)
+
+        if k+len(df) > size:
+            size = max(2*size, k+len(df))
+            for i in cols:
+                if buf[i] is not None:
+                    x = np.empty(size, dtype=buf[i].dtype)
+                    x[:k] = buf[i][:k]
+                    buf[i] = x
+
+        for i in cols:
+            dtype = column_dtype(df[i], i in date_cols)
+            if buf[i] is None and dtype is not None:
+                buf[i] = missing(dtype, size)
+            elif (buf[i] is not None and buf[i].dtype == np.float64
+                and dtype == object):
+                buf[i] = buf[i].astype(object)
+
+            if buf[i] is not None:
+                buf[i][k:k+len(df)] = df[i].to_numpy(dtype=buf[i].dtype)
+
+        k += len(df)
+
+    # Columns without any value are float64 as in raw_sql
+    for i in cols:
+        if buf[i] is None:
+            buf[i] = missing(np.dtype(np.float64), k)
+
+    # The frame uses the buffers without copying (object columns keep
+    # their dtype, otherwise they are converted)
+    df = pd.DataFrame({i: pd.Series(buf[i][:k], dtype=buf[i].dtype,
+        copy=False) for i in cols}, copy=False)
+    end_time = time.time()
+    print(f'Fetch: {k} rows in chunks of {chunksize} rows, '
+        f'{(end_time-start_time)/60: 3.1f} mins')
+    return df